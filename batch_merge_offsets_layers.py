@@ -0,0 +1,368 @@
+#!/usr/bin/python
+"""
+Offsets Blending - Batch Processing of a Campaign of Image Pairs
+
+Each pair directory contains the AMPCOR offsets layers to blend
+(default: layer1, layer2, layer3 - from high to low resolution).
+Pairs are processed headless on a process pool with the tiled engine;
+for each pair the blended layer and a JSON summary are written to
+<out_dir>/<pair path relative to the common parent of all the pairs>.
+Pairs whose outputs are up to date are skipped.
+
+--------
+usage: batch_merge_offsets_layers.py [-h] (--manifest MANIFEST | --glob GLOB)
+                                     [--out_dir OUT_DIR] [--n_procs N_PROCS]
+                                     [--mem_budget MEM_BUDGET] [--overwrite]
+                                     parameters
+
+positional arguments:
+  parameters            Processing Parameters File [yml - format].
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --manifest MANIFEST   Text file listing one pair directory per line.
+  --glob GLOB           Glob pattern matching the pair directories.
+  --out_dir OUT_DIR     Output directory.
+  --n_procs N_PROCS     Maximum number of pairs processed concurrently.
+  --mem_budget MEM_BUDGET
+                        Memory budget for the whole campaign [GB].
+  --overwrite           Process all pairs - ignore up to date outputs.
+
+UPDATE HISTORY:
+"""
+# - Python Dependencies
+from __future__ import print_function
+import os
+import glob
+import csv
+import json
+import hashlib
+import argparse
+import pathlib
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import yaml
+import numpy as np
+from offsets_layer import read_layer_headers, LAYER_BANDS, BAND_DTYPE, \
+    QUALITY_BANDS, QUALITY_DTYPES
+from merge_offsets_layers import fill_outliers_holes_tiled, tile_halo
+from utils.result_cache import ResultCache
+from utils.layer_store import LayerStore
+from utils.profiling import StageProfiler
+
+# - Processing parameters relevant to the blended output
+BLEND_PARAMETERS = ['metric', 'threshold', 'window_az', 'window_rg',
+                    'fill_strategy', 'kernel_size_az', 'kernel_size_rg',
+                    'median_engine', 'min_valid', 'layers', 'out_format',
+                    'compress', 'quality_dtype']
+# - Tiling parameters - relevant to the blended output of the median
+# - engines that quantize values per tile (all but scipy)
+TILE_PARAMETERS = ['tile_size_az', 'tile_size_rg']
+
+# - Default values of the batch processing parameters
+CAMPAIGN_DEFAULTS = {'layers': ['layer1', 'layer2', 'layer3'],
+                     'median_engine': 'scipy', 'min_valid': 1,
+                     'n_workers': 1, 'reader': 'gdal',
+                     'quality_dtype': 'float32',
+                     'tile_size_az': 1024, 'tile_size_rg': 1024,
+                     'out_format': 'COG', 'compress': 'DEFLATE'}
+
+
+def list_pairs(manifest: str = None, pattern: str = None) -> list:
+    """
+    List the pair directories to process.
+    :param manifest: text file listing one pair directory per line
+    :param pattern: glob pattern matching the pair directories
+    :return: sorted list of pair directories - list of pathlib.Path
+    """
+    if manifest is not None:
+        with open(manifest, 'r', encoding='utf8') as m_fid:
+            pairs = [ln.strip() for ln in m_fid.readlines()
+                     if ln.strip() and not ln.strip().startswith('#')]
+    else:
+        pairs = [p for p in glob.glob(pattern) if os.path.isdir(p)]
+    return sorted(pathlib.Path(p) for p in pairs)
+
+
+def pair_output_names(pairs: list) -> list:
+    """
+    Output directory names of the selected pairs: pair path relative to the
+    common parent directory of all the pairs - the pair name if all the
+    pairs share the same parent.
+    :param pairs: pair directories - list of pathlib.Path
+    :return: output names - list of pathlib.Path
+    """
+    if not pairs:
+        return []
+    a_paths = [os.path.abspath(p) for p in pairs]
+    root = os.path.commonpath([os.path.dirname(p) for p in a_paths])
+    o_names = [pathlib.Path(os.path.relpath(p, root)) for p in a_paths]
+    if len(set(o_names)) != len(o_names):
+        raise ValueError('Duplicate pair directories in the campaign')
+    return o_names
+
+
+def parameters_hash(param_proc: dict) -> str:
+    """
+    Hash of the processing parameters that affect the blended output.
+    :param param_proc: processing parameters - dict
+    :return: hexadecimal hash - str
+    """
+    b_param = {k: param_proc.get(k) for k in BLEND_PARAMETERS}
+    if param_proc.get('median_engine', 'scipy') != 'scipy':
+        b_param.update({k: param_proc.get(k) for k in TILE_PARAMETERS})
+    return hashlib.sha1(json.dumps(b_param, sort_keys=True).encode())\
+        .hexdigest()
+
+
+def is_up_to_date(pair_path: pathlib.Path, out_path: pathlib.Path,
+                  param_proc: dict) -> bool:
+    """
+    Verify if the outputs of the selected pair are up to date: the pair
+    summary exists, it was generated with the same parameters, and it is
+    newer than all the input files.
+    :param pair_path: pair directory
+    :param out_path: pair output directory
+    :param param_proc: processing parameters - dict
+    :return: bool
+    """
+    s_path = out_path.joinpath('summary.json')
+    if not s_path.is_file():
+        return False
+    with open(s_path, 'r', encoding='utf8') as s_fid:
+        summary = json.load(s_fid)
+    if summary.get('status') != 'done' \
+            or summary.get('parameters_hash') != parameters_hash(param_proc):
+        return False
+    try:
+        in_files = [f for l_name in param_proc['layers']
+                    for f in pair_path.joinpath(l_name).iterdir()]
+    except OSError:
+        # - missing layers - processed again and reported as failed
+        return False
+    return all(os.path.getmtime(f) <= os.path.getmtime(s_path)
+               for f in in_files)
+
+
+def estimate_pair_memory(pair_path: pathlib.Path, param_proc: dict) -> int:
+    """
+    Estimate the peak memory needed to blend a pair with the tiled engine.
+    Only the layer headers are read.
+    :param pair_path: pair directory
+    :param param_proc: processing parameters - dict
+    :return: memory estimate [bytes]
+    """
+    header = read_layer_headers(pair_path.joinpath(param_proc['layers'][0]))
+    shape = header['dense_offsets'].shape
+    # - same halo as the tiled engine - on each side of the tile
+    halo = tile_halo({k: param_proc[k]
+                      for k in ['metric', 'window_az', 'window_rg']},
+                     fill_strategy=param_proc['fill_strategy'],
+                     krn_size=(param_proc['kernel_size_az'],
+                               param_proc['kernel_size_rg']))
+    t_pixels = min(param_proc['tile_size_az'] + 2 * halo[0], shape[0]) \
+        * min(param_proc['tile_size_rg'] + 2 * halo[1], shape[1])
+    # - 7 bands x 3 layers - see the OffsetsLayer data type policy -
+    # - + filter outputs and temporaries (float64)
+    l_size = sum(np.dtype(QUALITY_DTYPES[param_proc['quality_dtype']]
+                          if b in QUALITY_BANDS else BAND_DTYPE).itemsize
+                 for b in LAYER_BANDS)
+    per_tile = t_pixels * (3 * l_size + 8 * 8)
+    return per_tile * 2 * max(param_proc['n_workers'], 1)
+
+
+def process_pair(pair_path: pathlib.Path, out_path: pathlib.Path,
+                 param_proc: dict) -> dict:
+    """
+    Blend the offsets layers of the selected pair and write the pair summary.
+    :param pair_path: pair directory
+    :param out_path: pair output directory
+    :param param_proc: processing parameters - dict
+    :return: pair summary - dict
+    """
+    start_time = datetime.datetime.now()
+    l_paths = [pair_path.joinpath(l_name) for l_name in param_proc['layers']]
+    outlier_kwd = {'metric': param_proc['metric'],
+                   'threshold': param_proc['threshold'],
+                   'window_az': param_proc['window_az'],
+                   'window_rg': param_proc['window_rg'],
+                   'median_engine': param_proc['median_engine'],
+                   'min_valid': param_proc['min_valid']}
+    summary = {'pair': str(pair_path), 'out_path': str(out_path),
+               'parameters_hash': parameters_hash(param_proc),
+               'parameters': {k: param_proc.get(k)
+                              for k in BLEND_PARAMETERS}}
+    profiler = StageProfiler().enable() \
+        if param_proc.get('profiling', False) else None
+    # - Tiles and stages whose inputs did not change are reused
+    cache = ResultCache(param_proc['cache_dir'],
+                        max_size=param_proc.get('cache_size', 2.),
+                        content_hash=param_proc.get('cache_content_hash',
+                                                    False)) \
+        if param_proc.get('cache_dir') is not None else None
+    # - Layers shared by several pairs are loaded once per node
+    store = LayerStore(param_proc['layer_store_dir']) \
+        if param_proc.get('layer_store_dir') is not None else None
+    try:
+        f_layer = fill_outliers_holes_tiled(
+            *l_paths, out_path.joinpath('blended_layer'), outlier_kwd,
+            fill_strategy=param_proc['fill_strategy'],
+            krn_size=(param_proc['kernel_size_az'],
+                      param_proc['kernel_size_rg']),
+            tile_size=(param_proc['tile_size_az'],
+                       param_proc['tile_size_rg']),
+            median_engine=param_proc['median_engine'],
+            min_valid=param_proc['min_valid'],
+            n_workers=param_proc['n_workers'],
+            reader=param_proc['reader'],
+            out_format=param_proc['out_format'],
+            compress=param_proc['compress'], cache=cache, store=store,
+            quality_dtype=param_proc['quality_dtype'])
+        shape = read_layer_headers(l_paths[0])['dense_offsets'].shape
+        summary.update({'status': 'done', 'shape': list(shape),
+                        'n_outliers': f_layer['n_outliers'],
+                        'outliers_fraction':
+                            f_layer['n_outliers'] / (shape[0] * shape[1])})
+    except Exception as err:     # - report the failure and move on
+        summary.update({'status': 'failed', 'error': repr(err)})
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            summary['profiling'] = profiler.summary()
+        if cache is not None:
+            summary['cache'] = cache.stats
+        if store is not None:
+            summary['layer_store'] = store.stats
+            store.close()
+    summary['elapsed_time'] \
+        = (datetime.datetime.now() - start_time).total_seconds()
+    os.makedirs(out_path, exist_ok=True)
+    with open(out_path.joinpath('summary.json'), 'w',
+              encoding='utf8') as s_fid:
+        json.dump(summary, s_fid, indent=2)
+    return summary
+
+
+def run_campaign(pairs: list, out_dir: pathlib.Path, param_proc: dict,
+                 n_procs: int = 1, mem_budget: float = None,
+                 overwrite: bool = False) -> list:
+    """
+    Blend the offsets layers of all the selected pairs on a process pool.
+    :param pairs: pair directories - list of pathlib.Path
+    :param out_dir: output directory
+    :param param_proc: processing parameters - dict
+    :param n_procs: maximum number of pairs processed concurrently
+    :param mem_budget: memory budget for the whole campaign [GB] - limits
+        the number of pairs processed concurrently
+    :param overwrite: process all pairs - ignore up to date outputs
+    :return: pair summaries - list of dict
+    """
+    param_proc = {**CAMPAIGN_DEFAULTS, **param_proc}
+    todo = []
+    summaries = []
+    for pair_path, o_name in zip(pairs, pair_output_names(pairs)):
+        out_path = out_dir.joinpath(o_name)
+        if not overwrite and is_up_to_date(pair_path, out_path, param_proc):
+            print(f'# - {o_name}: up to date - skipped.')
+            with open(out_path.joinpath('summary.json'), 'r',
+                      encoding='utf8') as s_fid:
+                summaries.append({**json.load(s_fid), 'skipped': True})
+        else:
+            todo.append((pair_path, out_path))
+
+    if todo and mem_budget is not None:
+        pair_mem = []
+        for pair_path, _ in todo:
+            try:
+                pair_mem.append(estimate_pair_memory(pair_path, param_proc))
+            except Exception as err:
+                # - missing or invalid layers - the pair is reported as
+                # - failed by process_pair
+                print(f'# - {pair_path.name}: memory estimate failed - '
+                      f'{err!r}')
+        if pair_mem:
+            n_procs = max(min(n_procs,
+                              int(mem_budget * 1024 ** 3 // max(pair_mem))),
+                          1)
+    if todo and param_proc.get('layer_store_dir') is not None:
+        # - bands left in the store by killed processes
+        LayerStore(param_proc['layer_store_dir']).cleanup()
+    print(f'# - Pairs to process: {len(todo)} - concurrent pairs: {n_procs}')
+    with ProcessPoolExecutor(max_workers=max(n_procs, 1)) as pool:
+        futures = [pool.submit(process_pair, pair_path, out_path, param_proc)
+                   for pair_path, out_path in todo]
+        for future in as_completed(futures):
+            summary = future.result()
+            print(f"# - {pathlib.Path(summary['pair']).name}: "
+                  f"{summary['status']} - {summary['elapsed_time']:.1f} s")
+            summaries.append(summary)
+
+    # - Campaign summary
+    os.makedirs(out_dir, exist_ok=True)
+    with open(out_dir.joinpath('campaign_summary.csv'), 'w',
+              encoding='utf8', newline='') as c_fid:
+        writer = csv.writer(c_fid)
+        writer.writerow(['pair', 'status', 'n_outliers', 'outliers_fraction',
+                         'elapsed_time', 'skipped'])
+        for summary in sorted(summaries, key=lambda s: s['pair']):
+            writer.writerow([summary['pair'], summary['status'],
+                             summary.get('n_outliers'),
+                             summary.get('outliers_fraction'),
+                             summary.get('elapsed_time'),
+                             summary.get('skipped', False)])
+    return summaries
+
+
+def main() -> None:
+    """
+    Main: Offsets Blending - Batch Processing of a Campaign of Image Pairs
+    """
+    # - Read the system arguments listed after the program
+    parser = argparse.ArgumentParser(
+        description="""Offsets Blending - Batch Processing of a Campaign
+            of Image Pairs.
+            """
+    )
+    # - Positional Arguments
+    parser.add_argument('parameters', type=str,
+                        help='Processing Parameters File [yaml - format].')
+    pairs_grp = parser.add_mutually_exclusive_group(required=True)
+    pairs_grp.add_argument('--manifest', type=str,
+                           help='Text file listing one pair directory '
+                                'per line.')
+    pairs_grp.add_argument('--glob', type=str,
+                           help='Glob pattern matching the pair '
+                                'directories.')
+    parser.add_argument('--out_dir', type=str, default='.',
+                        help='Output directory.')
+    parser.add_argument('--n_procs', type=int, default=os.cpu_count(),
+                        help='Maximum number of pairs processed '
+                             'concurrently.')
+    parser.add_argument('--mem_budget', type=float, default=None,
+                        help='Memory budget for the whole campaign [GB].')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Process all pairs - ignore up to date '
+                             'outputs.')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.parameters):
+        raise FileNotFoundError(':  Parameters file Not Found.')
+    # - Import parameters with PyYaml
+    with open(args.parameters, 'r', encoding='utf8') as stream:
+        param_proc = yaml.safe_load(stream)
+
+    pairs = list_pairs(manifest=args.manifest, pattern=args.glob)
+    print(f'# - Number of pairs found: {len(pairs)}')
+    summaries = run_campaign(pairs, pathlib.Path(args.out_dir), param_proc,
+                             n_procs=args.n_procs,
+                             mem_budget=args.mem_budget,
+                             overwrite=args.overwrite)
+    n_failed = sum(s['status'] != 'done' for s in summaries)
+    print(f'# - Pairs failed: {n_failed}')
+
+
+if __name__ == '__main__':
+    start_time = datetime.datetime.now()
+    main()
+    end_time = datetime.datetime.now()
+    print(f'# - Computation Time: {end_time - start_time}')
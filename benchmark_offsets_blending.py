@@ -0,0 +1,426 @@
+#!/usr/bin/python
+"""
+Offsets Blending - Benchmark Suite on Synthetic AMPCOR Offsets Layers
+
+Synthetic image pairs (see utils.synthetic_layers) are generated once
+for each selected size and raster format and reused by the following
+runs. The benchmark times:
+ - OffsetsLayer loading - for each reader,
+ - OffsetsLayer.identify_outliers - for each outlier metric,
+ - fill_outliers_holes - for each filling strategy (the tiled engine is
+   used for layers larger than --tiled_above).
+Each case runs in a fresh process: wall time, CPU time and peak memory
+are measured per case, together with the per-stage statistics recorded
+by utils.profiling. Case results (number of outliers, band checksums)
+and performance can be compared with a stored baseline.
+
+--------
+usage: benchmark_offsets_blending.py [-h] [--parameters PARAMETERS]
+                                     [--sizes SIZES [SIZES ...]]
+                                     [--formats FORMATS [FORMATS ...]]
+                                     [--readers READERS [READERS ...]]
+                                     [--metrics METRICS [METRICS ...]]
+                                     [--strategies STRATEGIES [...]]
+                                     [--data_dir DATA_DIR]
+                                     [--out_dir OUT_DIR] [--repeat REPEAT]
+                                     [--tiled_above TILED_ABOVE]
+                                     [--seed SEED] [--baseline BASELINE]
+                                     [--save_baseline SAVE_BASELINE]
+                                     [--time_tolerance TIME_TOLERANCE]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --parameters          Processing Parameters File [yaml - format] -
+                        overrides the benchmark defaults.
+  --sizes               Synthetic layers sizes [pixels per side].
+  --formats             Synthetic layers raster formats [ENVI, GTiff].
+  --readers             OffsetsLayer readers [gdal, memmap].
+  --metrics             Outlier metrics.
+  --strategies          Outliers filling strategies.
+  --data_dir            Synthetic layers directory.
+  --out_dir             Benchmark report directory.
+  --repeat              Number of runs per case - the fastest is kept.
+  --tiled_above         Use the tiled engine above this size [pixels].
+  --seed                Synthetic layers random seed.
+  --baseline            Baseline to compare with [JSON].
+  --save_baseline       Save the benchmark results as baseline [JSON].
+  --time_tolerance      Relative wall time / peak memory tolerance.
+
+Example - production sizes:
+  python benchmark_offsets_blending.py --sizes 1000 5000 10000 20000
+      --baseline baseline.json
+
+UPDATE HISTORY:
+"""
+# - Python Dependencies
+from __future__ import print_function
+import os
+import sys
+import csv
+import json
+import shutil
+import argparse
+import pathlib
+import platform
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import yaml
+from offsets_layer import OffsetsLayer
+from merge_offsets_layers import fill_outliers_holes, \
+    fill_outliers_holes_tiled
+from utils.synthetic_layers import write_synthetic_pair
+from utils.profiling import StageProfiler, process_counters
+
+# - Default benchmark parameters
+BENCHMARK_DEFAULTS = {'window_az': 15, 'window_rg': 15,
+                      'kernel_size_az': 9, 'kernel_size_rg': 9,
+                      'median_engine': 'scipy', 'min_valid': 1,
+                      'n_workers': 1, 'tile_size_az': 1024,
+                      'tile_size_rg': 1024, 'fill_metric': 'median_filter'}
+# - Outliers threshold of each metric - synthetic layers
+BENCHMARK_THRESHOLDS = {'snr': 4., 'covariance': 1., 'median_filter': 5.,
+                        'mad': 5., 'sigma_clip': 3.}
+# - Case statuses flagged as regressions
+REGRESSIONS = ('mismatch', 'slower', 'more_memory')
+
+
+def band_checksum(values: np.ndarray, block_rows: int = 1024) -> dict:
+    """
+    Checksum of a band - computed block by block.
+    :param values: band values - np.ndarray
+    :param block_rows: number of rows processed at once
+    :return: sum and sum of absolute values of the valid samples, number
+        of NaN samples - dict
+    """
+    b_sum, b_abs, n_nan = 0., 0., 0
+    for row in range(0, values.shape[0], block_rows):
+        block = np.asarray(values[row:row + block_rows], dtype=np.float64)
+        b_sum += np.nansum(block)
+        b_abs += np.nansum(np.abs(block))
+        n_nan += int(np.isnan(block).sum())
+    return {'sum': b_sum, 'abs_sum': b_abs, 'n_nan': n_nan}
+
+
+def list_cases(sizes: list, formats: list, readers: list, metrics: list,
+               strategies: list) -> list:
+    """
+    List the benchmark cases.
+    :param sizes: layers sizes [pixels per side]
+    :param formats: layers raster formats
+    :param readers: OffsetsLayer readers
+    :param metrics: outlier metrics
+    :param strategies: outliers filling strategies
+    :return: cases - list of dict
+    """
+    cases = []
+    for size in sizes:
+        for r_format in formats:
+            c_base = {'size': size, 'format': r_format}
+            cases += [{**c_base, 'operation': 'load', 'variant': r}
+                      for r in readers]
+            cases += [{**c_base, 'operation': 'identify_outliers',
+                       'variant': m} for m in metrics]
+            cases += [{**c_base, 'operation': 'fill_outliers_holes',
+                       'variant': s} for s in strategies]
+    return cases
+
+
+def case_id(case: dict) -> str:
+    """Unique case identifier"""
+    return f"{case['size']}/{case['format']}/{case['operation']}/" \
+           f"{case['variant']}"
+
+
+def run_operation(case: dict, l_paths: list, out_path: pathlib.Path,
+                  param_bench: dict) -> dict:
+    """
+    Run the operation of a benchmark case.
+    :param case: benchmark case - dict
+    :param l_paths: synthetic layers paths - list
+    :param out_path: temporary output directory
+    :param param_bench: benchmark parameters - dict
+    :return: operation results - dict
+    """
+    window = (param_bench['window_az'], param_bench['window_rg'])
+    f_param = {'median_engine': param_bench['median_engine'],
+               'min_valid': param_bench['min_valid'],
+               'n_workers': param_bench['n_workers']}
+    if case['operation'] == 'load':
+        layer = OffsetsLayer(l_paths[0], reader=case['variant'])
+        # - touch all the bands - memory-mapped bands are read here
+        return {b: band_checksum(getattr(layer, b))
+                for b in ['offsets_az', 'offsets_rg', 'snr']}
+
+    if case['operation'] == 'identify_outliers':
+        layer = OffsetsLayer(l_paths[0])
+        mask = layer.identify_outliers(
+            metric=case['variant'],
+            threshold=BENCHMARK_THRESHOLDS[case['variant']],
+            window_az=window[0], window_rg=window[1], **f_param)
+        return {'n_outliers': mask['outliers_mask'].count}
+
+    if case['operation'] == 'fill_outliers_holes':
+        metric = param_bench['fill_metric']
+        outlier_kwd = {'metric': metric,
+                       'threshold': BENCHMARK_THRESHOLDS[metric],
+                       'window_az': window[0], 'window_rg': window[1],
+                       **f_param}
+        krn_size = (param_bench['kernel_size_az'],
+                    param_bench['kernel_size_rg'])
+        if case['size'] <= param_bench['tiled_above']:
+            f_layer = fill_outliers_holes(
+                *[OffsetsLayer(p) for p in l_paths], outlier_kwd,
+                fill_strategy=case['variant'], krn_size=krn_size, **f_param)
+            n_outliers = f_layer['binary_mask'].count
+            filled_layer = f_layer['filled_layer']
+        else:
+            f_layer = fill_outliers_holes_tiled(
+                *l_paths, out_path, outlier_kwd,
+                fill_strategy=case['variant'], krn_size=krn_size,
+                tile_size=(param_bench['tile_size_az'],
+                           param_bench['tile_size_rg']), **f_param)
+            n_outliers = f_layer['n_outliers']
+            filled_layer = OffsetsLayer(out_path, reader='memmap')
+        return {'n_outliers': n_outliers,
+                **{b: band_checksum(getattr(filled_layer, b))
+                   for b in ['offsets_az', 'offsets_rg']}}
+
+    raise ValueError(f"{case['operation']} invalid benchmark operation")
+
+
+def run_case(case: dict, l_paths: list, out_path: pathlib.Path,
+             param_bench: dict) -> dict:
+    """
+    Run a benchmark case and record its statistics - see StageProfiler.
+    :param case: benchmark case - dict
+    :param l_paths: synthetic layers paths - list
+    :param out_path: temporary output directory
+    :param param_bench: benchmark parameters - dict
+    :return: case record - dict
+    """
+    with StageProfiler() as profiler:
+        # - stages count the work of their own thread - the case totals
+        # - include all the worker threads
+        p_start = process_counters()
+        with profiler.stage('benchmark_case', case=case_id(case)):
+            result = run_operation(case, l_paths, out_path, param_bench)
+        p_end = process_counters()
+    shutil.rmtree(out_path, ignore_errors=True)
+    c_rec = [r for r in profiler.records if r['stage'] == 'benchmark_case']
+    stages = profiler.summary()
+    stages.pop('benchmark_case')
+    return {'case': case_id(case), **case,
+            **{k: c_rec[-1][k] for k in ['wall_time', 'peak_rss']},
+            **{k: None if p_start[k] is None else p_end[k] - p_start[k]
+               for k in ['cpu_time', 'bytes_read']},
+            'result': result, 'stages': stages}
+
+
+def _match_results(result: object, b_result: object, rtol: float) -> bool:
+    """Compare case results - checksums sums within rtol x abs_sum"""
+    if isinstance(result, dict) and 'abs_sum' in result:
+        return result['n_nan'] == b_result['n_nan'] \
+            and np.isclose(result['sum'], b_result['sum'], rtol=0.,
+                           atol=rtol * b_result['abs_sum']) \
+            and np.isclose(result['abs_sum'], b_result['abs_sum'], rtol=rtol)
+    if isinstance(result, dict):
+        return isinstance(b_result, dict) \
+            and result.keys() == b_result.keys() \
+            and all(_match_results(result[k], b_result[k], rtol)
+                    for k in result)
+    return result == b_result
+
+
+def compare_baseline(records: list, baseline: dict,
+                     time_tolerance: float = 0.25,
+                     rtol: float = 1e-5) -> list:
+    """
+    Compare the case records with a baseline - a status is added to each
+    record:
+    - new: the case is not in the baseline,
+    - mismatch: the results differ from the baseline ones,
+    - slower / faster: wall time outside the baseline tolerance,
+    - more_memory: peak memory above the baseline tolerance,
+    - ok.
+    :param records: case records - list of dict
+    :param baseline: case identifier -> baseline record - dict
+    :param time_tolerance: relative wall time and peak memory tolerance
+    :param rtol: relative tolerance of the band checksums
+    :return: case records with status and speedup - list of dict
+    """
+    for rec in records:
+        b_rec = baseline.get(rec['case'])
+        if b_rec is None:
+            rec.update({'status': 'new', 'speedup': None})
+            continue
+        rec['speedup'] = b_rec['wall_time'] / max(rec['wall_time'], 1e-9)
+        if not _match_results(rec['result'], b_rec['result'], rtol):
+            rec['status'] = 'mismatch'
+        elif rec['wall_time'] > b_rec['wall_time'] * (1 + time_tolerance):
+            rec['status'] = 'slower'
+        elif rec['peak_rss'] and b_rec['peak_rss'] \
+                and rec['peak_rss'] > b_rec['peak_rss'] * (1 + time_tolerance):
+            rec['status'] = 'more_memory'
+        elif rec['wall_time'] < b_rec['wall_time'] * (1 - time_tolerance):
+            rec['status'] = 'faster'
+        else:
+            rec['status'] = 'ok'
+    return records
+
+
+def run_benchmark(cases: list, data_dir: pathlib.Path,
+                  param_bench: dict = None, repeat: int = 1,
+                  seed: int = 0) -> list:
+    """
+    Generate the synthetic layers and run the benchmark cases - each run
+    in a fresh process.
+    :param cases: benchmark cases - see list_cases
+    :param data_dir: synthetic layers directory
+    :param param_bench: benchmark parameters - see BENCHMARK_DEFAULTS
+    :param repeat: number of runs per case - the fastest is kept
+    :param seed: synthetic layers random seed
+    :return: case records - list of dict
+    """
+    param_bench = {**BENCHMARK_DEFAULTS, 'tiled_above': 4096,
+                   **(param_bench or {})}
+    records = []
+    for case in cases:
+        pair_path = data_dir.joinpath(f"pair_{case['size']}_"
+                                      f"{case['format']}")
+        l_paths = write_synthetic_pair(pair_path,
+                                       (case['size'], case['size']),
+                                       seed=seed, out_format=case['format'])
+        runs = []
+        for _ in range(max(repeat, 1)):
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                runs.append(pool.submit(run_case, case, l_paths,
+                                        data_dir.joinpath('tmp_output'),
+                                        param_bench).result())
+        c_rec = min(runs, key=lambda r: r['wall_time'])
+        print(f"# - {c_rec['case']}: {c_rec['wall_time']:.3f} s - peak rss: "
+              f"{(c_rec['peak_rss'] or 0) / 1024 ** 2:.1f} MB")
+        records.append(c_rec)
+    return records
+
+
+def save_report(records: list, out_dir: pathlib.Path,
+                param_bench: dict) -> None:
+    """
+    Save the benchmark report - JSON (full records) and CSV (summary).
+    :param records: case records - list of dict
+    :param out_dir: report directory
+    :param param_bench: benchmark parameters - dict
+    :return: None
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    env = {'python': platform.python_version(), 'numpy': np.__version__,
+           'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+           'date': datetime.datetime.now().isoformat()}
+    with open(out_dir.joinpath('benchmark_report.json'), 'w',
+              encoding='utf8') as j_fid:
+        json.dump({'environment': env, 'parameters': param_bench,
+                   'records': records}, j_fid, indent=2)
+    with open(out_dir.joinpath('benchmark_report.csv'), 'w',
+              encoding='utf8', newline='') as c_fid:
+        writer = csv.writer(c_fid)
+        writer.writerow(['case', 'wall_time', 'cpu_time', 'peak_rss',
+                         'bytes_read', 'speedup', 'status'])
+        for rec in records:
+            writer.writerow([rec['case'], rec['wall_time'], rec['cpu_time'],
+                             rec['peak_rss'], rec['bytes_read'],
+                             rec.get('speedup'), rec.get('status')])
+
+
+def main() -> None:
+    """
+    Main: Offsets Blending - Benchmark Suite
+    """
+    # - Read the system arguments listed after the program
+    parser = argparse.ArgumentParser(
+        description="""Offsets Blending - Benchmark Suite on Synthetic
+            AMPCOR Offsets Layers.
+            """
+    )
+    parser.add_argument('--parameters', type=str, default=None,
+                        help='Processing Parameters File [yaml - format] - '
+                             'overrides the benchmark defaults.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000],
+                        help='Synthetic layers sizes [pixels per side].')
+    parser.add_argument('--formats', type=str, nargs='+', default=['ENVI'],
+                        choices=['ENVI', 'GTiff'],
+                        help='Synthetic layers raster formats.')
+    parser.add_argument('--readers', type=str, nargs='+',
+                        default=['gdal', 'memmap'],
+                        choices=['gdal', 'memmap'],
+                        help='OffsetsLayer readers.')
+    parser.add_argument('--metrics', type=str, nargs='+',
+                        default=list(BENCHMARK_THRESHOLDS),
+                        choices=list(BENCHMARK_THRESHOLDS),
+                        help='Outlier metrics.')
+    parser.add_argument('--strategies', type=str, nargs='+',
+                        default=['intermediate', 'median', 'weighted'],
+                        choices=['intermediate', 'median', 'weighted'],
+                        help='Outliers filling strategies.')
+    parser.add_argument('--data_dir', type=str, default='benchmark_data',
+                        help='Synthetic layers directory.')
+    parser.add_argument('--out_dir', type=str, default='.',
+                        help='Benchmark report directory.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of runs per case - the fastest is '
+                             'kept.')
+    parser.add_argument('--tiled_above', type=int, default=4096,
+                        help='Use the tiled engine above this size '
+                             '[pixels].')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Synthetic layers random seed.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Baseline to compare with [JSON].')
+    parser.add_argument('--save_baseline', type=str, default=None,
+                        help='Save the benchmark results as baseline '
+                             '[JSON].')
+    parser.add_argument('--time_tolerance', type=float, default=0.25,
+                        help='Relative wall time / peak memory tolerance.')
+    args = parser.parse_args()
+
+    param_bench = {**BENCHMARK_DEFAULTS, 'tiled_above': args.tiled_above}
+    if args.parameters is not None:
+        # - Import parameters with PyYaml
+        with open(args.parameters, 'r', encoding='utf8') as stream:
+            param_proc = yaml.safe_load(stream)
+        param_bench.update({k: param_proc[k] for k in BENCHMARK_DEFAULTS
+                            if k in param_proc})
+
+    cases = list_cases(args.sizes, args.formats, args.readers, args.metrics,
+                       args.strategies)
+    print(f'# - Number of benchmark cases: {len(cases)}')
+    records = run_benchmark(cases, pathlib.Path(args.data_dir),
+                            param_bench=param_bench, repeat=args.repeat,
+                            seed=args.seed)
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf8') as b_fid:
+            baseline = json.load(b_fid)
+        compare_baseline(records, baseline,
+                         time_tolerance=args.time_tolerance)
+        for rec in records:
+            speedup = f"{rec['speedup']:.2f}x" if rec['speedup'] else '-'
+            print(f"# - {rec['case']}: {rec['status']} - speedup: "
+                  f"{speedup}")
+    save_report(records, pathlib.Path(args.out_dir), param_bench)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w', encoding='utf8') as b_fid:
+            json.dump({r['case']: {k: r[k] for k in
+                                   ['wall_time', 'peak_rss', 'result']}
+                       for r in records}, b_fid, indent=2)
+        print(f'# - Baseline saved: {args.save_baseline}')
+    n_regressions = sum(r.get('status') in REGRESSIONS for r in records)
+    if n_regressions:
+        print(f'# - Regressions found: {n_regressions}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    start_time = datetime.datetime.now()
+    main()
+    end_time = datetime.datetime.now()
+    print(f'# - Computation Time: {end_time - start_time}')
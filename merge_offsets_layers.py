@@ -22,24 +22,82 @@ import argparse
 import pathlib
 import datetime
 import copy
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import yaml
-from scipy import ndimage
-import matplotlib.pyplot as plt
-from offsets_layer import OffsetsLayer
+import numpy as np
+from osgeo import gdal
+from offsets_layer import OffsetsLayer, LAYER_FILES, METRIC_BANDS
 from utils.set_path import set_path_to_data_dir
-from utils.mpl_utils import add_colorbar
-# - change matplotlib default setting
-plt.rc('font', family='monospace')
-plt.rc('font', weight='bold')
-plt.style.use('seaborn-deep')
+from utils.preview import preview_factor, block_mean
+from utils.median_filter import median_filter_bands_at
+from utils.outliers_mask import OutliersMask, as_index
+from utils.raster_io import RasterWriter, writer_options, RASTER_FORMATS
+from utils.result_cache import ResultCache
+from utils.layer_store import LayerStore
+from utils.tiling import tile_windows
+from utils.profiling import StageProfiler, profiled
 
+# - Bands filled by each outliers filling strategy
+FILL_BANDS = {'intermediate': ['offsets_az', 'offsets_rg',
+                               'g_offsets_az', 'g_offsets_rg'],
+              'median': ['offsets_az', 'offsets_rg',
+                         'g_offsets_az', 'g_offsets_rg'],
+              'weighted': ['offsets_az', 'offsets_rg']}
+# - Bands read by each outliers filling strategy:
+# - layer (1: intermediate, 2: low resolution) -> band names
+FILL_SOURCES = {'intermediate': {1: FILL_BANDS['intermediate']},
+                'median': {1: FILL_BANDS['median']},
+                'weighted': {1: ['offsets_az', 'offsets_rg',
+                                 'cov_az', 'cov_rg'],
+                             2: ['offsets_az', 'offsets_rg',
+                                 'cov_az', 'cov_rg']}}
 
+
+def weighted_average(values_1: np.ndarray, weights_1: np.ndarray,
+                     values_2: np.ndarray, weights_2: np.ndarray,
+                     index=None, out: np.ndarray = None) -> np.ndarray:
+    """
+    Compute the weighted average of two arrays:
+    (values_1 * weights_1 + values_2 * weights_2) / (weights_1 + weights_2)
+    :param values_1: first array values
+    :param weights_1: first array weights
+    :param values_2: second array values
+    :param weights_2: second array weights
+    :param index: if not None, the average is computed only at the selected
+        elements (np.where tuple or boolean mask) - returns a 1D array
+    :param out: output array - dense computation only (index is None).
+        Must not share memory with the inputs.
+    :return: weighted average - np.ndarray
+    """
+    if index is not None:
+        # - gather the selected elements only
+        values_1, weights_1 = values_1[index], weights_1[index]
+        values_2, weights_2 = values_2[index], weights_2[index]
+        out = None
+    if out is None:
+        out = np.empty(np.broadcast(values_1, weights_1).shape,
+                       dtype=np.result_type(values_1, weights_1,
+                                            values_2, weights_2))
+    # - single scratch buffer - no other full-size temporary
+    scratch = np.multiply(values_2, weights_2)
+    np.multiply(values_1, weights_1, out=out)
+    np.add(out, scratch, out=out)
+    np.add(weights_1, weights_2, out=scratch)
+    np.divide(out, scratch, out=out)
+    return out
+
+
+@profiled('fill_outliers_holes')
 def fill_outliers_holes(hr_offsets: OffsetsLayer,
                         ir_offsets: OffsetsLayer,
                         lr_offsets: OffsetsLayer,
                         outlier_kwd: dict,
                         fill_strategy: str = 'intermediate',
-                        krn_size: tuple = (9, 9)
+                        krn_size: tuple = (9, 9),
+                        median_engine: str = 'scipy',
+                        min_valid: int = 1,
+                        n_workers: int = 1,
+                        cache: ResultCache = None
                         ) -> dict:
     """
     Merge AMPCOR Offsets Layers using the selected strategy
@@ -49,6 +107,16 @@ def fill_outliers_holes(hr_offsets: OffsetsLayer,
     :param outlier_kwd: outlier determination strategy + keywords
     :param fill_strategy: str - outliers filling strategy
     :param krn_size: tuple - median filet kernel size
+    :param median_engine: str - median filter engine - see
+        utils.median_filter.MEDIAN_ENGINES
+    :param min_valid: int - minimum number of valid (not NaN) samples inside
+        the median filter kernel - NaN samples are ignored
+    :param n_workers: int - number of threads used to filter the layer bands
+        concurrently
+    :param cache: ResultCache - reuse median images, outlier masks and
+        filled bands computed by previous runs on the same input layers.
+        Median fill values are evaluated at the outliers locations only
+        and are not cached
     :return:dictionary containing the high-resolution layer with outliers
             values replaced using the selected strategy + outliers mask
     """
@@ -58,26 +126,63 @@ def fill_outliers_holes(hr_offsets: OffsetsLayer,
                          f'{fill_strategy}')
     # - Extract Outlier Mask From Reference Layer
     # - Compute Outliers Mask
+    if cache is not None:
+        outlier_kwd = {**outlier_kwd, 'cache': cache}
     outliers_srch = hr_offsets.identify_outliers(**outlier_kwd)
-    outliers_mask = outliers_srch['outliers_mask']
     binary_mask = outliers_srch['binary_mask']
+    # - index tuple or boolean mask - whichever is more compact
+    outliers_mask = as_index(outliers_srch['outliers_mask'])
+
+    # - Filled bands computed by a previous run
+    f_bands = FILL_BANDS[fill_strategy]
+    f_key = None
+    if cache is not None:
+        # - Dependencies: reference bands used to detect the outliers and
+        # - filled, bands read by the selected strategy
+        hr_bands = METRIC_BANDS.get(outlier_kwd.get('metric', 'snr'), []) \
+            + f_bands
+        l_fp = [hr_offsets.fingerprint(*hr_bands,
+                                       content_hash=cache.content_hash)] \
+            + [layer.fingerprint(*FILL_SOURCES[fill_strategy].get(n, []),
+                                 content_hash=cache.content_hash)
+               for n, layer in [(1, ir_offsets), (2, lr_offsets)]]
+        if None not in l_fp:
+            f_param = {k: v for k, v in outlier_kwd.items()
+                       if k not in ['n_workers', 'cache']}
+            m_param = {'krn_size': krn_size, 'median_engine': median_engine,
+                       'min_valid': min_valid} \
+                if fill_strategy == 'median' else {}
+            f_key = cache.key('filled_bands', l_fp, outlier_kwd=f_param,
+                              fill_strategy=fill_strategy, **m_param)
+            f_values = cache.get(f_key)
+            if f_values is not None:
+                for b_name, b_values in zip(f_bands, f_values):
+                    hr_offsets._set_band(b_name, b_values, shared=True)
+                return {'filled_layer': hr_offsets,
+                        'outliers_mask': outliers_srch['outliers_mask'],
+                        'binary_mask': binary_mask}
 
     if fill_strategy in ['intermediate', 'median']:
+        # - Copy the bands shared with other layers before filling them
+        hr_offsets.writable('offsets_az', 'offsets_rg',
+                            'g_offsets_az', 'g_offsets_rg')
         if fill_strategy == 'median':
-            # - Apply 9x9 Median Filter to Intermediate Resolution
-            median_az = ndimage.median_filter(ir_offsets.offsets_az,
-                                              krn_size)
-            median_rg = ndimage.median_filter(ir_offsets.offsets_rg,
-                                              krn_size)
-            g_median_az = ndimage.median_filter(ir_offsets.g_offsets_az,
-                                                krn_size)
-            g_median_rg = ndimage.median_filter(ir_offsets.g_offsets_rg,
-                                                krn_size)
+            # - Median of the Intermediate Resolution layer - evaluated
+            # - at the outliers locations only
+            median_az, median_rg, g_median_az, g_median_rg \
+                = median_filter_bands_at([ir_offsets.offsets_az,
+                                          ir_offsets.offsets_rg,
+                                          ir_offsets.g_offsets_az,
+                                          ir_offsets.g_offsets_rg],
+                                         krn_size, outliers_mask,
+                                         n_workers=n_workers,
+                                         engine=median_engine,
+                                         min_valid=min_valid)
             # - Dense offsets
-            hr_offsets.offsets_rg[outliers_mask] = median_rg[outliers_mask]
-            hr_offsets.offsets_az[outliers_mask] = median_az[outliers_mask]
-            hr_offsets.g_offsets_rg[outliers_mask] = g_median_rg[outliers_mask]
-            hr_offsets.g_offsets_az[outliers_mask] = g_median_az[outliers_mask]
+            hr_offsets.offsets_rg[outliers_mask] = median_rg
+            hr_offsets.offsets_az[outliers_mask] = median_az
+            hr_offsets.g_offsets_rg[outliers_mask] = g_median_rg
+            hr_offsets.g_offsets_az[outliers_mask] = g_median_az
         else:
             # - Fill data gaps in the High-Resolution Layer using data values
             # - from the Intermediate-Resolution layer.
@@ -96,22 +201,266 @@ def fill_outliers_holes(hr_offsets: OffsetsLayer,
         # - Keep the Input layer original values fo all the other attributes.
     else:
         # - Compute Weighted Average of Intermediate and Low-Resolution Layers
-        w_ave_rg = (((ir_offsets.offsets_rg * ir_offsets.cov_rg)
-                     + (lr_offsets.offsets_rg * lr_offsets.cov_rg))
-                    / (ir_offsets.cov_rg + lr_offsets.cov_rg))
-        w_ave_az = (((ir_offsets.offsets_az * ir_offsets.cov_az)
-                     + (lr_offsets.offsets_az * lr_offsets.cov_az))
-                    / (ir_offsets.cov_az + lr_offsets.cov_az))
+        # - at the outliers locations only.
+        hr_offsets.writable('offsets_az', 'offsets_rg')
         # - Dense offsets
-        hr_offsets.offsets_rg[outliers_mask] = w_ave_rg[outliers_mask]
-        hr_offsets.offsets_az[outliers_mask] = w_ave_az[outliers_mask]
+        hr_offsets.offsets_rg[outliers_mask] \
+            = weighted_average(ir_offsets.offsets_rg, ir_offsets.cov_rg,
+                               lr_offsets.offsets_rg, lr_offsets.cov_rg,
+                               index=outliers_mask)
+        hr_offsets.offsets_az[outliers_mask] \
+            = weighted_average(ir_offsets.offsets_az, ir_offsets.cov_az,
+                               lr_offsets.offsets_az, lr_offsets.cov_az,
+                               index=outliers_mask)
 
         # - Keep the Input layer original values fo all the other attributes.
 
-    return{'filled_layer': hr_offsets, 'outliers_mask': outliers_mask,
+    if f_key is not None:
+        cache.put(f_key, np.stack([getattr(hr_offsets, b) for b in f_bands]))
+
+    return{'filled_layer': hr_offsets,
+           'outliers_mask': outliers_srch['outliers_mask'],
            'binary_mask': binary_mask}
 
 
+def tile_halo(outlier_kwd: dict, fill_strategy: str = 'intermediate',
+              krn_size: tuple = (9, 9)) -> list:
+    """
+    Tile halo of the tiled engine - half size of the largest filter window,
+    so that tiled results match the ones computed on the entire layers.
+    :param outlier_kwd: outlier determination strategy + keywords
+    :param fill_strategy: str - outliers filling strategy
+    :param krn_size: tuple - median filet kernel size
+    :return: halo (rows, columns) - list
+    """
+    halo = [0, 0]
+    if fill_strategy == 'median':
+        halo = [krn_size[0] // 2, krn_size[1] // 2]
+    metric = outlier_kwd.get('metric', 'snr')
+    if metric in ['median_filter', 'mad', 'sigma_clip']:
+        # - the local MAD is the median of residuals from the local
+        # - median - its support is twice the window half-size
+        n_win = 2 if metric == 'mad' else 1
+        halo = [max(halo[0], n_win * (outlier_kwd.get('window_az', 50) // 2)),
+                max(halo[1], n_win * (outlier_kwd.get('window_rg', 50) // 2))]
+    return halo
+
+
+@profiled('fill_outliers_holes_tiled')
+def fill_outliers_holes_tiled(hr_path: pathlib.Path,
+                              ir_path: pathlib.Path,
+                              lr_path: pathlib.Path,
+                              out_path: pathlib.Path,
+                              outlier_kwd: dict,
+                              fill_strategy: str = 'intermediate',
+                              krn_size: tuple = (9, 9),
+                              tile_size: tuple = (1024, 1024),
+                              median_engine: str = 'scipy',
+                              min_valid: int = 1,
+                              n_workers: int = 1,
+                              reader: str = 'gdal',
+                              out_format: str = 'ENVI',
+                              compress: str = 'DEFLATE',
+                              cache: ResultCache = None,
+                              store: LayerStore = None,
+                              quality_dtype: str = 'float32'
+                              ) -> dict:
+    """
+    Merge AMPCOR Offsets Layers using the selected strategy - tile by tile.
+    Each tile is read with a halo as large as the filters' half-window so
+    that results match fill_outliers_holes computed on the entire layers.
+    Filled tiles are written to an output layer with the same structure
+    as the input ones + an outliers mask raster.
+    :param hr_path: high-resolution offsets layer path [Reference Layer]
+    :param ir_path: intermediate-resolution offsets layer path
+    :param lr_path: low-resolution offsets layer path
+    :param out_path: output layer path
+    :param outlier_kwd: outlier determination strategy + keywords
+    :param fill_strategy: str - outliers filling strategy
+    :param krn_size: tuple - median filet kernel size
+    :param tile_size: tuple - tile size (azimuth, range)
+    :param median_engine: str - median filter engine - the 'histogram'
+        engine quantizes values tile by tile, so its results can differ
+        slightly from the in-memory ones
+    :param min_valid: int - minimum number of valid (not NaN) samples inside
+        the median filter kernel
+    :param n_workers: int - number of tiles processed concurrently. At most
+        2 x n_workers tiles are held in memory at once
+    :param reader: str - input layers reader [gdal, memmap]
+    :param out_format: str - output format [ENVI, GTiff, COG] - GTiff and
+        COG outputs are tiled, compressed and carry overviews
+    :param compress: str - GTiff/COG compression algorithm
+    :param cache: ResultCache - reuse the outlier masks and filled bands of
+        each tile computed by previous runs: only the tiles and stages
+        whose inputs changed are recomputed. With cache.content_hash the
+        tiles inputs are fingerprinted by their values, so only the tiles
+        whose values changed are recomputed when a layer is updated
+    :param store: LayerStore - process-shared band store - the input
+        layers are loaded once per node and tiles are views of the
+        shared bands
+    :param quality_dtype: str - storage data type of the SNR and
+        covariance bands [float32, float16] - see OffsetsLayer
+    :return: dictionary containing the output layer path + number of
+            outliers found
+    """
+    if fill_strategy not in ['intermediate', 'median', 'weighted']:
+        raise ValueError(f'# - Invalid merging strategy selected: '
+                         f'{fill_strategy}')
+    halo = tile_halo(outlier_kwd, fill_strategy, krn_size)
+    shape = OffsetsLayer(hr_path, lazy=True, quality_dtype=quality_dtype).size
+    os.makedirs(out_path, exist_ok=True)
+    f_ext = RASTER_FORMATS[out_format][1]
+    w_kwd = writer_options(out_format, gdal.GDT_Float32, compress=compress)
+    if out_format != 'ENVI':
+        w_kwd['nodata'] = np.nan
+    writers = {f_name: RasterWriter(out_path.joinpath(f_name + f_ext), shape,
+                                    len(b_names),
+                                    ref_path=hr_path.joinpath(f_name),
+                                    **w_kwd)
+               for f_name, b_names in LAYER_FILES.items()}
+    writers['outliers_mask'] \
+        = RasterWriter(out_path.joinpath('outliers_mask' + f_ext), shape, 1,
+                       data_type=gdal.GDT_Byte,
+                       **writer_options(out_format, gdal.GDT_Byte,
+                                        compress=compress))
+
+    def fill_tile(tile):
+        # - Read only the bands needed by the selected strategy
+        t_layers = [OffsetsLayer(l_path, lazy=True, window=tile.read_window,
+                                 reader=reader, store=store,
+                                 quality_dtype=quality_dtype)
+                    for l_path in (hr_path, ir_path, lr_path)]
+        return tile, fill_outliers_holes(*t_layers, outlier_kwd,
+                                         fill_strategy=fill_strategy,
+                                         krn_size=krn_size,
+                                         median_engine=median_engine,
+                                         min_valid=min_valid, cache=cache)
+
+    def write_tile(tile, f_layer) -> int:
+        # - GDAL datasets are written from the calling thread only
+        filled_layer = f_layer['filled_layer']
+        for f_name, b_names in LAYER_FILES.items():
+            writers[f_name].write([getattr(filled_layer, b)[tile.inner]
+                                   for b in b_names], *tile.write_window[:2])
+        t_mask = np.asarray(f_layer['binary_mask'][tile.inner],
+                            dtype=np.uint8)
+        writers['outliers_mask'].write([t_mask], *tile.write_window[:2])
+        return int(t_mask.sum())
+
+    n_outliers = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as pool:
+            pending = set()
+            for tile in tile_windows(shape, tile_size, halo):
+                pending.add(pool.submit(fill_tile, tile))
+                if len(pending) >= 2 * max(n_workers, 1):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        n_outliers += write_tile(*future.result())
+            for future in wait(pending).done:
+                n_outliers += write_tile(*future.result())
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return {'out_path': out_path, 'n_outliers': n_outliers}
+
+
+@profiled('blend_offsets_layers')
+def blend_offsets_layers(layers: list,
+                         outlier_kwd: dict,
+                         fill_strategy: str = 'intermediate',
+                         krn_size: tuple = (9, 9),
+                         median_engine: str = 'scipy',
+                         min_valid: int = 1,
+                         n_workers: int = 1,
+                         reader: str = 'gdal',
+                         quality_dtype: str = 'float32'
+                         ) -> dict:
+    """
+    Merge N AMPCOR Offsets Layers - cascade from the finest to the coarsest.
+    Outliers are identified in the reference (first) layer. The remaining
+    holes are filled with the valid (not NaN) values of the next layer in
+    the list; holes still unfilled move on to the following layer.
+    Layers given as paths are read lazily, only over the bounding box of
+    the remaining holes (+ median filter halo), and layers after the last
+    needed one are never read.
+    :param layers: offsets layers ordered from the highest to the lowest
+        resolution - list of OffsetsLayer or pathlib.Path
+    :param outlier_kwd: outlier determination strategy + keywords
+    :param fill_strategy: str - outliers filling strategy
+        [intermediate, median]
+    :param krn_size: tuple - median filet kernel size
+    :param median_engine: str - median filter engine - see
+        utils.median_filter.MEDIAN_ENGINES
+    :param min_valid: int - minimum number of valid (not NaN) samples inside
+        the median filter kernel
+    :param n_workers: int - number of threads used to filter the layer bands
+        concurrently
+    :param reader: str - reader of layers given as paths [gdal, memmap]
+    :param quality_dtype: str - storage data type of the SNR and
+        covariance bands of layers given as paths [float32, float16]
+    :return: dictionary containing the reference layer with outliers values
+        replaced + outliers mask + mask of the holes left unfilled +
+        number of pixels filled by each layer
+    """
+    if fill_strategy not in ['intermediate', 'median']:
+        raise ValueError(f'# - Invalid merging strategy selected: '
+                         f'{fill_strategy}')
+    if len(layers) < 2:
+        raise ValueError('# - At least two offsets layers are required.')
+    ref_layer = layers[0]
+    if not isinstance(ref_layer, OffsetsLayer):
+        ref_layer = OffsetsLayer(ref_layer, lazy=True, reader=reader,
+                                 quality_dtype=quality_dtype)
+    outliers_srch = ref_layer.identify_outliers(**outlier_kwd)
+    holes = np.array(outliers_srch['outliers_mask'], dtype=bool)
+    f_bands = ['offsets_az', 'offsets_rg', 'g_offsets_az', 'g_offsets_rg']
+    ref_layer.writable(*f_bands)
+    halo = [k // 2 for k in krn_size] if fill_strategy == 'median' else [0, 0]
+
+    n_filled = []
+    for c_layer in layers[1:]:
+        if not holes.any():
+            break
+        rows, cols = np.nonzero(holes)
+        if isinstance(c_layer, OffsetsLayer):
+            row_0, col_0 = 0, 0
+        else:
+            # - Read the bounding box of the remaining holes only
+            row_0 = max(rows.min() - halo[0], 0)
+            col_0 = max(cols.min() - halo[1], 0)
+            row_1 = min(rows.max() + halo[0] + 1, holes.shape[0])
+            col_1 = min(cols.max() + halo[1] + 1, holes.shape[1])
+            c_layer = OffsetsLayer(c_layer, lazy=True, reader=reader,
+                                   window=(col_0, row_0, col_1 - col_0,
+                                           row_1 - row_0),
+                                   quality_dtype=quality_dtype)
+        c_bands = [getattr(c_layer, b) for b in f_bands]
+        if fill_strategy == 'median':
+            # - median evaluated at the holes locations only
+            c_values = median_filter_bands_at(c_bands, krn_size,
+                                              (rows - row_0, cols - col_0),
+                                              n_workers=n_workers,
+                                              engine=median_engine,
+                                              min_valid=min_valid)
+        else:
+            c_values = [c_band[rows - row_0, cols - col_0]
+                        for c_band in c_bands]
+        # - Fill only the holes where all the values are valid
+        valid = np.all([np.isfinite(c_val) for c_val in c_values], axis=0)
+        for b_name, c_val in zip(f_bands, c_values):
+            getattr(ref_layer, b_name)[rows[valid], cols[valid]] \
+                = c_val[valid]
+        holes[rows[valid], cols[valid]] = False
+        n_filled.append(int(valid.sum()))
+
+    return {'filled_layer': ref_layer,
+            'outliers_mask': outliers_srch['outliers_mask'],
+            'binary_mask': outliers_srch['binary_mask'],
+            'holes_mask': OutliersMask(holes), 'n_filled': n_filled}
+
+
 def main():
     """
     Main: Offsets Blending - Preliminary Implementation
@@ -140,21 +489,57 @@ def main():
     fill_strategy = param_proc['fill_strategy']
     krn_size_az = param_proc['kernel_size_az']
     krn_size_rg = param_proc['kernel_size_rg']
+    lazy = param_proc.get('lazy_loading', False)
+    median_engine = param_proc.get('median_engine', 'scipy')
+    min_valid = param_proc.get('min_valid', 1)
+    n_workers = param_proc.get('n_workers', 1)
+    reader = param_proc.get('reader', 'gdal')
+    quality_dtype = param_proc.get('quality_dtype', 'float32')
+    out_dir = param_proc.get('out_dir')
+    out_format = param_proc.get('out_format', 'COG')
+    compress = param_proc.get('compress', 'DEFLATE')
+    cache_dir = param_proc.get('cache_dir')
+    cache = ResultCache(cache_dir, max_size=param_proc.get('cache_size', 2.),
+                        content_hash=param_proc.get('cache_content_hash',
+                                                    False))\
+        if cache_dir is not None else None
+    # - Bands shared with the other processes running on the node
+    store_dir = param_proc.get('layer_store_dir')
+    store = LayerStore(store_dir) if store_dir is not None else None
+    qa_dir = pathlib.Path(param_proc.get('qa_dir', 'qa_figures'))
+    # - Per-stage timing and memory instrumentation
+    profiler = StageProfiler(log=param_proc.get('profiling_log', False))\
+        .enable() if param_proc.get('profiling', False) else None
 
     # - set path to project data directory
     data_path = pathlib.Path(set_path_to_data_dir())
+    # - QA figures are saved to qa_dir and rendered in the background
+    # - while processing continues - matplotlib is imported only here
+    from utils.qa_plots import FigureExporter, plot_outliers_mask
+    os.makedirs(qa_dir, exist_ok=True)
+    exporter = FigureExporter()
 
     # - import sample Offset Layer
-    layer_1 = OffsetsLayer(data_path.joinpath('layer1'))
-    layer_2 = OffsetsLayer(data_path.joinpath('layer2'))
-    layer_3 = OffsetsLayer(data_path.joinpath('layer3'))
+    layer_1 = OffsetsLayer(data_path.joinpath('layer1'), lazy=lazy,
+                           reader=reader, quality_dtype=quality_dtype,
+                           store=store)
+    layer_2 = OffsetsLayer(data_path.joinpath('layer2'), lazy=lazy,
+                           reader=reader, quality_dtype=quality_dtype,
+                           store=store)
+    layer_3 = OffsetsLayer(data_path.joinpath('layer3'), lazy=lazy,
+                           reader=reader, quality_dtype=quality_dtype,
+                           store=store)
     # - Show Offsets after Outlier Removal
-    layer_1.show_offsets(cov_range=(0, 1), offsets_range=(-20, 20),
-                         title='Layer 1 - High Resolution Offsets')
+    layer_1.show_offsets(qa_dir.joinpath('layer1_offsets.png'),
+                         cov_range=(0, 1), offsets_range=(-20, 20),
+                         title='Layer 1 - High Resolution Offsets',
+                         exporter=exporter)
 
     # - Outlier determination parameters
     outlier_param = {'metric': metric, 'threshold': threshold,
-                     'window_az': window_az, 'window_rg': window_rg}
+                     'window_az': window_az, 'window_rg': window_rg,
+                     'median_engine': median_engine,
+                     'min_valid': min_valid, 'n_workers': n_workers}
 
     # - Generate a shallow copy of the high-resolution layer
     layer_1_c = copy.copy(layer_1)
@@ -162,22 +547,49 @@ def main():
     f_layer = fill_outliers_holes(layer_1_c, layer_2,
                                   layer_3, outlier_param,
                                   fill_strategy=fill_strategy,
-                                  krn_size=krn_size)
+                                  krn_size=krn_size,
+                                  median_engine=median_engine,
+                                  min_valid=min_valid,
+                                  n_workers=n_workers,
+                                  cache=cache)
     filled_layer = f_layer['filled_layer']
+    if out_dir is not None:
+        # - Save the blended layer
+        for f_path in filled_layer.write(pathlib.Path(out_dir),
+                                         out_format=out_format,
+                                         compress=compress):
+            print(f'# - Blended layer saved: {f_path}')
 
-    # - Show Outliers Mask
-    fig_size = (7, 5)
-    fig = plt.figure(figsize=fig_size)
-    ax_b = fig.add_subplot(111)
-    ax_b.set_title('Outlier Mask', weight='bold', loc='left', size=20)
-    im_b = ax_b.pcolormesh(f_layer['outliers_mask'].T,
-                           cmap=plt.get_cmap('Greys'), vmin=0, vmax=1)
-    add_colorbar(ax_b, im_b)
-    plt.show()
-    plt.close()
+    # - Show Outliers Mask - fraction of outliers per display pixel
+    o_mask = f_layer['binary_mask']
+    exporter.submit(plot_outliers_mask,
+                    block_mean(o_mask.to_bool(),
+                               preview_factor(o_mask.shape)),
+                    o_mask.shape, qa_dir.joinpath('outliers_mask.png'),
+                    title='Outlier Mask')
 
     # - Show Offsets after Outlier Removal + Filling
-    filled_layer.show_offsets(cov_range=(0, 1), offsets_range=(-20, 20))
+    filled_layer.show_offsets(qa_dir.joinpath('filled_layer_offsets.png'),
+                              cov_range=(0, 1), offsets_range=(-20, 20),
+                              exporter=exporter)
+    exporter.close()
+    print(f'# - QA figures saved to: {qa_dir}')
+    if cache is not None:
+        # - Stages reused from previous runs
+        for operator, o_stats in cache.stats.items():
+            print(f"# - {operator}: reused {o_stats['hits']} - "
+                  f"recomputed {o_stats['misses']}")
+    if store is not None:
+        s_stats = store.stats
+        print(f"# - Layer store: loaded {s_stats['loaded']} bands - "
+              f"attached {s_stats['attached']}")
+        store.close()
+    if profiler is not None:
+        profiler.disable()
+        report = param_proc.get('profiling_report', 'profiling_report')
+        profiler.to_json(f'{report}.json')
+        profiler.to_csv(f'{report}.csv')
+        print(f'# - Profiling report saved to: {report}.json/.csv')
 
 
 if __name__ == '__main__':
@@ -5,15 +5,70 @@ OffsetsLayer - Utility class to load AMPCOR Offsets Layers.
 import os
 import pathlib
 import copy
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import gdal
 import numpy as np
-from scipy import ndimage
-import matplotlib.pyplot as plt
-from utils.mpl_utils import add_colorbar
-# - change matplotlib default setting
-plt.rc('font', family='monospace')
-plt.rc('font', weight='bold')
-plt.style.use('seaborn-deep')
+from utils.median_filter import median_filter_bands, mean_std_filter, \
+    MAD_SCALE
+from utils.outliers_mask import OutliersMask
+from utils.raster_io import envi_memmap, read_raster_bands, RasterWriter, \
+    writer_options, RASTER_FORMATS
+from utils.envi_header import EnviHeader, read_envi_header
+from utils.result_cache import ResultCache, file_fingerprint
+from utils.layer_store import LayerStore
+from utils.preview import preview_factor, block_mean, blocked_histogram
+from utils.profiling import profiled, stage
+
+# - Offsets Layer bands: band name -> (raster file name, band number)
+LAYER_BANDS = {
+    'offsets_az': ('dense_offsets', 1),     # - Dense Offsets Azimuth
+    'offsets_rg': ('dense_offsets', 2),     # - Dense Offsets Range
+    'g_offsets_az': ('gross_offsets', 1),   # - Gross Offsets Azimuth
+    'g_offsets_rg': ('gross_offsets', 2),   # - Gross Offsets Range
+    'snr': ('snr', 1),                      # - SNR
+    'cov_az': ('covariance', 1),            # - Covariance Azimuth
+    'cov_rg': ('covariance', 2),            # - Covariance Range
+}
+# - Compute data type of the layer bands
+BAND_DTYPE = np.float32
+# - Quality bands - optionally stored in reduced precision
+QUALITY_BANDS = ('snr', 'cov_az', 'cov_rg')
+QUALITY_DTYPES = {'float32': np.float32, 'float16': np.float16}
+# - Maximum number of raster files read concurrently
+IO_WORKERS = 4
+# - Bands read by each outlier metric
+METRIC_BANDS = {'snr': ['snr'],
+                'median_filter': ['offsets_az', 'offsets_rg'],
+                'mad': ['offsets_az', 'offsets_rg'],
+                'sigma_clip': ['offsets_az', 'offsets_rg'],
+                'covariance': ['cov_az', 'cov_rg']}
+# - Offsets Layer files: raster file name -> band names
+LAYER_FILES = {f_name: [b for b, (f, _) in LAYER_BANDS.items() if f == f_name]
+               for f_name, _ in LAYER_BANDS.values()}
+
+
+def read_layer_headers(d_path: pathlib.Path) -> dict:
+    """
+    Read the headers of the selected offsets layer without reading
+    any raster data - headers are cached.
+    :param d_path: absolute path to the offsets layer directory
+    :return: raster file name -> EnviHeader - dict
+    """
+    return {f_name: read_envi_header(os.path.join(d_path, f'{f_name}.hdr'))
+            for f_name in LAYER_FILES}
+
+
+def _abs_deviation(values: np.ndarray, center: np.ndarray) -> np.ndarray:
+    """
+    Absolute deviation |values - center| computed in a single buffer of
+    the band compute data type.
+    :param values: band values - np.ndarray
+    :param center: local center (median or mean) - np.ndarray
+    :return: absolute deviation - np.ndarray
+    """
+    deviation = np.subtract(values, center, dtype=BAND_DTYPE)
+    return np.abs(deviation, out=deviation)
 
 
 class OffsetsLayer:
@@ -24,249 +79,723 @@ class OffsetsLayer:
     ----------
     :param d_path - pathlib.Path - absolute path ti the directory containing the
         selected offset layer.
+    :param lazy - bool - if True, each band is read from disk the first time
+        it is accessed instead of at initialization.
+    :param window - tuple - (xoff, yoff, xsize, ysize) raster window to read.
+        If None, the entire layer is read.
+    :param reader - str - raster reader:
+        'gdal' - bands are read in memory with GDAL,
+        'memmap' - bands of flat binary ENVI rasters are memory-mapped
+            (zero-copy, read-only until modified). Other rasters are read
+            with GDAL.
+    :param quality_dtype - str - storage data type of the SNR and
+        covariance bands [float32, float16]. Offsets are always stored
+        as float32.
+    :param store - LayerStore - process-shared band store. Bands read
+        with GDAL are loaded once per node and attached read-only by the
+        other processes (copied before being modified).
 
     Attributes
     ----------
     path = d_path          # - Absolute Path to Offsets Layer
     offsets_az = None      # - Dense Offsets Azimuth
     offsets_rg = None      # - Dense Offsets Range
-    offsets_hdr = {}       # - Dense Offsets Metadate
+    offsets_hdr = None     # - Dense Offsets Metadata - EnviHeader
     g_offsets_az = None    # - Gross Offsets Azimuth
     g_offsets_rg = None    # - Gross Offsets Range
-    g_offset_hdr = {}      # - Gross Offsets Metadata
+    g_offset_hdr = None    # - Gross Offsets Metadata - EnviHeader
     snr = None             # - SNR
-    snr_hdr = {}           # - SNR Header
+    snr_hdr = None         # - SNR Header - EnviHeader
     cov_az = None          # - Covariance Azimuth
     cov_rg = None          # - Covariance Range
-    cov_hdr = {}           # - Covariance Header
+    cov_hdr = None         # - Covariance Header - EnviHeader
     shape = None           # - Offsets layer shape
+    loaded_bands = []      # - Bands currently held in memory
 
     Methods
     -------
 
+    release - Release the selected bands from memory.
+    writable - Make the selected bands writable in place (copy on write).
+    band_dtype - Storage data type of the selected band.
     identify_outliers - Identify outliers inf the selected offset fields.
+    outlier_statistic - Per-pixel statistic compared with the threshold.
+    sweep_thresholds - Evaluate a vector of outliers thresholds.
     mask_outliers - Apply binary mask to Layer fields.
-    show_offsets - Show layer dense offsets and their covariance.
-    plot_offsets_distribution - Show dense offsets probability distribution.
+    write - Write the layer to disk [ENVI, GTiff, COG].
+    preview - Display-resolution preview of the selected band.
+    show_offsets - Plot layer dense offsets and their covariance.
+    plot_offsets_distribution - Plot dense offsets probability distribution.
 
     Raises ValueError
         Raised if offsets layers dimensions do not match,
         Raised if invalid metric to filter outliers is selected.
 
+    Copies of a layer (copy.copy/copy.deepcopy) share the loaded bands with
+    the original layer. Shared bands are returned as read-only arrays and
+    are copied only when modified: through the property setters or after
+    calling writable(). The original layer stays writable: a band lent to
+    a copy is copied by the original layer on its next access.
     """
-    def __init__(self, d_path: pathlib.Path) -> None:
+    # - Bands shared with other layers - copied before being modified
+    _shared_bands = frozenset()
+    # - Bands lent to layer copies - copied on next access
+    _lent_bands = frozenset()
+    # - Bands modified in memory - they no longer match the files on disk
+    _modified_bands = frozenset()
+    # - Storage data type of the quality bands
+    _quality_dtype = BAND_DTYPE
+    # - Process-shared band store
+    _store = None
+
+    def __init__(self, d_path: pathlib.Path, lazy: bool = False,
+                 window: tuple = None, reader: str = 'gdal',
+                 quality_dtype: str = 'float32',
+                 store: LayerStore = None) -> None:
+        if reader not in ['gdal', 'memmap']:
+            raise ValueError(f'{reader} invalid offsets layer reader')
+        if quality_dtype not in QUALITY_DTYPES:
+            raise ValueError(f'{quality_dtype} invalid quality bands '
+                             f'data type')
         # - class attributes
         self._path = d_path          # - Absolute Path to Offsets Layer
+        self._lazy = lazy            # - Read bands on first access
+        self._window = window        # - Raster window (xoff, yoff, xs, ys)
+        self._reader = reader        # - Raster reader [gdal, memmap]
+        self._quality_dtype = QUALITY_DTYPES[quality_dtype]
+        self._store = store          # - Process-shared band store
         self._offsets_az = None      # - Dense Offsets Azimuth
         self._offsets_rg = None      # - Dense Offsets Range
-        self._offsets_hdr = {}       # - Dense Offsets Metadate
+        self._offsets_hdr = None     # - Dense Offsets Metadata
         self._g_offsets_az = None    # - Gross Offsets Azimuth
         self._g_offsets_rg = None    # - Gross Offsets Range
-        self._g_offset_hdr = {}      # - Gross Offsets Metadata
+        self._g_offset_hdr = None    # - Gross Offsets Metadata
         self._snr = None             # - SNR
-        self._snr_hdr = {}           # - SNR Header
+        self._snr_hdr = None         # - SNR Header
         self._cov_az = None          # - Covariance Azimuth
         self._cov_rg = None          # - Covariance Range
-        self._cov_hdr = {}           # - Covariance Header
+        self._cov_hdr = None         # - Covariance Header
         self._shape = None           # - Offsets layer shape
 
-        # - Read Dense Offsets file
-        ds = gdal.Open(str(os.path.join(d_path, 'dense_offsets')),
-                       gdal.GA_ReadOnly)
-        self._offsets_az = ds.GetRasterBand(1).ReadAsArray()
-        self._offsets_rg = ds.GetRasterBand(2).ReadAsArray()
-        self._shape = self._offsets_rg.shape
-        ds = None
-        # - Read Dense Offsets header
-        with open(os.path.join(d_path, 'dense_offsets.hdr'), 'r',
-                  encoding='utf8') as h_fid:
-            h_line = h_fid.readlines()
-            for ln in h_line[1:]:
-                s_line = ln.split('=')
-                self._offsets_hdr[s_line[0].strip] = s_line[1].strip
-
-        # - Read Gross Offsets file
-        ds = gdal.Open(str(os.path.join(d_path, 'gross_offsets')),
-                       gdal.GA_ReadOnly)
-        self._g_offsets_az = ds.GetRasterBand(1).ReadAsArray()
-        self._g_offsets_rg = ds.GetRasterBand(2).ReadAsArray()
-        ds = None
-        # - Read Dense Offsets header
-        with open(os.path.join(d_path, 'gross_offsets.hdr'), 'r',
-                  encoding='utf8') as h_fid:
-            h_line = h_fid.readlines()
-            for ln in h_line[1:]:
-                s_line = ln.split('=')
-                self._g_offset_hdr[s_line[0].strip] = s_line[1].strip
-
-        # - Read SNR file
-        ds = gdal.Open(str(os.path.join(d_path, 'snr')),
-                       gdal.GA_ReadOnly)
-        self._snr = ds.GetRasterBand(1).ReadAsArray()
-        ds = None
-        # - Read SNR header
-        with open(os.path.join(d_path, 'snr.hdr'), 'r',
-                  encoding='utf8') as h_fid:
-            h_line = h_fid.readlines()
-            for ln in h_line[1:]:
-                s_line = ln.split('=')
-                self._snr_hdr[s_line[0].strip] = s_line[1].strip
-
-        # - Read Covariance file
-        ds = gdal.Open(str(os.path.join(d_path, 'covariance')),
-                       gdal.GA_ReadOnly)
-        self._cov_az = ds.GetRasterBand(1).ReadAsArray()
-        self._cov_rg = ds.GetRasterBand(2).ReadAsArray()
-        ds = None
-
-        # - Read SNR header
-        with open(os.path.join(d_path, 'covariance.hdr'), 'r',
-                  encoding='utf8') as h_fid:
-            h_line = h_fid.readlines()
-            for ln in h_line[1:]:
-                s_line = ln.split('=')
-                self._cov_hdr[s_line[0].strip] = s_line[1].strip
+        # - Read layer headers - no raster data is read
+        headers = read_layer_headers(d_path)
+        self._offsets_hdr = headers['dense_offsets']
+        self._g_offset_hdr = headers['gross_offsets']
+        self._snr_hdr = headers['snr']
+        self._cov_hdr = headers['covariance']
+
+        if window is not None and lazy:
+            self._shape = (window[3], window[2])
+        elif lazy:
+            # - Raster size from the header - bands are loaded on first access
+            self._shape = self._offsets_hdr.shape
+        else:
+            # - Read all the layer bands
+            self._read_bands(*LAYER_BANDS)
+            self._shape = self._offsets_rg.shape
 
     def __copy__(self):
-        return OffsetsLayer(self._path)
+        # - In-memory clone - loaded bands are shared until modified.
+        # - The clone holds read-only views of the loaded bands, the
+        # - original layer copies them on next access
+        loaded = frozenset(self.loaded_bands)
+        clone = OffsetsLayer.__new__(OffsetsLayer)
+        clone.__dict__.update(self.__dict__)
+        clone._shared_bands = self._shared_bands | loaded
+        clone._lent_bands = frozenset()
+        self._lent_bands = self._lent_bands | (loaded - self._shared_bands)
+        return clone
 
     def __deepcopy__(self, memo):
-        return OffsetsLayer(copy.deepcopy(self._path, memo))
+        clone = self.__copy__()
+        clone._path = copy.deepcopy(self._path, memo)
+        return clone
+
+    def _read_bands(self, *bands: str) -> None:
+        """
+        Read the selected bands from disk. All the requested bands of a
+        raster file are read in a single pass over the file (or mapped in
+        memory with the 'memmap' reader). Files are read concurrently.
+        :param bands: band names - see LAYER_BANDS
+        :return: None
+        """
+        f_bands = {}
+        for b_name in bands:
+            f_name, b_num = LAYER_BANDS[b_name]
+            f_bands.setdefault(f_name, []).append((b_name, b_num))
+        if self._reader == 'memmap':
+            for f_name, b_list in list(f_bands.items()):
+                with stage('map_bands', layer=self._path, file=f_name):
+                    b_views = envi_memmap(os.path.join(self._path, f_name),
+                                          [b_num for _, b_num in b_list],
+                                          window=self._window)
+                if b_views is None:
+                    continue
+                # - read-only mapping - copied before being modified.
+                # - Bands stored with a different data type are
+                # - converted - no longer zero-copy
+                for (b_name, _), b_view in zip(b_list, b_views):
+                    b_dtype = self.band_dtype(b_name)
+                    if b_view.dtype.newbyteorder('=') == b_dtype:
+                        self._set_band(b_name, b_view, shared=True,
+                                       modified=False)
+                    else:
+                        self._set_band(b_name, b_view.astype(b_dtype),
+                                       modified=False)
+                del f_bands[f_name]
+        if not f_bands:
+            return
+        f_items = list(f_bands.items())
+        if len(f_items) == 1:
+            f_arrays = [self._read_file(*f_items[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(f_items),
+                                                    IO_WORKERS)) as pool:
+                f_arrays = list(pool.map(lambda f: self._read_file(*f),
+                                         f_items))
+        for (_, b_list), b_arrays in zip(f_items, f_arrays):
+            for (b_name, _), b_array in zip(b_list, b_arrays):
+                self._set_band(b_name, b_array,
+                               shared=self._store is not None,
+                               modified=False)
+
+    def _read_file(self, f_name: str, b_list: list) -> list:
+        """
+        Read the selected bands of a layer raster file.
+        :param f_name: raster file name - see LAYER_FILES
+        :param b_list: (band name, band number) - list
+        :return: band values - list of np.ndarray
+        """
+        f_path = os.path.join(self._path, f_name)
+        b_nums = [b_num for _, b_num in b_list]
+        dtypes = [self.band_dtype(b_name) for b_name, _ in b_list]
+        if self._store is not None:
+            # - full resolution bands shared by all the processes
+            with stage('attach_bands', layer=self._path, file=f_name):
+                b_maps = self._store.attach(
+                    f_path, b_nums, dtypes,
+                    lambda b_load, d_load: read_raster_bands(
+                        f_path, b_load, dtypes=d_load))
+            if self._window is None:
+                return b_maps
+            xoff, yoff, xsize, ysize = self._window
+            return [b_map[yoff:yoff + ysize, xoff:xoff + xsize]
+                    for b_map in b_maps]
+        with stage('read_bands', layer=self._path, file=f_name):
+            return read_raster_bands(f_path, b_nums, window=self._window,
+                                     dtypes=dtypes)
+
+    def band_dtype(self, b_name: str) -> np.dtype:
+        """
+        Storage data type of the selected band - see quality_dtype.
+        :param b_name: band name - see LAYER_BANDS
+        :return: np.dtype
+        """
+        return np.dtype(self._quality_dtype if b_name in QUALITY_BANDS
+                        else BAND_DTYPE)
+
+    def _get_band(self, b_name: str) -> np.ndarray:
+        """
+        Return the selected band - read it from disk if not loaded yet.
+        :param b_name: band name - see LAYER_BANDS
+        :return: band values - np.ndarray
+        """
+        if getattr(self, f'_{b_name}') is None:
+            self._read_bands(b_name)
+        b_array = getattr(self, f'_{b_name}')
+        if b_name in self._lent_bands:
+            # - band lent to a layer copy - the copy keeps the original
+            self._set_band(b_name, np.array(b_array),
+                           modified=b_name in self._modified_bands)
+            b_array = getattr(self, f'_{b_name}')
+        if b_name in self._shared_bands:
+            # - read-only view - the band is shared with another layer
+            b_array = b_array.view()
+            b_array.flags.writeable = False
+        return b_array
+
+    def _set_band(self, b_name: str, b_array: np.ndarray,
+                  shared: bool = False, modified: bool = True) -> None:
+        """
+        Replace the selected band.
+        :param b_name: band name - see LAYER_BANDS
+        :param b_array: band values - np.ndarray
+        :param shared: the band values are shared or read-only - they are
+            copied before being modified
+        :param modified: the band values differ from the ones on disk
+        :return: None
+        """
+        setattr(self, f'_{b_name}', b_array)
+        self._lent_bands = self._lent_bands - {b_name}
+        if shared:
+            self._shared_bands = self._shared_bands | {b_name}
+        else:
+            self._shared_bands = self._shared_bands - {b_name}
+        if modified and b_array is not None:
+            self._modified_bands = self._modified_bands | {b_name}
+        else:
+            self._modified_bands = self._modified_bands - {b_name}
+
+    def writable(self, *bands: str) -> None:
+        """
+        Make the selected bands writable in place: bands shared with other
+        layers (or lent to a layer copy) are copied, the others are left
+        untouched.
+        :param bands: band names - see LAYER_BANDS. If none is given,
+            all the layer bands are made writable.
+        :return: None
+        """
+        bands = bands or tuple(LAYER_BANDS)
+        for b_name in bands:
+            if b_name not in LAYER_BANDS:
+                raise ValueError(f'{b_name} invalid offsets layer band')
+        # - bands not loaded yet may be read from a shared source
+        # - (memory map, layer store) - read them before copying
+        unloaded = [b for b in bands if getattr(self, f'_{b}', 0) is None]
+        if unloaded:
+            self._read_bands(*unloaded)
+        for b_name in bands:
+            if b_name in self._shared_bands | self._lent_bands:
+                b_array = getattr(self, f'_{b_name}')
+                self._set_band(b_name, None if b_array is None
+                               else np.array(b_array))
+            self._modified_bands = self._modified_bands | {b_name}
+
+    @property
+    def loaded_bands(self) -> list:
+        """Return the names of the bands currently held in memory"""
+        return [b for b in LAYER_BANDS if getattr(self, f'_{b}') is not None]
+
+    def release(self, *bands: str) -> None:
+        """
+        Release the selected bands from memory. Released bands are read
+        again from disk on next access - in-memory edits are lost.
+        :param bands: band names - see LAYER_BANDS. If none is given,
+            all the layer bands are released.
+        :return: None
+        """
+        for b_name in bands or LAYER_BANDS:
+            if b_name not in LAYER_BANDS:
+                raise ValueError(f'{b_name} invalid offsets layer band')
+            self._set_band(b_name, None)
+
+    def fingerprint(self, *bands: str, content_hash: bool = False) -> list:
+        """
+        Fingerprint of the selected bands as stored on disk and of their
+        storage data type - used to build ResultCache keys.
+        :param bands: band names - see LAYER_BANDS
+        :param content_hash: hash the raster files content instead of
+            using their size and modification time. Windowed layers hash
+            the values of the selected bands inside the window only
+            (the bands are read).
+        :return: fingerprint - list, or None if any of the selected bands
+            was modified in memory
+        """
+        if self._modified_bands & set(bands):
+            return None
+        f_names = sorted({LAYER_BANDS[b][0] for b in bands})
+        # - results depend on the bands storage data type
+        b_dtypes = [self.band_dtype(b).str for b in sorted(bands)]
+        if content_hash and self._window is not None:
+            return [sorted(bands), b_dtypes, self._window] \
+                + [file_fingerprint(os.path.join(self._path,
+                                                 f'{f_name}.hdr'), True)
+                   for f_name in f_names] \
+                + [hashlib.sha1(np.ascontiguousarray(self._get_band(b)))
+                   .hexdigest() for b in sorted(bands)]
+        return [sorted(bands), b_dtypes, self._window] \
+            + [file_fingerprint(os.path.join(self._path, f), content_hash)
+               for f_name in f_names for f in (f_name, f'{f_name}.hdr')]
+
+    def preview(self, b_name: str, max_size: int = 1024) -> np.ndarray:
+        """
+        Display-resolution preview of the selected band - NaN-aware block
+        mean. Bands not loaded yet are read from the raster overviews, if
+        available.
+        :param b_name: band name - see LAYER_BANDS
+        :param max_size: maximum preview size [pixels]
+        :return: decimated band - np.ndarray
+        """
+        factor = preview_factor(self._shape, max_size)
+        if factor > 1 and self._window is None \
+                and getattr(self, f'_{b_name}') is None:
+            overview = self._read_overview(b_name, factor)
+            if overview is not None:
+                return overview
+        return block_mean(self._get_band(b_name), factor)
+
+    def _read_overview(self, b_name: str, factor: int) -> np.ndarray:
+        """
+        Read the selected band from the coarsest raster overview whose
+        decimation does not exceed factor - the remaining decimation is
+        applied with a block mean.
+        :param b_name: band name - see LAYER_BANDS
+        :param factor: decimation factor
+        :return: decimated band - np.ndarray, None if no overview is found
+        """
+        f_name, b_num = LAYER_BANDS[b_name]
+        ds = gdal.Open(str(os.path.join(self._path, f_name)),
+                       gdal.GA_ReadOnly)
+        if ds is None:
+            return None
+        band = ds.GetRasterBand(b_num)
+        o_dec, o_band = 1, None
+        for o_num in range(band.GetOverviewCount()):
+            ovr = band.GetOverview(o_num)
+            dec = int(round(self._shape[1] / ovr.XSize))
+            if o_dec < dec <= factor:
+                o_dec, o_band = dec, ovr
+        if o_band is None:
+            return None
+        return block_mean(o_band.ReadAsArray(), factor // o_dec)
 
     @property
     def size(self):
         """Return Offsets Maps size"""
-        return self._offsets_rg.shape
+        return self._shape
+
+    @property
+    def offsets_hdr(self) -> EnviHeader:
+        """Get Dense Offsets Header"""
+        return self._offsets_hdr
+
+    @property
+    def g_offset_hdr(self) -> EnviHeader:
+        """Get Gross Offsets Header"""
+        return self._g_offset_hdr
+
+    @property
+    def snr_hdr(self) -> EnviHeader:
+        """Get SNR Header"""
+        return self._snr_hdr
+
+    @property
+    def cov_hdr(self) -> EnviHeader:
+        """Get Covariance Header"""
+        return self._cov_hdr
 
     @property
     def offsets_az(self):
         """Get Offsets Azimuth Direction"""
-        return self._offsets_az
+        return self._get_band('offsets_az')
 
     @offsets_az.setter
     def offsets_az(self, offsets_az: np.ndarray):
         """Set Offsets Azimuth Direction"""
         if offsets_az.shape != self._shape:
             raise ValueError(': Offsets Layers Dimensions do not match.')
-        self._offsets_az = offsets_az
+        self._set_band('offsets_az', offsets_az)
 
     @property
     def offsets_rg(self):
         """Get Offsets Range Direction"""
-        return self._offsets_rg
+        return self._get_band('offsets_rg')
 
     @offsets_rg.setter
     def offsets_rg(self, offsets_rg: np.ndarray):
         """Set Offsets Range Direction"""
         if offsets_rg.shape != self._shape:
             raise ValueError(': Offsets Layers Dimensions do not match.')
-        self._offsets_rg = offsets_rg
+        self._set_band('offsets_rg', offsets_rg)
 
     @property
     def g_offsets_az(self):
         """Get Gross Offsets Azimuth Direction"""
-        return self._g_offsets_az
+        return self._get_band('g_offsets_az')
 
     @g_offsets_az.setter
     def g_offsets_az(self, g_offsets_az: np.ndarray):
         """Set Gross Offsets Azimuth Direction"""
         if g_offsets_az.shape != self._shape:
             raise ValueError(': Offsets Layers Dimensions do not match.')
-        self._g_offsets_az = g_offsets_az
+        self._set_band('g_offsets_az', g_offsets_az)
 
     @property
     def g_offsets_rg(self):
         """Get Gross Offsets Range Direction"""
-        return self._g_offsets_rg
+        return self._get_band('g_offsets_rg')
 
     @g_offsets_rg.setter
     def g_offsets_rg(self, g_offsets_rg: np.ndarray):
         """Set Gross Offsets Range Direction"""
         if g_offsets_rg.shape != self._shape:
             raise ValueError(': Offsets Layers Dimensions do not match.')
-        self._g_offsets_rg = g_offsets_rg
+        self._set_band('g_offsets_rg', g_offsets_rg)
 
     @property
     def cov_az(self):
         """Get Offsets Covariance Azimuth Direction"""
-        return self._cov_az
+        return self._get_band('cov_az')
 
     @cov_az.setter
     def cov_az(self, cov_az: np.ndarray):
         """Set Offsets Covariance Azimuth Direction"""
         if cov_az.shape != self._shape:
             raise ValueError(': Offsets Layers Dimensions do not match.')
-        self._cov_az = cov_az
+        self._set_band('cov_az', cov_az)
 
     @property
     def cov_rg(self):
         """Get Offsets Covariance Range Direction"""
-        return self._cov_az
+        return self._get_band('cov_rg')
 
     @cov_rg.setter
     def cov_rg(self, cov_rg: np.ndarray):
         """Set Offsets Covariance Range Direction"""
         if cov_rg.shape != self._shape:
             raise ValueError(': Offsets Layers Dimensions do not match.')
-        self._cov_rg = cov_rg
+        self._set_band('cov_rg', cov_rg)
 
     @property
     def snr(self):
         """Get Offsets SNR"""
-        return self._snr
+        return self._get_band('snr')
 
     @snr.setter
     def snr(self, snr: np.ndarray):
         """Set Offsets SNR"""
         if snr.shape != self._shape:
             raise ValueError(': Offsets Layers Dimensions do not match.')
-        self._snr = snr
+        self._set_band('snr', snr)
 
+    @profiled('identify_outliers')
     def identify_outliers(self, metric: str = 'snr', threshold: float = 1.,
                           window_az: int = 50, window_rg: int = 50,
-                          ) -> dict:
+                          median_engine: str = 'scipy',
+                          min_valid: int = 1, n_workers: int = 1,
+                          packed: bool = False,
+                          cache: ResultCache = None) -> dict:
         """
         Identify outliers inf the selected offset fields.
         Outliers are identified by employing a user defined metric:
-        1. SNR,
-        2. offset covariance,
-        3. offset median,
-        4. absolute deviation
+        1. snr - SNR,
+        2. covariance - offset covariance,
+        3. median_filter - absolute deviation from the offset local median,
+        4. mad - absolute deviation from the offset local median normalized
+            by the local median absolute deviation (robust sigma units),
+        5. sigma_clip - absolute deviation from the offset local mean
+            normalized by the local standard deviation (sigma units).
         -------
         :param metric: outlier selection metric - str
         :param threshold: outlier selection threshold - str
         :param window_az: azimuth windows search size
         :param window_rg: range windows search size
-        :return: outliers_mask - dict
+        :param median_engine: median filter engine - see
+            utils.median_filter.MEDIAN_ENGINES
+        :param min_valid: minimum number of valid (not NaN) samples inside
+            the search window - NaN samples are ignored by the median filter
+        :param n_workers: number of threads used to filter the azimuth and
+            range offsets concurrently
+        :param packed: store the outliers mask bit-packed
+        :param cache: ResultCache - reuse median images and outlier masks
+            computed by previous runs on the same (unmodified) bands
+        :return: outliers_mask - dict - 'outliers_mask': OutliersMask,
+            'binary_mask': same OutliersMask - kept for compatibility:
+            numpy operations see it as the legacy 0/1 array, use
+            OutliersMask.to_float() to get the array.
         """
-        if metric == 'snr':
-            # - Open SNR
-            outliers_mask = np.where(self._snr < threshold)
+        m_bands = METRIC_BANDS.get(metric, [])
+        l_fp = self.fingerprint(*m_bands, content_hash=cache.content_hash) \
+            if cache is not None else None
+        m_key = None
+        if l_fp is not None and m_bands:
+            m_param = {'window_az': window_az, 'window_rg': window_rg,
+                       'median_engine': median_engine,
+                       'min_valid': min_valid} \
+                if metric in ['median_filter', 'mad', 'sigma_clip'] else {}
+            m_key = cache.key('outliers_mask', l_fp, metric=metric,
+                              threshold=threshold, **m_param)
+            outliers_mask = cache.get(m_key)
+            if outliers_mask is not None:
+                outliers_mask = OutliersMask(outliers_mask, packed=packed)
+                return {'outliers_mask': outliers_mask,
+                        'binary_mask': outliers_mask}
+
+        statistic, flag_below \
+            = self.outlier_statistic(metric=metric, window_az=window_az,
+                                     window_rg=window_rg,
+                                     median_engine=median_engine,
+                                     min_valid=min_valid, n_workers=n_workers,
+                                     cache=cache if l_fp else None)
+        if flag_below:
+            outliers_mask = statistic < threshold
+        else:
+            outliers_mask = statistic > threshold
 
-        elif metric == 'median_filter':
-            # - Use offsets to compute "median absolute deviation" (MAD)
-            median_az = ndimage.median_filter(self._offsets_az,
-                                              [window_az, window_rg])
-            median_rg = ndimage.median_filter(self._offsets_rg,
-                                              [window_az, window_rg])
+        if m_key is not None:
+            cache.put(m_key, outliers_mask)
+        # - outlier binary mask
+        outliers_mask = OutliersMask(outliers_mask, packed=packed)
 
-            outliers_mask \
-                = (np.abs(self._offsets_az - median_az) > threshold) | \
-                  (np.abs(self._offsets_rg - median_rg) > threshold)
+        return{'outliers_mask': outliers_mask, 'binary_mask': outliers_mask}
 
-        elif metric == 'covariance':
+    def outlier_statistic(self, metric: str = 'snr', window_az: int = 50,
+                          window_rg: int = 50, median_engine: str = 'scipy',
+                          min_valid: int = 1, n_workers: int = 1,
+                          cache: ResultCache = None) -> tuple:
+        """
+        Compute the per-pixel statistic compared with the outliers threshold:
+        1. snr - SNR - outliers below the threshold,
+        2. covariance - max(cov_az, cov_rg) - outliers above the threshold,
+        3. median_filter - max(|az - median_az|, |rg - median_rg|) -
+            outliers above the threshold,
+        4. mad - max(|az - median_az| / (k mad_az), |rg - median_rg| /
+            (k mad_rg)) - mad: local median absolute deviation, k: MAD to
+            standard deviation scale factor - outliers above the threshold,
+        5. sigma_clip - max(|az - mean_az| / std_az, |rg - mean_rg| /
+            std_rg) - outliers above the threshold.
+        NaN values are never flagged.
+        -------
+        :param metric: outlier selection metric - str
+        :param window_az: azimuth windows search size
+        :param window_rg: range windows search size
+        :param median_engine: median filter engine - see
+            utils.median_filter.MEDIAN_ENGINES
+        :param min_valid: minimum number of valid (not NaN) samples inside
+            the search window
+        :param n_workers: number of threads used to filter the azimuth and
+            range offsets concurrently
+        :param cache: ResultCache - reuse median images computed by previous
+            runs on the same (unmodified) bands
+        :return: statistic - np.ndarray, flag_below - bool - outliers are
+            the pixels below (True) or above (False) the threshold
+        """
+        if metric == 'snr':
+            # - Open SNR
+            return self.snr, True
+
+        if metric == 'median_filter':
+            # - Absolute deviation from the local median
+            median_az, median_rg \
+                = self._median_images(['offsets_az', 'offsets_rg'],
+                                      (window_az, window_rg), cache=cache,
+                                      n_workers=n_workers,
+                                      engine=median_engine,
+                                      min_valid=min_valid)
+            statistic = _abs_deviation(self.offsets_az, median_az)
+            np.fmax(statistic, _abs_deviation(self.offsets_rg, median_rg),
+                    out=statistic)
+            return statistic, False
+
+        if metric in ['mad', 'sigma_clip']:
+            # - Deviation from the local center normalized by the local
+            # - spread - joint azimuth/range test
+            bands = [self.offsets_az, self.offsets_rg]
+            if metric == 'mad':
+                center = self._median_images(['offsets_az', 'offsets_rg'],
+                                             (window_az, window_rg),
+                                             cache=cache, n_workers=n_workers,
+                                             engine=median_engine,
+                                             min_valid=min_valid)
+                residuals = [_abs_deviation(b, c)
+                             for b, c in zip(bands, center)]
+                # - local median absolute deviation - median of residuals
+                spread = median_filter_bands(residuals,
+                                             (window_az, window_rg),
+                                             n_workers=n_workers,
+                                             engine=median_engine,
+                                             min_valid=min_valid)
+                for scale in spread:
+                    np.multiply(scale, MAD_SCALE, out=scale)
+            else:
+                center, spread \
+                    = zip(*[mean_std_filter(b, (window_az, window_rg),
+                                            min_valid=min_valid)
+                            for b in bands])
+                residuals = [_abs_deviation(b, c)
+                             for b, c in zip(bands, center)]
+            statistic = None
+            for res, scale in zip(residuals, spread):
+                # - zero spread: any deviation is an outlier
+                zero = (scale == 0) & (res == 0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    np.divide(res, scale, out=res)
+                res[zero] = 0.
+                statistic = res if statistic is None \
+                    else np.fmax(statistic, res, out=statistic)
+            return statistic, False
+
+        if metric == 'covariance':
             # - Use offsets azimuth and range covariance elements
-            outliers_mask = (self._cov_az > threshold) |\
-                            (self._cov_rg > threshold)
-        else:
-            err_str = f'{metric} invalid metric to filter outliers'
-            raise ValueError(err_str)
+            return np.fmax(self.cov_az, self.cov_rg, dtype=BAND_DTYPE), False
 
-        # - outlier binary mask
-        binary_mask = np.zeros(self._shape)
-        binary_mask[outliers_mask] = 1
+        err_str = f'{metric} invalid metric to filter outliers'
+        raise ValueError(err_str)
 
-        return{'outliers_mask': outliers_mask, 'binary_mask': binary_mask}
+    def sweep_thresholds(self, thresholds, metric: str = 'snr',
+                         masks: bool = False, packed: bool = True,
+                         **kwargs) -> dict:
+        """
+        Evaluate a vector of outliers thresholds from a single computation
+        of the outlier statistic (see outlier_statistic).
+        :param thresholds: outliers thresholds - array_like
+        :param metric: outlier selection metric - str
+        :param masks: return the outliers mask of each threshold
+        :param packed: store the outliers masks bit-packed
+        :param kwargs: outlier_statistic keywords
+        :return: dict -
+            'thresholds': thresholds sorted in ascending order,
+            'counts': number of outliers for each threshold,
+            'flag_threshold': per-pixel threshold at which the pixel starts
+                being flagged - smallest flagging threshold (snr) or
+                largest flagging threshold (covariance, median_filter),
+                NaN if never flagged,
+            'masks': list of OutliersMask - only if masks is True.
+        """
+        thresholds = np.sort(np.asarray(thresholds, dtype=float).ravel())
+        statistic, flag_below = self.outlier_statistic(metric=metric,
+                                                       **kwargs)
+        valid = ~np.isnan(statistic)
+        s_sorted = np.sort(statistic[valid], axis=None)
+        # - pixel index in the sorted thresholds vector
+        t_index = np.full(statistic.shape, -1, dtype=np.int32)
+        if flag_below:
+            # - flagged if statistic < threshold
+            counts = np.searchsorted(s_sorted, thresholds, side='left')
+            t_index[valid] = np.searchsorted(thresholds, statistic[valid],
+                                             side='right')
+            flagged = valid & (t_index < thresholds.size)
+        else:
+            # - flagged if statistic > threshold
+            counts = s_sorted.size \
+                - np.searchsorted(s_sorted, thresholds, side='right')
+            t_index[valid] = np.searchsorted(thresholds, statistic[valid],
+                                             side='left') - 1
+            flagged = valid & (t_index >= 0)
+        flag_threshold = np.full(statistic.shape, np.nan)
+        flag_threshold[flagged] = thresholds[t_index[flagged]]
+        sweep = {'thresholds': thresholds, 'counts': counts,
+                 'flag_threshold': flag_threshold}
+        if masks:
+            sweep['masks'] \
+                = [OutliersMask(statistic < thr if flag_below
+                                else statistic > thr, packed=packed)
+                   for thr in thresholds]
+        return sweep
+
+    def _median_images(self, bands: list, size: tuple,
+                       cache: ResultCache = None, **kwargs) -> list:
+        """
+        Median filter the selected bands - median images are read from the
+        cache if available.
+        :param bands: band names - see LAYER_BANDS
+        :param size: median filter window size (azimuth, range)
+        :param cache: ResultCache - None to disable caching
+        :param kwargs: median_filter_bands keywords
+        :return: median images - list of np.ndarray
+        """
+        l_fp = self.fingerprint(*bands, content_hash=cache.content_hash) \
+            if cache is not None else None
+        if l_fp is None:
+            return median_filter_bands([getattr(self, b) for b in bands],
+                                       size, **kwargs)
+        m_param = {k: v for k, v in kwargs.items() if k != 'n_workers'}
+        m_key = cache.key('median_images', l_fp, size=size, **m_param)
+        medians = cache.get(m_key)
+        if medians is None:
+            medians = cache.put(m_key, np.stack(median_filter_bands(
+                [getattr(self, b) for b in bands], size, **kwargs)))
+        return list(medians)
 
     def mask_outliers(self, mask: np.ndarray) -> None:
         """
@@ -274,7 +803,7 @@ class OffsetsLayer:
         - mask = 1 -> NonValid data Points - set to NaN
         - mask = 0 -> Valid data point
         ------------
-        :param mask: binary mask - np.ndarray
+        :param mask: binary mask - OutliersMask or np.ndarray
         :return: None
         """
         if mask.shape != self._shape:
@@ -282,95 +811,113 @@ class OffsetsLayer:
                              f'together with shapes ({mask.shape}) '
                              f'({self._shape})')
         else:
-            ind_bin = np.where(mask == 1.)
-            self._offsets_az[ind_bin] = np.nan    # - Dense Offsets Azimuth
-            self._offsets_rg[ind_bin] = np.nan    # - Dense Offsets Range
-            self._g_offsets_az[ind_bin] = np.nan  # - Gross Offsets Azimuth
-            self._g_offsets_rg[ind_bin] = np.nan  # - Gross Offsets Range
-            self._snr[ind_bin] = np.nan           # - Gross Offsets Range
-            self._cov_az[ind_bin] = np.nan        # - Covariance Azimuth Azimuth
-            self._cov_rg[ind_bin] = np.nan        # - Covariance Azimuth Range
-
-    def show_offsets(self, fig_size: tuple = (10, 6),
+            if isinstance(mask, OutliersMask):
+                ind_bin = mask.index()
+            else:
+                ind_bin = np.where(mask == 1.)
+            self.writable()
+            self.offsets_az[ind_bin] = np.nan    # - Dense Offsets Azimuth
+            self.offsets_rg[ind_bin] = np.nan    # - Dense Offsets Range
+            self.g_offsets_az[ind_bin] = np.nan  # - Gross Offsets Azimuth
+            self.g_offsets_rg[ind_bin] = np.nan  # - Gross Offsets Range
+            self.snr[ind_bin] = np.nan           # - Gross Offsets Range
+            self.cov_az[ind_bin] = np.nan        # - Covariance Azimuth Azimuth
+            self.cov_rg[ind_bin] = np.nan        # - Covariance Azimuth Range
+
+    @profiled('write_layer')
+    def write(self, out_path: pathlib.Path, out_format: str = 'COG',
+              compress: str = 'DEFLATE', block_size: int = 512,
+              overviews='auto') -> list:
+        """
+        Write the layer to disk - one raster per layer file, with the same
+        bands, georeferencing and metadata of the input ones. Bands are
+        written in blocks of rows.
+        :param out_path: output layer path
+        :param out_format: output format [ENVI, GTiff, COG]
+        :param compress: compression algorithm [DEFLATE, ZSTD, LZW, NONE]
+        :param block_size: tile size [pixels]
+        :param overviews: overview levels - list, 'auto' or None
+        :return: written rasters paths - list
+        """
+        os.makedirs(out_path, exist_ok=True)
+        w_kwd = writer_options(out_format, gdal.GDT_Float32,
+                               compress=compress, block_size=block_size,
+                               overviews=overviews)
+        if out_format != 'ENVI':
+            w_kwd['nodata'] = np.nan
+        f_paths = []
+        for f_name, b_names in LAYER_FILES.items():
+            f_path = out_path.joinpath(f_name + RASTER_FORMATS[out_format][1])
+            # - georeferencing of windowed layers is not carried over
+            ref_path = pathlib.Path(self._path).joinpath(f_name) \
+                if self._window is None else None
+            with RasterWriter(f_path, self._shape, len(b_names),
+                              ref_path=ref_path, **w_kwd) as writer:
+                for row in range(0, self._shape[0], block_size):
+                    rows = slice(row, row + block_size)
+                    writer.write([getattr(self, b)[rows] for b in b_names],
+                                 yoff=row)
+            f_paths.append(f_path)
+        return f_paths
+
+    def show_offsets(self, out_path: pathlib.Path = None,
+                     fig_size: tuple = (10, 6),
                      offsets_range: tuple = (-20, 20),
                      cov_range: tuple = (0, 50),
                      title: str = '',
-                     off_cmap: plt.cm = plt.get_cmap('RdBu'),
-                     cov_cmap: plt.cm = plt.get_cmap('Reds')) -> None:
+                     off_cmap: str = 'RdBu',
+                     cov_cmap: str = 'Reds',
+                     max_size: int = 1024, exporter=None):
         """
-        Show Offsets Maps
+        Show Offsets Maps - bands are decimated to display resolution
+        :param out_path: output figure path - None: the figure is not saved
         :param fig_size: figure size - tuple
         :param offsets_range: offsets (min, max) values - tuple
         :param cov_range: covariance (min, max) values - tuple
         :param title: figure sup-title
         :param off_cmap: offsets colormap
         :param cov_cmap: covariance colormap
-        :return: None
+        :param max_size: maximum preview size [pixels]
+        :param exporter: utils.qa_plots.FigureExporter - render the figure
+            in the background
+        :return: matplotlib Figure, or Future if an exporter is given
         """
-        # - Show Grid Search Error Array
-        fig = plt.figure(figsize=fig_size)
-        plt.suptitle(title, weight='bold', size=16)
-        # - Dense Offsets Azimuth
-        ax_1 = fig.add_subplot(221)
-        ax_1.set_title('Offsets Azimuth', loc='left', weight='bold')
-        im_1 = ax_1.pcolormesh(self._offsets_az.T, cmap=off_cmap,
-                               vmin=offsets_range[0], vmax=offsets_range[1])
-        add_colorbar(ax_1, im_1)
-
-        # - Dense Offsets Range
-        ax_2 = fig.add_subplot(222)
-        ax_2.set_title('Offsets Range', loc='left', weight='bold')
-        im_2 = ax_2.pcolormesh(self._offsets_rg.T, cmap=off_cmap,
-                               vmin=offsets_range[0], vmax=offsets_range[1])
-        add_colorbar(ax_2, im_2)
-
-        # - Covariance Offsets Azimuth
-        ax_3 = fig.add_subplot(223)
-        ax_3.set_title('Covariance Offsets Azimuth', loc='left', weight='bold')
-        im_3 = ax_3.pcolormesh(self._cov_az.T, cmap=cov_cmap,
-                               vmin=cov_range[0], vmax=cov_range[1])
-        add_colorbar(ax_3, im_3)
-
-        # - Covariance Offsets Range
-        ax_4 = fig.add_subplot(224)
-        ax_4.set_title('Covariance Offsets Range', loc='left', weight='bold')
-        im_4 = ax_4.pcolormesh(self._cov_rg.T, cmap=cov_cmap,
-                               vmin=cov_range[0], vmax=cov_range[1])
-        add_colorbar(ax_4, im_4)
-        plt.tight_layout()
-        plt.show()
-        plt.close()
-
-    def plot_offsets_distribution(self, fig_size: tuple = (10, 4),
+        from utils import qa_plots
+        # - previews are computed here - only rendering is deferred
+        previews = {b: self.preview(b, max_size)
+                    for b in ['offsets_az', 'offsets_rg', 'cov_az', 'cov_rg']}
+        p_kwd = {'out_path': out_path, 'fig_size': fig_size,
+                 'offsets_range': offsets_range, 'cov_range': cov_range,
+                 'title': title, 'off_cmap': off_cmap, 'cov_cmap': cov_cmap}
+        if exporter is not None:
+            return exporter.submit(qa_plots.plot_offsets, previews,
+                                   self._shape, **p_kwd)
+        return qa_plots.plot_offsets(previews, self._shape, **p_kwd)
+
+    def plot_offsets_distribution(self, out_path: pathlib.Path = None,
+                                  fig_size: tuple = (10, 4),
                                   offsets_range: tuple = (-20, 20),
                                   n_bins: int = 41,
-                                  density: bool = True) -> None:
+                                  density: bool = True, exporter=None):
         """
-        Plot Histograms showing Offsets value distribution
+        Plot Histograms showing Offsets value distribution - histograms
+        are accumulated block by block over offsets_range
+        :param out_path: output figure path - None: the figure is not saved
         :param fig_size: figure size
         :param offsets_range: histogram x-axis limits
         :param n_bins: histogram number of bins
         :param density: If True, draw and return offsets probability density
-        :return: None
+        :param exporter: utils.qa_plots.FigureExporter - render the figure
+            in the background
+        :return: matplotlib Figure, or Future if an exporter is given
         """
-        # - Show Grid Search Error Array
-        fig = plt.figure(figsize=fig_size)
-        # - Dense Offsets Azimuth
-        ax_1 = fig.add_subplot(121)
-        ax_1.set_title('Offsets Azimuth', loc='left', weight='bold')
-        ax_1.hist(self._offsets_az.ravel(), n_bins, density=density,
-                  facecolor='g', edgecolor='k', alpha=0.75)
-        ax_1.grid(color='k', linestyle='dotted', alpha=0.3)
-        ax_1.set_xlim(offsets_range[0], offsets_range[1])
-
-        # - Dense Offsets Range
-        ax_2 = fig.add_subplot(122)
-        ax_2.set_title('Offsets Range', loc='left', weight='bold')
-        ax_2.hist(self._offsets_rg.ravel(), n_bins, density=density,
-                  facecolor='b', edgecolor='k', alpha=0.75)
-        ax_2.grid(color='k', linestyle='dotted', alpha=0.3)
-        ax_2.set_xlim(offsets_range[0], offsets_range[1])
-
-        plt.tight_layout()
-        plt.show()
-        plt.close()
+        from utils import qa_plots
+        histograms = {b: blocked_histogram(getattr(self, b), n_bins,
+                                           offsets_range, density=density)
+                      for b in ['offsets_az', 'offsets_rg']}
+        p_kwd = {'out_path': out_path, 'fig_size': fig_size,
+                 'offsets_range': offsets_range}
+        if exporter is not None:
+            return exporter.submit(qa_plots.plot_offsets_distribution,
+                                   histograms, **p_kwd)
+        return qa_plots.plot_offsets_distribution(histograms, **p_kwd)
@@ -21,14 +21,12 @@ import argparse
 import pathlib
 import datetime
 import yaml
-import matplotlib.pyplot as plt
 from offsets_layer import OffsetsLayer
 from utils.set_path import set_path_to_data_dir
-from utils.mpl_utils import add_colorbar
-# - change matplotlib default setting
-plt.rc('font', family='monospace')
-plt.rc('font', weight='bold')
-plt.style.use('seaborn-deep')
+from utils.preview import preview_factor, block_mean
+from utils.result_cache import ResultCache
+from utils.layer_store import LayerStore
+from utils.profiling import StageProfiler
 
 
 def main() -> None:
@@ -56,19 +54,49 @@ def main() -> None:
     threshold = param_proc['threshold']
     window_az = param_proc['window_az']
     window_rg = param_proc['window_rg']
+    lazy = param_proc.get('lazy_loading', False)
+    median_engine = param_proc.get('median_engine', 'scipy')
+    min_valid = param_proc.get('min_valid', 1)
+    n_workers = param_proc.get('n_workers', 1)
+    reader = param_proc.get('reader', 'gdal')
+    quality_dtype = param_proc.get('quality_dtype', 'float32')
+    threshold_sweep = param_proc.get('threshold_sweep')
+    cache_dir = param_proc.get('cache_dir')
+    cache = ResultCache(cache_dir, max_size=param_proc.get('cache_size', 2.),
+                        content_hash=param_proc.get('cache_content_hash',
+                                                    False))\
+        if cache_dir is not None else None
+    # - Bands shared with the other processes running on the node
+    store_dir = param_proc.get('layer_store_dir')
+    store = LayerStore(store_dir) if store_dir is not None else None
+    qa_dir = pathlib.Path(param_proc.get('qa_dir', 'qa_figures'))
+    # - Per-stage timing and memory instrumentation
+    profiler = StageProfiler(log=param_proc.get('profiling_log', False))\
+        .enable() if param_proc.get('profiling', False) else None
 
     # - set path to project data directory
     data_path = pathlib.Path(set_path_to_data_dir())
 
     # - import sample Offset Layer
-    o_layer = OffsetsLayer(data_path.joinpath(layer_name))
+    o_layer = OffsetsLayer(data_path.joinpath(layer_name), lazy=lazy,
+                           reader=reader, quality_dtype=quality_dtype,
+                           store=store)
     print(f'# - Selected Offsets Layer: {layer_name}')
     print(f'# - Offsets Map Size: {o_layer.size}')
 
+    # - QA figures are saved to qa_dir and rendered in the background
+    # - while processing continues - matplotlib is imported only here
+    from utils.qa_plots import FigureExporter, plot_outliers_mask
+    os.makedirs(qa_dir, exist_ok=True)
+    exporter = FigureExporter()
+
     # - Show Offsets and Their Covariance
-    o_layer.show_offsets(fig_size=(8, 6), title=f'{layer_name} - Offsets')
+    o_layer.show_offsets(qa_dir.joinpath(f'{layer_name}_offsets.png'),
+                         fig_size=(8, 6), title=f'{layer_name} - Offsets',
+                         exporter=exporter)
     # - Show Outlier Value Distribution
-    o_layer.plot_offsets_distribution()
+    o_layer.plot_offsets_distribution(
+        qa_dir.joinpath(f'{layer_name}_distribution.png'), exporter=exporter)
 
     # - Compute Outliers Mask
     print('# - Compute Outliers Mask.')
@@ -76,27 +104,52 @@ def main() -> None:
     outliers_mask = o_layer.identify_outliers(metric=metric,
                                               threshold=threshold,
                                               window_az=window_az,
-                                              window_rg=window_rg)
-
-    # - Show Outliers Mask
-    fig_size = (7, 5)
-    fig = plt.figure(figsize=fig_size)
-    ax_b = fig.add_subplot(111)
-    ax_b.set_title('Outliers Mask', weight='bold', loc='left', size=20)
-    im_b = ax_b.pcolormesh(outliers_mask['binary_mask'].T,
-                           cmap=plt.get_cmap('Greys'), vmin=0, vmax=1)
-    add_colorbar(ax_b, im_b)
-    plt.show()
-    plt.close()
+                                              window_rg=window_rg,
+                                              median_engine=median_engine,
+                                              min_valid=min_valid,
+                                              n_workers=n_workers,
+                                              cache=cache)
+    if threshold_sweep is not None:
+        # - Number of outliers for each of the candidate thresholds
+        sweep = o_layer.sweep_thresholds(threshold_sweep, metric=metric,
+                                         window_az=window_az,
+                                         window_rg=window_rg,
+                                         median_engine=median_engine,
+                                         min_valid=min_valid,
+                                         n_workers=n_workers, cache=cache)
+        print('# - Threshold sweep [threshold: number of outliers]')
+        for thr, cnt in zip(sweep['thresholds'], sweep['counts']):
+            print(f'# - {thr:10.3f}: {cnt}')
+
+    # - Show Outliers Mask - fraction of outliers per display pixel
+    o_mask = outliers_mask['binary_mask']
+    exporter.submit(plot_outliers_mask,
+                    block_mean(o_mask.to_bool(),
+                               preview_factor(o_mask.shape)),
+                    o_mask.shape, qa_dir.joinpath(f'{layer_name}_mask.png'))
 
     # - Apply Outlier Mask to the selected Layer
     o_layer.mask_outliers(outliers_mask['binary_mask'])
 
     # - Show Offsets after Outlier Removal
     print('# - Set outlier values to NaN.')
-    o_layer.show_offsets(cov_range=(0, 1), offsets_range=(-20, 20))
+    o_layer.show_offsets(qa_dir.joinpath(f'{layer_name}_masked_offsets.png'),
+                         cov_range=(0, 1), offsets_range=(-20, 20),
+                         exporter=exporter)
     # - Show New Outlier Values Distribution
-    o_layer.plot_offsets_distribution()
+    o_layer.plot_offsets_distribution(
+        qa_dir.joinpath(f'{layer_name}_masked_distribution.png'),
+        exporter=exporter)
+    exporter.close()
+    print(f'# - QA figures saved to: {qa_dir}')
+    if store is not None:
+        store.close()
+    if profiler is not None:
+        profiler.disable()
+        report = param_proc.get('profiling_report', 'profiling_report')
+        profiler.to_json(f'{report}.json')
+        profiler.to_csv(f'{report}.csv')
+        print(f'# - Profiling report saved to: {report}.json/.csv')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+"""
+Test - Batch Processing of a Campaign of Image Pairs
+
+UPDATE HISTORY:
+
+"""
+import os
+import json
+import pathlib
+import numpy as np
+import pytest
+from batch_merge_offsets_layers import list_pairs, run_campaign, \
+    estimate_pair_memory, parameters_hash, pair_output_names, \
+    CAMPAIGN_DEFAULTS
+from utils.synthetic_layers import write_random_layer
+
+param_proc = {'metric': 'snr', 'threshold': 1., 'window_az': 5,
+              'window_rg': 5, 'fill_strategy': 'median',
+              'kernel_size_az': 3, 'kernel_size_rg': 3,
+              'tile_size_az': 16, 'tile_size_rg': 16, 'out_format': 'ENVI'}
+
+
+def test_run_campaign(tmp_path: pathlib.Path):
+    """Verify that all pairs are processed and up to date pairs skipped"""
+    rng = np.random.default_rng(0)
+    for pair in ['pair_a', 'pair_b']:
+        for l_name in ['layer1', 'layer2', 'layer3']:
+            write_random_layer(tmp_path.joinpath('pairs', pair, l_name),
+                               (30, 40), rng)
+    pairs = list_pairs(pattern=str(tmp_path.joinpath('pairs', 'pair_*')))
+    assert [p.name for p in pairs] == ['pair_a', 'pair_b']
+    manifest = tmp_path.joinpath('manifest.txt')
+    manifest.write_text('\n'.join(str(p) for p in pairs) + '\n# comment\n')
+    assert list_pairs(manifest=str(manifest)) == pairs
+
+    out_dir = tmp_path.joinpath('out')
+    summaries = run_campaign(pairs, out_dir, param_proc, n_procs=2,
+                             mem_budget=1.)
+    assert all(s['status'] == 'done' for s in summaries)
+    assert not any(s.get('skipped') for s in summaries)
+    for pair in pairs:
+        with open(out_dir.joinpath(pair.name, 'summary.json'), 'r',
+                  encoding='utf8') as s_fid:
+            summary = json.load(s_fid)
+        assert summary['shape'] == [30, 40] and summary['n_outliers'] > 0
+        assert out_dir.joinpath(pair.name, 'blended_layer',
+                                'dense_offsets').is_file()
+    assert out_dir.joinpath('campaign_summary.csv').is_file()
+
+    # - resume: skip up to date pairs
+    summaries = run_campaign(pairs, out_dir, param_proc)
+    assert all(s.get('skipped') for s in summaries)
+    # - modified inputs or parameters are processed again
+    snr_path = pairs[0].joinpath('layer2', 'snr')
+    os.utime(snr_path, (snr_path.stat().st_atime,
+                        snr_path.stat().st_mtime + 10.))
+    summaries = run_campaign(pairs, out_dir, param_proc)
+    assert sorted(s.get('skipped', False) for s in summaries) \
+        == [False, True]
+    summaries = run_campaign(pairs, out_dir, {**param_proc, 'threshold': 2.})
+    assert not any(s.get('skipped') for s in summaries)
+    # - half precision quality bands are forwarded to the tiled engine
+    summaries = run_campaign(pairs, out_dir, {**param_proc, 'threshold': 2.,
+                                              'quality_dtype': 'float16'})
+    assert all(s['status'] == 'done' and not s.get('skipped')
+               for s in summaries)
+
+
+def test_run_campaign_invalid_pair(tmp_path: pathlib.Path):
+    """Verify that a pair with missing layers fails alone when a memory
+    budget is set"""
+    rng = np.random.default_rng(0)
+    for l_name in ['layer1', 'layer2', 'layer3']:
+        write_random_layer(tmp_path.joinpath('pairs', 'pair_a', l_name),
+                           (30, 40), rng)
+    # - the high resolution layer is missing
+    for l_name in ['layer2', 'layer3']:
+        write_random_layer(tmp_path.joinpath('pairs', 'pair_b', l_name),
+                           (30, 40), rng)
+    pairs = list_pairs(pattern=str(tmp_path.joinpath('pairs', 'pair_*')))
+    summaries = run_campaign(pairs, tmp_path.joinpath('out'), param_proc,
+                             n_procs=2, mem_budget=1.)
+    status = {pathlib.Path(s['pair']).name: s['status'] for s in summaries}
+    assert status == {'pair_a': 'done', 'pair_b': 'failed'}
+
+
+def test_pair_output_names(tmp_path: pathlib.Path):
+    """Verify that pairs with the same name write to different outputs"""
+    rng = np.random.default_rng(0)
+    for track in ['track12', 'track13']:
+        for l_name in ['layer1', 'layer2', 'layer3']:
+            write_random_layer(tmp_path.joinpath('pairs', track, 'pair_001',
+                                                 l_name), (30, 40), rng)
+    pairs = list_pairs(pattern=str(tmp_path.joinpath('pairs', '*',
+                                                     'pair_*')))
+    assert pair_output_names(pairs) == [pathlib.Path('track12', 'pair_001'),
+                                        pathlib.Path('track13', 'pair_001')]
+    assert pair_output_names(pairs[:1]) == [pathlib.Path('pair_001')]
+    with pytest.raises(ValueError):
+        pair_output_names([pairs[0], pairs[0]])
+
+    out_dir = tmp_path.joinpath('out')
+    summaries = run_campaign(pairs, out_dir, param_proc)
+    assert sorted(s['out_path'] for s in summaries) \
+        == [str(out_dir.joinpath(track, 'pair_001'))
+            for track in ['track12', 'track13']]
+    # - resume: each pair is checked against its own summary
+    snr_path = pairs[1].joinpath('layer1', 'snr')
+    os.utime(snr_path, (snr_path.stat().st_atime,
+                        snr_path.stat().st_mtime + 10.))
+    summaries = run_campaign(pairs, out_dir, param_proc)
+    skipped = {s['pair']: s.get('skipped', False) for s in summaries}
+    assert skipped == {str(pairs[0]): True, str(pairs[1]): False}
+
+
+def test_estimate_pair_memory(tmp_path: pathlib.Path):
+    """Verify that the memory estimate follows the tiled engine halo"""
+    write_random_layer(tmp_path.joinpath('layer1'), (300, 400),
+                       np.random.default_rng(0))
+    p_kwd = {**CAMPAIGN_DEFAULTS, **param_proc, 'window_az': 21,
+             'window_rg': 21, 'tile_size_az': 64, 'tile_size_rg': 64}
+    m_median = estimate_pair_memory(tmp_path, {**p_kwd,
+                                               'metric': 'median_filter'})
+    m_mad = estimate_pair_memory(tmp_path, {**p_kwd, 'metric': 'mad'})
+    # - the MAD support is twice the window: (64 + 40)^2 vs (64 + 20)^2
+    assert m_mad * 84 ** 2 == m_median * 104 ** 2
+
+
+def test_parameters_hash():
+    """Verify that the tile size is hashed for the tile-dependent median
+    engines only"""
+    p_kwd = {**CAMPAIGN_DEFAULTS, **param_proc}
+    t_kwd = {**p_kwd, 'tile_size_az': 32}
+    assert parameters_hash(p_kwd) == parameters_hash(t_kwd)
+    assert parameters_hash({**p_kwd, 'median_engine': 'histogram'}) \
+        != parameters_hash({**t_kwd, 'median_engine': 'histogram'})
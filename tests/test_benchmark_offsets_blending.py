@@ -0,0 +1,45 @@
+#!/usr/bin/python
+"""
+Test - Benchmark Suite on Synthetic AMPCOR Offsets Layers
+
+UPDATE HISTORY:
+
+"""
+import copy
+import pathlib
+from benchmark_offsets_blending import list_cases, run_benchmark, \
+    compare_baseline
+
+
+def test_run_benchmark(tmp_path: pathlib.Path):
+    """Verify that the tiled engine reproduces the in-memory results and
+    that the baseline comparison flags mismatches and regressions"""
+    cases = list_cases([96], ['ENVI'], ['memmap'], ['snr', 'mad'],
+                       ['median'])
+    assert len(cases) == 4
+    param_bench = {'window_az': 5, 'window_rg': 5, 'kernel_size_az': 3,
+                   'kernel_size_rg': 3, 'tile_size_az': 40,
+                   'tile_size_rg': 40}
+    records = run_benchmark(cases, tmp_path, param_bench=param_bench)
+    assert [r['case'] for r in records] \
+        == ['96/ENVI/load/memmap', '96/ENVI/identify_outliers/snr',
+            '96/ENVI/identify_outliers/mad',
+            '96/ENVI/fill_outliers_holes/median']
+    assert all(r['wall_time'] > 0 for r in records)
+    assert records[1]['result']['n_outliers'] > 0
+    assert 'median_filter' in records[3]['stages']
+    baseline = {r['case']: r for r in copy.deepcopy(records)}
+
+    # - tiled engine
+    t_records = run_benchmark(cases[3:], tmp_path,
+                              param_bench={**param_bench,
+                                           'tiled_above': 64})
+    compare_baseline(t_records, baseline, time_tolerance=1e6)
+    assert t_records[0]['status'] == 'ok'
+
+    baseline['96/ENVI/identify_outliers/snr']['result']['n_outliers'] += 1
+    baseline['96/ENVI/identify_outliers/mad']['wall_time'] /= 10.
+    del baseline['96/ENVI/load/memmap']
+    compare_baseline(records, baseline, time_tolerance=0.5)
+    assert [r['status'] for r in records[:3]] \
+        == ['new', 'mismatch', 'slower']
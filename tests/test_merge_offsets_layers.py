@@ -12,8 +12,14 @@ import pathlib
 import copy
 import pytest
 from pytest import MonkeyPatch
-from offsets_layer import OffsetsLayer
-from merge_offsets_layers import fill_outliers_holes
+import offsets_layer
+from offsets_layer import OffsetsLayer, LAYER_BANDS
+from merge_offsets_layers import fill_outliers_holes, \
+    fill_outliers_holes_tiled, weighted_average, blend_offsets_layers
+from utils.result_cache import ResultCache
+from utils.layer_store import LayerStore
+from utils.profiling import StageProfiler
+from utils.synthetic_layers import write_random_layer
 
 
 def test_fill_outliers_holes(monkeypatch: MonkeyPatch):
@@ -154,3 +160,258 @@ def test_mask_outliers(monkeypatch: MonkeyPatch):
         layer_1_c = copy.deepcopy(layer_1)
         assert isinstance(layer_1_c, OffsetsLayer)
         assert id(layer_1_c) == id(OffsetsLayer)
+
+
+@pytest.mark.parametrize('fill_strategy', ['intermediate', 'median',
+                                           'weighted'])
+@pytest.mark.parametrize('reader, shared', [('gdal', False), ('gdal', True),
+                                            ('memmap', False)])
+def test_fill_outliers_holes_tiled(tmp_path: pathlib.Path,
+                                   fill_strategy: str, reader: str,
+                                   shared: bool):
+    """Verify that the tiled engine matches the in-memory results"""
+    shape = (67, 81)
+    rng = np.random.default_rng(0)
+    l_paths = [write_random_layer(tmp_path.joinpath(f'layer{n}'), shape, rng)
+               for n in range(1, 4)]
+    outlier_kwd = {'metric': 'median_filter', 'threshold': 5.,
+                   'window_az': 11, 'window_rg': 9}
+    f_layer = fill_outliers_holes(*[OffsetsLayer(p) for p in l_paths],
+                                  outlier_kwd, fill_strategy=fill_strategy,
+                                  krn_size=(7, 5))
+    out_path = tmp_path.joinpath('blended')
+    store = LayerStore(tmp_path.joinpath('store')) if shared else None
+    t_layer = fill_outliers_holes_tiled(*l_paths, out_path, outlier_kwd,
+                                        fill_strategy=fill_strategy,
+                                        krn_size=(7, 5), tile_size=(20, 30),
+                                        n_workers=2, reader=reader,
+                                        store=store)
+    if store is not None:
+        # - each band is loaded once and attached by the other tiles
+        assert 0 < store.stats['loaded'] <= 3 * len(LAYER_BANDS)
+        assert store.stats['attached'] > store.stats['loaded']
+        store.close()
+    assert t_layer['n_outliers'] == f_layer['binary_mask'].count
+    tiled_layer = OffsetsLayer(out_path)
+    for b_name in ['offsets_az', 'offsets_rg', 'g_offsets_az',
+                   'g_offsets_rg', 'snr', 'cov_az', 'cov_rg']:
+        np.testing.assert_array_equal(getattr(tiled_layer, b_name),
+                                      getattr(f_layer['filled_layer'],
+                                              b_name))
+
+
+@pytest.mark.parametrize('fill_strategy', ['median', 'weighted'])
+def test_fill_outliers_holes_tiled_float16(tmp_path: pathlib.Path,
+                                           fill_strategy: str):
+    """Verify the tiled engine with half precision quality bands"""
+    shape = (67, 81)
+    rng = np.random.default_rng(1)
+    l_paths = [write_random_layer(tmp_path.joinpath(f'layer{n}'), shape, rng)
+               for n in range(1, 4)]
+    outlier_kwd = {'metric': 'covariance', 'threshold': 0.5}
+    f_layer = fill_outliers_holes(*[OffsetsLayer(p, quality_dtype='float16')
+                                    for p in l_paths],
+                                  outlier_kwd, fill_strategy=fill_strategy,
+                                  krn_size=(7, 5))
+    out_path = tmp_path.joinpath('blended')
+    t_layer = fill_outliers_holes_tiled(*l_paths, out_path, outlier_kwd,
+                                        fill_strategy=fill_strategy,
+                                        krn_size=(7, 5), tile_size=(20, 30),
+                                        quality_dtype='float16')
+    assert t_layer['n_outliers'] == f_layer['binary_mask'].count > 0
+    tiled_layer = OffsetsLayer(out_path)
+    for b_name in LAYER_BANDS:
+        np.testing.assert_array_equal(getattr(tiled_layer, b_name),
+                                      getattr(f_layer['filled_layer'],
+                                              b_name))
+    # - the cascade reads layers given as paths with the same policy
+    b_layer = blend_offsets_layers(l_paths, outlier_kwd,
+                                   fill_strategy='intermediate',
+                                   quality_dtype='float16')
+    assert b_layer['filled_layer'].snr.dtype == np.float16
+
+
+def test_weighted_average():
+    """Verify sparse and dense weighted average against the formula"""
+    rng = np.random.default_rng(0)
+    v_1, v_2 = rng.normal(size=(2, 50, 40))
+    w_1, w_2 = rng.uniform(0.1, 1., size=(2, 50, 40))
+    reference = (v_1 * w_1 + v_2 * w_2) / (w_1 + w_2)
+    np.testing.assert_allclose(weighted_average(v_1, w_1, v_2, w_2),
+                               reference)
+    out = np.empty_like(v_1)
+    assert weighted_average(v_1, w_1, v_2, w_2, out=out) is out
+    np.testing.assert_allclose(out, reference)
+    index = np.where(rng.random((50, 40)) < 0.05)
+    np.testing.assert_allclose(weighted_average(v_1, w_1, v_2, w_2,
+                                                index=index),
+                               reference[index])
+
+
+@pytest.mark.parametrize('fill_strategy', ['intermediate', 'median'])
+def test_blend_offsets_layers(tmp_path: pathlib.Path, fill_strategy: str):
+    """Verify the N-layer cascade against fill_outliers_holes"""
+    shape = (45, 38)
+    rng = np.random.default_rng(1)
+    l_paths = [write_random_layer(tmp_path.joinpath(f'layer{n}'), shape, rng)
+               for n in range(1, 4)]
+    outlier_kwd = {'metric': 'snr', 'threshold': 1.}
+    f_layer = fill_outliers_holes(*[OffsetsLayer(p) for p in l_paths],
+                                  outlier_kwd, fill_strategy=fill_strategy,
+                                  krn_size=(5, 5))
+    # - the fourth layer does not exist - it must not be read
+    b_layer = blend_offsets_layers(l_paths[:2] + [tmp_path.joinpath('none')],
+                                   outlier_kwd, fill_strategy=fill_strategy,
+                                   krn_size=(5, 5))
+    assert b_layer['n_filled'] == [f_layer['outliers_mask'].count]
+    assert b_layer['holes_mask'].count == 0
+    for b_name in ['offsets_az', 'offsets_rg', 'g_offsets_az',
+                   'g_offsets_rg']:
+        np.testing.assert_array_equal(getattr(b_layer['filled_layer'],
+                                              b_name),
+                                      getattr(f_layer['filled_layer'],
+                                              b_name))
+
+
+def test_blend_offsets_layers_cascade(tmp_path: pathlib.Path):
+    """Verify that holes left by a layer are filled by the next one"""
+    shape = (30, 20)
+    rng = np.random.default_rng(2)
+    l_paths = [write_random_layer(tmp_path.joinpath(f'layer{n}'), shape, rng)
+               for n in range(1, 4)]
+    layers = [OffsetsLayer(p) for p in l_paths]
+    outliers = layers[0].identify_outliers(metric='snr', threshold=2.)
+    o_index = outliers['outliers_mask'].indices()
+    # - invalid values in the second layer at half of the outliers
+    nan_index = (o_index[0][::2], o_index[1][::2])
+    layers[1].writable()
+    layers[1].offsets_az[nan_index] = np.nan
+    b_layer = blend_offsets_layers(layers, {'metric': 'snr',
+                                            'threshold': 2.})
+    assert sum(b_layer['n_filled']) == outliers['outliers_mask'].count
+    assert b_layer['n_filled'][1] == nan_index[0].size
+    np.testing.assert_array_equal(
+        b_layer['filled_layer'].offsets_rg[nan_index],
+        layers[2].offsets_rg[nan_index])
+
+
+def test_fill_outliers_holes_cache(monkeypatch: MonkeyPatch,
+                                   tmp_path: pathlib.Path):
+    """Verify that cached results match and skip the median filter"""
+    shape = (40, 36)
+    rng = np.random.default_rng(2)
+    l_paths = [write_random_layer(tmp_path.joinpath(f'layer{n}'), shape, rng)
+               for n in range(1, 4)]
+    outlier_kwd = {'metric': 'median_filter', 'threshold': 5.,
+                   'window_az': 11, 'window_rg': 9}
+    reference = fill_outliers_holes(*[OffsetsLayer(p) for p in l_paths],
+                                    outlier_kwd, fill_strategy='median',
+                                    krn_size=(7, 5))
+    n_calls = []
+    median_filter_bands = offsets_layer.median_filter_bands
+
+    def f_median_filter_bands(*args, **kwargs):
+        n_calls.append(1)
+        return median_filter_bands(*args, **kwargs)
+    monkeypatch.setattr(offsets_layer, 'median_filter_bands',
+                        f_median_filter_bands)
+
+    cache = ResultCache(tmp_path.joinpath('cache'))
+    for n_run, thr in enumerate([5., 5., 3.]):
+        f_layer = fill_outliers_holes(*[OffsetsLayer(p) for p in l_paths],
+                                      {**outlier_kwd, 'threshold': thr},
+                                      fill_strategy='median',
+                                      krn_size=(7, 5), cache=cache)
+        if n_run < 2:
+            np.testing.assert_array_equal(f_layer['binary_mask'],
+                                          reference['binary_mask'])
+            for b_name in ['offsets_az', 'offsets_rg', 'g_offsets_az',
+                           'g_offsets_rg']:
+                np.testing.assert_array_equal(
+                    getattr(f_layer['filled_layer'], b_name),
+                    getattr(reference['filled_layer'], b_name))
+    # - medians computed once - reused by the second run and the new
+    # - threshold. Median fill values are evaluated at the outliers only.
+    assert len(n_calls) == 1
+    # - filled bands from the cache are copied before being modified
+    f_layer['filled_layer'].mask_outliers(np.ones(shape))
+
+    # - layers modified in memory are not cached
+    layer = OffsetsLayer(l_paths[0])
+    layer.mask_outliers(np.eye(*shape))
+    assert layer.fingerprint('offsets_az') is None
+    layer.identify_outliers(**outlier_kwd, cache=cache)
+    assert len(n_calls) == 2
+
+
+def test_fill_outliers_holes_tiled_incremental(tmp_path: pathlib.Path):
+    """Verify that only the tiles and stages whose inputs changed are
+    recomputed"""
+    shape = (60, 60)
+    rng = np.random.default_rng(4)
+    l_paths = [write_random_layer(tmp_path.joinpath(f'layer{n}'), shape, rng)
+               for n in range(1, 4)]
+    outlier_kwd = {'metric': 'median_filter', 'threshold': 5.,
+                   'window_az': 5, 'window_rg': 5}
+    t_kwd = {'krn_size': (3, 3), 'tile_size': (20, 20)}
+    c_path = tmp_path.joinpath('cache')
+
+    def run(fill_strategy: str) -> dict:
+        cache = ResultCache(c_path, content_hash=True)
+        fill_outliers_holes_tiled(*l_paths, tmp_path.joinpath('out'),
+                                  outlier_kwd, fill_strategy=fill_strategy,
+                                  cache=cache, **t_kwd)
+        fill_outliers_holes_tiled(*l_paths, tmp_path.joinpath('ref'),
+                                  outlier_kwd, fill_strategy=fill_strategy,
+                                  **t_kwd)
+        for b_name in ['offsets_az', 'offsets_rg', 'g_offsets_az',
+                       'g_offsets_rg']:
+            np.testing.assert_array_equal(
+                getattr(OffsetsLayer(tmp_path.joinpath('out')), b_name),
+                getattr(OffsetsLayer(tmp_path.joinpath('ref')), b_name))
+        return cache.stats
+
+    stats = run('intermediate')
+    assert stats['outliers_mask'] == {'hits': 0, 'misses': 9}
+    assert stats['filled_bands'] == {'hits': 0, 'misses': 9}
+    # - new strategy - outlier masks are reused
+    stats = run('median')
+    assert stats['outliers_mask'] == {'hits': 9, 'misses': 0}
+    assert stats['filled_bands'] == {'hits': 0, 'misses': 9}
+    # - the low-resolution layer is not used by the median strategy
+    write_random_layer(l_paths[2], shape, rng)
+    stats = run('median')
+    assert stats['filled_bands'] == {'hits': 9, 'misses': 0}
+    # - intermediate layer updated in the first tile only (+ halo)
+    ir_values = np.memmap(l_paths[1].joinpath('dense_offsets'),
+                          dtype=np.float32, mode='r+', shape=shape + (2,))
+    ir_values[:5, :5] += 1.
+    ir_values.flush()
+    del ir_values
+    stats = run('median')
+    assert stats['outliers_mask'] == {'hits': 9, 'misses': 0}
+    assert stats['filled_bands'] == {'hits': 8, 'misses': 1}
+    f_key = [k.stem for k in c_path.glob('filled_bands_*.json')][0]
+    assert ResultCache(c_path).inputs(f_key)['params']['fill_strategy'] \
+        in ['intermediate', 'median']
+
+
+def test_fill_outliers_holes_profiling(tmp_path: pathlib.Path):
+    """Verify that the blending stages are recorded"""
+    rng = np.random.default_rng(3)
+    l_paths = [write_random_layer(tmp_path.joinpath(f'layer{n}'), (30, 20),
+                                  rng) for n in range(1, 4)]
+    with StageProfiler() as profiler:
+        layers = [OffsetsLayer(p, lazy=True) for p in l_paths]
+        fill_outliers_holes(*layers, {'metric': 'median_filter',
+                                      'threshold': 5., 'window_az': 5,
+                                      'window_rg': 5},
+                            fill_strategy='median', krn_size=(3, 3))
+        layers[0].write(tmp_path.joinpath('out'), out_format='ENVI')
+    summary = profiler.summary()
+    assert summary['median_filter']['count'] == 2
+    assert summary['median_filter_at']['count'] == 4
+    for s_name in ['read_bands', 'identify_outliers', 'fill_outliers_holes',
+                   'write_block', 'close_raster', 'write_layer']:
+        assert summary[s_name]['count'] > 0
+        assert summary[s_name]['wall_time'] > 0.
@@ -0,0 +1,410 @@
+#!/usr/bin/python
+"""
+Test - OffsetsLayer band loading
+
+UPDATE HISTORY:
+
+"""
+import os
+import copy
+import pathlib
+import numpy as np
+import pytest
+from pytest import MonkeyPatch
+import offsets_layer
+from offsets_layer import OffsetsLayer, LAYER_BANDS
+from utils.raster_io import read_raster_bands
+from utils.layer_store import LayerStore
+from utils.result_cache import ResultCache
+from utils.profiling import StageProfiler
+from utils.synthetic_layers import write_envi_raster
+
+rester_dim = (30, 40)
+
+
+class _FakeBand:
+    def __init__(self, values: np.ndarray):
+        self._values = values
+
+    def ReadAsArray(self):
+        return self._values.copy()
+
+
+class _FakeDataset:
+    """Stand-in for gdal.Dataset - returns constant band values"""
+    def __init__(self, f_path: str, reads: list):
+        self._f_name = os.path.basename(f_path)
+        self._reads = reads
+        self.RasterYSize, self.RasterXSize = rester_dim
+
+    def GetRasterBand(self, b_num: int):
+        self._reads.append((self._f_name, b_num))
+        return _FakeBand(np.full(rester_dim, float(b_num)))
+
+    def ReadAsArray(self, band_list: list):
+        return np.stack([self.GetRasterBand(b_num).ReadAsArray()
+                         for b_num in band_list])
+
+
+def make_layer_dir(d_path: pathlib.Path) -> pathlib.Path:
+    """Write minimal headers for the layer files"""
+    for f_name in {f for f, _ in LAYER_BANDS.values()}:
+        with open(d_path.joinpath(f'{f_name}.hdr'), 'w',
+                  encoding='utf8') as h_fid:
+            h_fid.write('ENVI\n')
+            h_fid.write(f'samples = {rester_dim[1]}\n')
+            h_fid.write(f'lines = {rester_dim[0]}\n')
+    return d_path
+
+
+def test_lazy_loading(monkeypatch: MonkeyPatch, tmp_path: pathlib.Path):
+    """Verify that bands are read only when accessed"""
+    reads = []
+    monkeypatch.setattr(offsets_layer.gdal, 'Open',
+                        lambda f_path, mode: _FakeDataset(f_path, reads))
+    layer = OffsetsLayer(make_layer_dir(tmp_path), lazy=True)
+    assert layer.size == rester_dim
+    assert not reads and not layer.loaded_bands
+
+    assert np.all(layer.snr == 1.)
+    assert np.all(layer.cov_rg == 2.)
+    assert reads == [('snr', 1), ('covariance', 2)]
+    assert layer.loaded_bands == ['snr', 'cov_rg']
+
+    # - release and read again
+    layer.release('snr')
+    assert layer.loaded_bands == ['cov_rg']
+    assert np.all(layer.snr == 1.)
+    assert len(reads) == 3
+
+    with pytest.raises(ValueError):
+        layer.release('not_a_band')
+
+
+def test_eager_loading(monkeypatch: MonkeyPatch, tmp_path: pathlib.Path):
+    """Verify that all bands are read at initialization by default"""
+    reads = []
+    monkeypatch.setattr(offsets_layer.gdal, 'Open',
+                        lambda f_path, mode: _FakeDataset(f_path, reads))
+    layer = OffsetsLayer(make_layer_dir(tmp_path))
+    assert len(reads) == len(LAYER_BANDS)
+    assert layer.loaded_bands == list(LAYER_BANDS)
+    assert layer.size == rester_dim
+
+
+@pytest.mark.parametrize('copy_func', [copy.copy, copy.deepcopy])
+def test_copy_on_write(monkeypatch: MonkeyPatch, tmp_path: pathlib.Path,
+                       copy_func):
+    """Verify that layer copies share bands until they are modified"""
+    reads = []
+    monkeypatch.setattr(offsets_layer.gdal, 'Open',
+                        lambda f_path, mode: _FakeDataset(f_path, reads))
+    layer = OffsetsLayer(make_layer_dir(tmp_path))
+    n_reads = len(reads)
+    layer_c = copy_func(layer)
+    assert isinstance(layer_c, OffsetsLayer)
+    assert len(reads) == n_reads
+    assert np.shares_memory(layer._offsets_az, layer_c.offsets_az)
+
+    # - shared bands are read-only
+    with pytest.raises(ValueError):
+        layer_c.offsets_az[0, 0] = 10.
+    layer_c.writable('offsets_az')
+    layer_c.offsets_az[0, 0] = 10.
+    assert layer.offsets_az[0, 0] == 1.
+    assert not np.shares_memory(layer.offsets_az, layer_c.offsets_az)
+    # - setters replace the shared band
+    layer_c.snr = np.zeros(rester_dim)
+    assert np.all(layer.snr == 1.)
+    # - masking the original does not affect the copy
+    layer.mask_outliers(np.ones(rester_dim))
+    assert np.isnan(layer.cov_az).all()
+    assert np.all(layer_c.cov_az == 1.)
+
+
+@pytest.mark.parametrize('copy_func', [copy.copy, copy.deepcopy])
+def test_copy_source_writable(monkeypatch: MonkeyPatch,
+                              tmp_path: pathlib.Path, copy_func):
+    """Verify that the original layer stays writable after a copy"""
+    monkeypatch.setattr(offsets_layer.gdal, 'Open',
+                        lambda f_path, mode: _FakeDataset(f_path, []))
+    layer = OffsetsLayer(make_layer_dir(tmp_path))
+    layer_c = copy_func(layer)
+    layer.offsets_az[0, 0] = 10.
+    assert layer.offsets_az[0, 0] == 10.
+    assert layer_c.offsets_az[0, 0] == 1.
+    layer.writable('snr')
+    layer.snr[0, 0] = 10.
+    assert layer_c.snr[0, 0] == 1.
+    # - the copy is still read-only
+    with pytest.raises(ValueError):
+        layer_c.offsets_az[0, 0] = 10.
+
+
+@pytest.mark.parametrize('interleave, byte_order',
+                         [('bip', 0), ('bil', 0), ('bsq', 0), ('bip', 1)])
+def test_memmap_reader(tmp_path: pathlib.Path, interleave: str,
+                       byte_order: int):
+    """Verify that memory-mapped bands match the GDAL reader"""
+    rng = np.random.default_rng(0)
+    values = {}
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        values[f_name] = rng.normal(size=(len(b_names),) + rester_dim)
+        write_envi_raster(tmp_path.joinpath(f_name), values[f_name],
+                          interleave, byte_order=byte_order)
+    window = (5, 3, 20, 12)
+    for l_window in [None, window]:
+        m_layer = OffsetsLayer(tmp_path, reader='memmap', window=l_window)
+        g_layer = OffsetsLayer(tmp_path, reader='gdal', window=l_window)
+        for b_name in LAYER_BANDS:
+            assert isinstance(m_layer._get_band(b_name), np.memmap)
+            np.testing.assert_array_equal(getattr(m_layer, b_name),
+                                          getattr(g_layer, b_name))
+    # - mapped bands are copied before being modified
+    m_layer.mask_outliers(np.ones(m_layer.size))
+    assert np.isnan(m_layer.offsets_az).all()
+    np.testing.assert_array_equal(OffsetsLayer(tmp_path, reader='memmap')
+                                  .offsets_az,
+                                  values['dense_offsets'][0]
+                                  .astype(np.float32))
+
+
+@pytest.mark.parametrize('interleave, byte_order',
+                         [('bip', 0), ('bil', 0), ('bsq', 0), ('bip', 1)])
+def test_single_pass_reader(tmp_path: pathlib.Path, interleave: str,
+                            byte_order: int):
+    """Verify that bands read in a single pass match the GDAL band reads"""
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(3,) + rester_dim)
+    f_path = tmp_path.joinpath('raster')
+    write_envi_raster(f_path, values, interleave, byte_order=byte_order)
+    for window in [None, (5, 3, 20, 12)]:
+        w_args = () if window is None else window
+        ds = offsets_layer.gdal.Open(str(f_path))
+        for block_rows in [7, 256]:
+            b_arrays = read_raster_bands(f_path, [3, 1], window=window,
+                                         dtypes=[np.float32, np.float16],
+                                         block_rows=block_rows)
+            assert [b.dtype for b in b_arrays] == [np.float32, np.float16]
+            for b_num, b_array in zip([3, 1], b_arrays):
+                np.testing.assert_array_equal(
+                    b_array, ds.GetRasterBand(b_num).ReadAsArray(*w_args)
+                    .astype(b_array.dtype))
+
+
+def test_read_bands_profiling(tmp_path: pathlib.Path):
+    """Verify that the bytes read by the read stages are recorded"""
+    rng = np.random.default_rng(0)
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        write_envi_raster(tmp_path.joinpath(f_name),
+                          rng.normal(size=(len(b_names),) + rester_dim), 'bip')
+    with StageProfiler() as profiler:
+        OffsetsLayer(tmp_path)
+    records = [r for r in profiler.records if r['stage'] == 'read_bands']
+    assert len(records) == len(offsets_layer.LAYER_FILES)
+    if records[0]['bytes_read'] is None:
+        pytest.skip('bytes read not available on this platform')
+    for rec in records:
+        f_bands = offsets_layer.LAYER_FILES[rec['info']['file']]
+        assert rec['bytes_read'] >= len(f_bands) * np.prod(rester_dim) * 4
+
+
+def test_layer_store(tmp_path: pathlib.Path):
+    """Verify that layers attach the bands of a process-shared store"""
+    rng = np.random.default_rng(0)
+    l_path = tmp_path.joinpath('layer')
+    os.makedirs(l_path)
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        write_envi_raster(l_path.joinpath(f_name),
+                          rng.normal(size=(len(b_names),) + rester_dim), 'bip')
+    window = (5, 3, 20, 12)
+    with LayerStore(tmp_path.joinpath('store')) as store:
+        s_layer = OffsetsLayer(l_path, store=store)
+        w_layer = OffsetsLayer(l_path, store=store, lazy=True,
+                               window=window)
+        for b_name in LAYER_BANDS:
+            np.testing.assert_array_equal(
+                getattr(w_layer, b_name),
+                getattr(OffsetsLayer(l_path, window=window), b_name))
+            # - read-only views of the same stored band
+            b_map = w_layer._get_band(b_name)
+            assert isinstance(b_map, np.memmap)
+            assert b_map.filename == s_layer._get_band(b_name).filename
+        assert store.stats == {'loaded': len(LAYER_BANDS),
+                               'attached': len(LAYER_BANDS)}
+        # - shared bands are copied before being modified
+        w_layer.mask_outliers(np.ones(w_layer.size))
+        assert np.isnan(w_layer.offsets_az).all()
+        assert not np.isnan(s_layer.offsets_az).any()
+    assert store.nbytes == 0
+
+
+@pytest.mark.parametrize('out_format', ['ENVI', 'GTiff', 'COG'])
+def test_write(tmp_path: pathlib.Path, out_format: str):
+    """Verify that written layers match the in-memory bands"""
+    rng = np.random.default_rng(0)
+    in_path = tmp_path.joinpath('layer')
+    in_path.mkdir()
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        write_envi_raster(in_path.joinpath(f_name),
+                          rng.normal(size=(len(b_names),) + rester_dim), 'bip')
+    layer = OffsetsLayer(in_path)
+    layer.mask_outliers(np.eye(*rester_dim))
+    f_paths = layer.write(tmp_path.joinpath('out'), out_format=out_format,
+                          block_size=16)
+    assert len(f_paths) == len(offsets_layer.LAYER_FILES)
+    for f_path, (f_name, b_names) in zip(f_paths,
+                                         offsets_layer.LAYER_FILES.items()):
+        ds = offsets_layer.gdal.Open(str(f_path))
+        for b_num, b_name in enumerate(b_names, start=1):
+            np.testing.assert_array_equal(
+                ds.GetRasterBand(b_num).ReadAsArray(),
+                getattr(layer, b_name).astype(np.float32))
+        if out_format != 'ENVI':
+            assert f_path.suffix == '.tif'
+            assert ds.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'] \
+                == 'DEFLATE'
+            band = ds.GetRasterBand(1)
+            assert band.GetBlockSize() == [16, 16]
+            assert band.GetOverviewCount() == 2
+            assert np.isnan(band.GetNoDataValue())
+        ds = None
+    assert not list(tmp_path.joinpath('out').glob('*.tmp.tif'))
+
+
+@pytest.mark.parametrize('metric', ['snr', 'covariance', 'median_filter'])
+def test_sweep_thresholds(tmp_path: pathlib.Path, metric: str):
+    """Verify that the threshold sweep matches identify_outliers"""
+    rng = np.random.default_rng(0)
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        values = rng.gamma(2., size=(len(b_names),) + rester_dim)
+        values[:, 3, 4] = np.nan
+        write_envi_raster(tmp_path.joinpath(f_name), values, 'bip')
+    layer = OffsetsLayer(tmp_path)
+    thresholds = [3., 0.5, 1., 2.]
+    o_kwd = {'window_az': 5, 'window_rg': 7}
+    sweep = layer.sweep_thresholds(thresholds, metric=metric, masks=True,
+                                   **o_kwd)
+    np.testing.assert_array_equal(sweep['thresholds'], sorted(thresholds))
+    for n_thr, thr in enumerate(sweep['thresholds']):
+        o_mask = layer.identify_outliers(metric=metric, threshold=thr,
+                                         **o_kwd)['outliers_mask']
+        assert sweep['counts'][n_thr] == o_mask.count
+        np.testing.assert_array_equal(sweep['masks'][n_thr], o_mask)
+        if metric == 'snr':
+            f_mask = sweep['flag_threshold'] <= thr
+        else:
+            f_mask = sweep['flag_threshold'] >= thr
+        np.testing.assert_array_equal(f_mask, o_mask)
+
+
+@pytest.mark.parametrize('metric', ['mad', 'sigma_clip'])
+def test_normalized_metrics(tmp_path: pathlib.Path, metric: str):
+    """Verify that normalized metrics flag the same relative deviation
+    whatever the local noise level"""
+    rng = np.random.default_rng(0)
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        values = rng.normal(size=(len(b_names),) + rester_dim)
+        if f_name == 'dense_offsets':
+            # - noise level 10 times larger on the right half
+            values[:, :, rester_dim[1] // 2:] *= 10.
+            values[0, 10, 5] = values[0, 10, 30] = np.nan
+            values[0, 15, 5] += 8.
+            values[1, 15, 30] += 80.
+        write_envi_raster(tmp_path.joinpath(f_name), values, 'bip')
+    layer = OffsetsLayer(tmp_path)
+    o_kwd = {'metric': metric, 'threshold': 5., 'window_az': 11,
+             'window_rg': 11}
+    o_mask = layer.identify_outliers(**o_kwd)['outliers_mask']
+    assert o_mask[15, 5] and o_mask[15, 30]
+    assert not o_mask[10, 5] and not o_mask[10, 30]
+    # - the absolute deviation flags the noisy half only
+    a_mask = layer.identify_outliers(**{**o_kwd, 'metric': 'median_filter'})
+    assert a_mask['outliers_mask'].to_bool()[:, rester_dim[1] // 2:].sum() \
+        > 10 * o_mask.count
+
+
+def test_qa_figures(tmp_path: pathlib.Path):
+    """Verify that QA figures are saved without pyplot"""
+    import sys
+    import subprocess
+    # - compute-only import of the layer class does not load matplotlib
+    code = 'import sys, offsets_layer; ' \
+           'assert "matplotlib" not in sys.modules'
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   cwd=pathlib.Path(offsets_layer.__file__).parent)
+
+    from utils.qa_plots import FigureExporter
+    rng = np.random.default_rng(0)
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        write_envi_raster(tmp_path.joinpath(f_name),
+                          rng.normal(size=(len(b_names),) + rester_dim), 'bip')
+    layer = OffsetsLayer(tmp_path, lazy=True)
+    for executor in ['thread', 'process']:
+        with FigureExporter(executor=executor) as exporter:
+            layer.show_offsets(tmp_path.joinpath(f'{executor}_off.png'),
+                               max_size=16, exporter=exporter)
+            layer.plot_offsets_distribution(
+                tmp_path.joinpath(f'{executor}_dist.png'), exporter=exporter)
+        assert tmp_path.joinpath(f'{executor}_off.png').stat().st_size > 0
+        assert tmp_path.joinpath(f'{executor}_dist.png').stat().st_size > 0
+    assert 'matplotlib.pyplot' not in sys.modules
+
+
+@pytest.mark.parametrize('reader', ['gdal', 'memmap'])
+def test_quality_dtype(tmp_path: pathlib.Path, reader: str):
+    """Verify the bands data type policy and that statistics are computed
+    in float32"""
+    rng = np.random.default_rng(0)
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        values = rng.gamma(2., size=(len(b_names),) + rester_dim)
+        values[:, 3, 4] = np.nan
+        write_envi_raster(tmp_path.joinpath(f_name), values, 'bip')
+    layer = OffsetsLayer(tmp_path, reader=reader)
+    h_layer = OffsetsLayer(tmp_path, reader=reader, quality_dtype='float16')
+    for b_name in LAYER_BANDS:
+        assert getattr(layer, b_name).dtype == np.float32
+        assert getattr(h_layer, b_name).dtype == h_layer.band_dtype(b_name)
+    assert h_layer.snr.dtype == h_layer.cov_az.dtype == np.float16
+    assert h_layer.offsets_az.dtype == np.float32
+    for metric in ['snr', 'covariance', 'median_filter', 'mad',
+                   'sigma_clip']:
+        statistic, _ = layer.outlier_statistic(metric, window_az=5,
+                                               window_rg=5)
+        assert statistic.dtype == np.float32
+    # - half precision quality bands
+    np.testing.assert_allclose(h_layer.outlier_statistic('covariance')[0],
+                               layer.outlier_statistic('covariance')[0],
+                               rtol=1e-3)
+    h_layer.mask_outliers(np.eye(*rester_dim))
+    f_paths = h_layer.write(tmp_path.joinpath('out'), out_format='ENVI')
+    ds = offsets_layer.gdal.Open(str(f_paths[2]))
+    np.testing.assert_array_equal(ds.GetRasterBand(1).ReadAsArray(),
+                                  h_layer.snr.astype(np.float32))
+    with pytest.raises(ValueError):
+        OffsetsLayer(tmp_path, quality_dtype='int8')
+
+
+def test_quality_dtype_cache(tmp_path: pathlib.Path):
+    """Verify that cached results are not shared between quality bands
+    data types"""
+    for f_name, b_names in offsets_layer.LAYER_FILES.items():
+        # - SNR below the threshold in float32, rounded above it in
+        # - float16
+        write_envi_raster(tmp_path.joinpath(f_name),
+                          np.full((len(b_names),) + rester_dim, 1.0007),
+                          'bip')
+    cache = ResultCache(tmp_path.joinpath('cache'))
+    n_outliers = {}
+    for quality_dtype in ['float32', 'float16', 'float32']:
+        layer = OffsetsLayer(tmp_path, quality_dtype=quality_dtype)
+        reference = layer.identify_outliers(metric='snr', threshold=1.0008)
+        outliers = layer.identify_outliers(metric='snr', threshold=1.0008,
+                                           cache=cache)
+        assert outliers['outliers_mask'].count \
+            == reference['outliers_mask'].count
+        n_outliers[quality_dtype] = outliers['outliers_mask'].count
+    assert n_outliers == {'float32': rester_dim[0] * rester_dim[1],
+                          'float16': 0}
+    assert OffsetsLayer(tmp_path).fingerprint('snr') \
+        != OffsetsLayer(tmp_path, quality_dtype='float16').fingerprint('snr')
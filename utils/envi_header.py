@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+u"""
+Read ENVI header files (.hdr).
+
+read_envi_header returns a typed EnviHeader model. Parsed headers are
+cached per path and refreshed when the header file changes, so raster
+metadata (shape, data type, georeferencing) can be queried repeatedly
+without reading any pixel.
+"""
+# - python dependencies
+import os
+import pathlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+import numpy as np
+
+# - ENVI data type codes
+ENVI_DTYPES = {1: np.uint8, 2: np.int16, 3: np.int32, 4: np.float32,
+               5: np.float64, 6: np.complex64, 9: np.complex128,
+               12: np.uint16, 13: np.uint32, 14: np.int64, 15: np.uint64}
+
+
+@dataclass(frozen=True)
+class MapInfo:
+    """ENVI map info - georeferencing of the raster grid"""
+    projection: str                 # - Projection name
+    ref_pixel: tuple                # - Reference pixel (x, y) - 1-based
+    ref_coords: tuple               # - Reference pixel (easting, northing)
+    pixel_size: tuple               # - Pixel size (x, y)
+    zone: int = None                # - UTM zone
+    hemisphere: str = None          # - UTM hemisphere
+    datum: str = None               # - Datum
+    units: str = None               # - Map units
+    rotation: float = 0.            # - Grid rotation [deg]
+
+    @property
+    def geotransform(self) -> tuple:
+        """GDAL-style geotransform of the grid (top-left pixel corner)"""
+        x_size, y_size = self.pixel_size
+        rot = np.deg2rad(self.rotation)
+        cos_r, sin_r = np.cos(rot), np.sin(rot)
+        # - pixel (col, row) -> map coordinates
+        gt_1, gt_2 = x_size * cos_r, y_size * sin_r
+        gt_4, gt_5 = x_size * sin_r, -y_size * cos_r
+        d_col, d_row = self.ref_pixel[0] - 1., self.ref_pixel[1] - 1.
+        gt_0 = self.ref_coords[0] - d_col * gt_1 - d_row * gt_2
+        gt_3 = self.ref_coords[1] - d_col * gt_4 - d_row * gt_5
+        return gt_0, gt_1, gt_2, gt_3, gt_4, gt_5
+
+
+@dataclass(frozen=True)
+class EnviHeader:
+    """ENVI header model"""
+    samples: int                    # - Number of columns
+    lines: int                      # - Number of rows
+    bands: int = 1                  # - Number of bands
+    data_type: int = 4              # - ENVI data type code
+    interleave: str = 'bsq'         # - Band interleave [bsq, bil, bip]
+    byte_order: int = 0             # - 0 -> little endian, 1 -> big endian
+    header_offset: int = 0          # - Header bytes before the data
+    file_type: str = 'ENVI Standard'
+    description: str = ''
+    band_names: tuple = ()
+    map_info: MapInfo = None
+    fields: dict = field(default_factory=dict, compare=False)  # - Raw
+
+    @property
+    def shape(self) -> tuple:
+        """Raster shape (rows, columns)"""
+        return self.lines, self.samples
+
+    @property
+    def dtype(self) -> np.dtype:
+        """Raster data type - byte order included"""
+        return np.dtype(ENVI_DTYPES[self.data_type])\
+            .newbyteorder('>' if self.byte_order == 1 else '<')
+
+    @property
+    def nbytes(self) -> int:
+        """Raster data size [bytes]"""
+        return self.samples * self.lines * self.bands * self.dtype.itemsize
+
+    @property
+    def geotransform(self) -> tuple:
+        """GDAL-style geotransform - None if map info is not available"""
+        return None if self.map_info is None else self.map_info.geotransform
+
+
+def parse_envi_header(hdr_path: pathlib.Path) -> dict:
+    """
+    Parse an ENVI header file.
+    Keys are lower-case, values are stripped strings. Values enclosed in
+    braces can span multiple lines: braces are removed and lines joined.
+    :param hdr_path: absolute path to the header file
+    :return: header key/value pairs - dict
+    """
+    header = {}
+    with open(hdr_path, 'r', encoding='utf8') as h_fid:
+        h_lines = h_fid.read().splitlines()
+    if not h_lines or h_lines[0].strip() != 'ENVI':
+        raise ValueError(f': {hdr_path} is not a valid ENVI header')
+    key = None
+    value = ''
+    for ln in h_lines[1:]:
+        if key is not None:
+            # - multi-line value
+            value += ' ' + ln.strip()
+        elif '=' in ln:
+            key, value = (s.strip() for s in ln.split('=', 1))
+            key = key.lower()
+        else:
+            continue
+        if value.startswith('{') and not value.endswith('}'):
+            continue
+        if value.startswith('{'):
+            value = value[1:-1].strip()
+        header[key] = value
+        key = None
+    return header
+
+
+def parse_map_info(map_info: str) -> MapInfo:
+    """
+    Parse the value of the ENVI 'map info' field.
+    :param map_info: map info value - braces removed - str
+    :return: MapInfo
+    """
+    items = [s.strip() for s in map_info.split(',')]
+    keywords = {}
+    for item in [s for s in items if '=' in s]:
+        key, value = (s.strip() for s in item.split('=', 1))
+        keywords[key.lower()] = value
+    items = [s for s in items if '=' not in s]
+    zone, hemisphere = None, None
+    datum = items[7] if len(items) > 7 else None
+    if items[0].upper() == 'UTM' and len(items) > 9:
+        zone, hemisphere, datum = int(items[7]), items[8], items[9]
+    return MapInfo(projection=items[0],
+                   ref_pixel=(float(items[1]), float(items[2])),
+                   ref_coords=(float(items[3]), float(items[4])),
+                   pixel_size=(float(items[5]), float(items[6])),
+                   zone=zone, hemisphere=hemisphere, datum=datum,
+                   units=keywords.get('units'),
+                   rotation=float(keywords.get('rotation', 0.)))
+
+
+def read_envi_header(hdr_path: pathlib.Path) -> EnviHeader:
+    """
+    Read an ENVI header file - cached, refreshed if the file changes.
+    :param hdr_path: absolute path to the header file
+    :return: EnviHeader
+    """
+    h_stat = os.stat(hdr_path)
+    return _read_envi_header(os.path.abspath(hdr_path), h_stat.st_mtime_ns,
+                             h_stat.st_size)
+
+
+@lru_cache(maxsize=1024)
+def _read_envi_header(hdr_path: str, mtime_ns: int,
+                      size: int) -> EnviHeader:
+    """Parse an ENVI header file - modification time and size are part of
+    the cache key"""
+    fields = parse_envi_header(hdr_path)
+    try:
+        map_info = parse_map_info(fields['map info']) \
+            if 'map info' in fields else None
+    except (ValueError, IndexError):
+        map_info = None
+    band_names = tuple(s.strip() for s in fields['band names'].split(',')) \
+        if 'band names' in fields else ()
+    return EnviHeader(samples=int(fields['samples']),
+                      lines=int(fields['lines']),
+                      bands=int(fields.get('bands', 1)),
+                      data_type=int(fields.get('data type', 4)),
+                      interleave=fields.get('interleave', 'bsq').lower(),
+                      byte_order=int(fields.get('byte order', 0)),
+                      header_offset=int(fields.get('header offset', 0)),
+                      file_type=fields.get('file type', 'ENVI Standard'),
+                      description=fields.get('description', ''),
+                      band_names=band_names, map_info=map_info,
+                      fields=fields)
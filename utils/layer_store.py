@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+u"""
+Process-shared store of offsets layer bands.
+
+Bands are stored as .npy files in a node-local directory (by default in
+shared memory, /dev/shm) and attached memory-mapped and read-only: the
+first process that needs a band loads it, the others map the same pages.
+Node memory scales with the number of distinct bands, not with the number
+of worker processes.
+
+Each store attaching a band records a reference marker next to it,
+until the store is closed (or the interpreter exits). A band is removed
+when no live store references it. Markers of processes that were
+killed without releasing their bands are ignored and removed by
+cleanup().
+"""
+# - python dependencies
+import os
+import json
+import weakref
+import hashlib
+import pathlib
+import tempfile
+import uuid
+import threading
+from contextlib import contextmanager, ExitStack
+import numpy as np
+try:
+    import fcntl
+except ImportError:             # - not available on Windows
+    fcntl = None
+
+
+def default_store_dir() -> pathlib.Path:
+    """Default store directory - shared memory if available"""
+    root = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return pathlib.Path(root, 'offsets_blending_store')
+
+
+def _pid_alive(pid: int) -> bool:
+    """Return True if the selected process is running"""
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class LayerStore:
+    """Share read-only layer bands between processes.
+    ...
+
+    Parameters
+    ----------
+    :param store_dir - pathlib.Path - store directory, node-local.
+        None: default_store_dir().
+
+    Attributes
+    ----------
+    store_dir       # - Store directory
+    nbytes          # - Memory used by the stored bands [bytes]
+    stats           # - Bands loaded and attached by this store
+
+    Methods
+    -------
+    key - Store key of a raster band.
+    attach - Return the selected bands of a raster - memory-mapped,
+        read-only. Missing bands are loaded once, by a single process.
+    refs - Number of live stores referencing a band.
+    close - Release the references of this store.
+    cleanup - Remove the bands no live process references.
+    clear - Remove all the stored bands.
+
+    Bands are identified by the real path, size and modification time of
+    their raster file and by their storage data type. Mapped bands stay
+    valid after close(): the memory is returned to the system when the
+    last mapping is released.
+    """
+    def __init__(self, store_dir: pathlib.Path = None) -> None:
+        self._store_dir = pathlib.Path(store_dir) if store_dir is not None \
+            else default_store_dir()
+        self._pid = os.getpid()
+        # - reference marker id - process id + store instance
+        self._ref_id = f'{self._pid}-{uuid.uuid4().hex[:8]}'
+        self._held = set()           # - Keys referenced by this store
+        self._stats = {'loaded': 0, 'attached': 0}
+        self._lock = threading.Lock()
+        os.makedirs(self._store_dir, exist_ok=True)
+        # - references are released at interpreter exit
+        self._finalizer = weakref.finalize(self, _release, self._store_dir,
+                                           self._ref_id, self._held)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def store_dir(self) -> pathlib.Path:
+        """Store directory"""
+        return self._store_dir
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the stored bands [bytes]"""
+        return sum(f.stat().st_size for f in self._store_dir.glob('*.npy'))
+
+    @property
+    def stats(self) -> dict:
+        """Bands loaded and attached by this store - dict"""
+        with self._lock:
+            return dict(self._stats)
+
+    @staticmethod
+    def key(f_path: pathlib.Path, b_num: int, dtype) -> str:
+        """
+        Store key of a raster band.
+        :param f_path: raster path
+        :param b_num: band number (1-based)
+        :param dtype: storage data type
+        :return: key - str
+        """
+        # - rasters linked from several directories share their bands
+        f_stat = os.stat(f_path)
+        k_str = json.dumps([os.path.realpath(f_path), f_stat.st_size,
+                            f_stat.st_mtime_ns, b_num, np.dtype(dtype).str])
+        return f'band_{hashlib.sha1(k_str.encode()).hexdigest()}'
+
+    def attach(self, f_path: pathlib.Path, bands: list, dtypes: list,
+               loader) -> list:
+        """
+        Return the selected bands of a raster - memory-mapped, read-only.
+        Bands not yet in the store are loaded with a single loader call
+        and stored; concurrent callers wait for them instead of loading
+        them again.
+        :param f_path: raster path
+        :param bands: band numbers (1-based) - list
+        :param dtypes: storage data type of each band - list
+        :param loader: callable(bands, dtypes) -> list of np.ndarray -
+            reads the selected bands of the full raster
+        :return: band views - list of np.memmap
+        """
+        keys = [self.key(f_path, b_num, dt)
+                for b_num, dt in zip(bands, dtypes)]
+        with ExitStack() as locks:
+            # - locks are always acquired in the same order
+            for key in sorted(set(keys)):
+                locks.enter_context(_key_lock(self._store_dir, key))
+            missing = [i for i, key in enumerate(keys)
+                       if not _entry_path(self._store_dir, key).is_file()]
+            if missing:
+                b_arrays = loader([bands[i] for i in missing],
+                                  [dtypes[i] for i in missing])
+                for i, b_array in zip(missing, b_arrays):
+                    t_path = self._store_dir\
+                        .joinpath(f'{keys[i]}.{os.getpid()}.tmp')
+                    with open(t_path, 'wb') as t_fid:
+                        np.save(t_fid, np.asarray(b_array, dtype=dtypes[i]))
+                    os.replace(t_path, _entry_path(self._store_dir, keys[i]))
+                del b_arrays
+            with self._lock:
+                for key in set(keys) - self._held:
+                    _ref_path(self._store_dir, key, self._ref_id).touch()
+                    self._held.add(key)
+                self._stats['loaded'] += len(missing)
+                self._stats['attached'] += len(keys) - len(missing)
+            return [np.load(_entry_path(self._store_dir, key), mmap_mode='r')
+                    for key in keys]
+
+    def refs(self, key: str) -> int:
+        """
+        Number of live stores (in any process) referencing a band.
+        :param key: store key
+        :return: int
+        """
+        return _live_refs(self._store_dir, key)
+
+    def close(self) -> None:
+        """
+        Release the references of this store - bands no other store
+        references are removed.
+        :return: None
+        """
+        if os.getpid() == self._pid:
+            self._finalizer()
+
+    def cleanup(self) -> None:
+        """Remove the bands and the markers of processes no longer running"""
+        for r_path in self._store_dir.glob('*.ref'):
+            if not _pid_alive(_file_pid(r_path)):
+                _remove(r_path)
+        for e_path in self._store_dir.glob('*.npy'):
+            with _key_lock(self._store_dir, e_path.stem):
+                if _live_refs(self._store_dir, e_path.stem) == 0:
+                    _remove(e_path)
+        for t_path in self._store_dir.glob('*.tmp'):
+            if not _pid_alive(_file_pid(t_path)):
+                _remove(t_path)
+
+    def clear(self) -> None:
+        """Remove all the stored bands - mapped bands stay valid"""
+        for f_path in self._store_dir.iterdir():
+            if f_path.suffix in ('.npy', '.ref', '.tmp', '.lock'):
+                _remove(f_path)
+
+
+def _entry_path(store_dir: pathlib.Path, key: str) -> pathlib.Path:
+    return store_dir.joinpath(f'{key}.npy')
+
+
+def _ref_path(store_dir: pathlib.Path, key: str,
+              ref_id: str) -> pathlib.Path:
+    return store_dir.joinpath(f'{key}.{ref_id}.ref')
+
+
+def _file_pid(f_path: pathlib.Path) -> int:
+    """Process id recorded in a reference or temporary file name"""
+    return int(f_path.suffixes[-2][1:].split('-')[0])
+
+
+def _live_refs(store_dir: pathlib.Path, key: str) -> int:
+    """Number of live stores referencing a band"""
+    return sum(_pid_alive(_file_pid(r_path))
+               for r_path in store_dir.glob(f'{key}.*.ref'))
+
+
+@contextmanager
+def _key_lock(store_dir: pathlib.Path, key: str):
+    """Exclusive access to a key - across threads and processes"""
+    if fcntl is None:
+        yield
+        return
+    with open(store_dir.joinpath(f'{key}.lock'), 'a') as l_fid:
+        fcntl.flock(l_fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(l_fid, fcntl.LOCK_UN)
+
+
+def _release(store_dir: pathlib.Path, ref_id: str, held: set) -> None:
+    """Release the references of a store - remove unreferenced bands"""
+    for key in sorted(held):
+        try:
+            with _key_lock(store_dir, key):
+                _remove(_ref_path(store_dir, key, ref_id))
+                if _live_refs(store_dir, key) == 0:
+                    _remove(_entry_path(store_dir, key))
+        except OSError:
+            # - the store directory was removed
+            pass
+    held.clear()
+
+
+def _remove(f_path: pathlib.Path) -> None:
+    try:
+        os.remove(f_path)
+    except FileNotFoundError:
+        pass
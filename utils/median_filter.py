@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+u"""
+Windowed median filters for large kernel sizes.
+
+Available engines:
+- scipy: scipy.ndimage.median_filter - exact, reference implementation.
+- separable: 1D median along range followed by 1D median along azimuth.
+    Approximate, cost grows with kernel height + width instead of
+    kernel area.
+- histogram: sliding-histogram median computed on values quantized to
+    n_levels levels. Exact up to half a quantization step. One running
+    box sum over the array per occupied level, until every window median
+    is found: O(rows x cols x L), L <= n_levels the number of levels
+    scanned. The kernel size changes L (the spread of the window medians)
+    and the border padding of the box sums.
+All engines use the same window placement and border handling ('reflect')
+of scipy.ndimage.
+
+Invalid samples (NaN) are ignored: the median of each window is computed
+on its valid samples only, windows with fewer than min_valid valid
+samples are set to NaN and are not evaluated at all.
+
+median_filter_at evaluates the windowed median at selected pixels only
+(e.g. the outliers to fill) - its cost scales with the number of
+selected pixels instead of the array size.
+
+Robust local statistics (median absolute deviation, mean and standard
+deviation) are computed with the same windows.
+"""
+# - python dependencies
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage
+from utils.profiling import profiled
+
+MEDIAN_ENGINES = ('scipy', 'separable', 'histogram')
+# - MAD to standard deviation scale factor - normal distribution
+MAD_SCALE = 1.4826
+
+
+@profiled('median_filter')
+def median_filter(values: np.ndarray, size: tuple, engine: str = 'scipy',
+                  n_levels: int = 1024, min_valid: int = 1) -> np.ndarray:
+    """
+    Compute the windowed median of the input array.
+    :param values: input array - np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :param engine: median filter engine - see MEDIAN_ENGINES
+    :param n_levels: number of quantization levels - histogram engine only
+    :param min_valid: minimum number of valid samples per window
+    :return: median filtered array - np.ndarray
+    """
+    if engine not in MEDIAN_ENGINES:
+        raise ValueError(f'{engine} invalid median filter engine')
+    if engine == 'histogram':
+        return _histogram_median(values, size, n_levels=n_levels,
+                                 min_valid=min_valid)
+    valid = np.isfinite(values)
+    if valid.all():
+        if min_valid > size[0] * size[1]:
+            # - no window has enough valid samples
+            return np.full(values.shape, np.nan,
+                           dtype=np.result_type(values.dtype, np.float32))
+        if engine == 'scipy':
+            return ndimage.median_filter(values, size)
+        return _separable_median(values, size)
+
+    # - NaN-aware path - evaluate only windows with enough valid samples
+    eval_px = valid_count(valid, size) >= min_valid
+    if engine == 'scipy':
+        return _nan_rank_median(values, size, eval_px)
+    median_rg = _nan_rank_median(values, (1, size[1]),
+                                 valid_count(valid, (1, size[1])) > 0)
+    return _nan_rank_median(median_rg, (size[0], 1), eval_px)
+
+
+def median_filter_bands(bands: list, size: tuple, n_workers: int = 1,
+                        **kwargs) -> list:
+    """
+    Compute the windowed median of several bands. With n_workers > 1 the
+    bands are filtered concurrently on a thread pool - scipy.ndimage
+    releases the GIL while filtering.
+    :param bands: input arrays - list of np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :param n_workers: number of worker threads
+    :param kwargs: median_filter keywords (engine, n_levels, min_valid)
+    :return: median filtered arrays - list of np.ndarray
+    """
+    if n_workers <= 1 or len(bands) == 1:
+        return [median_filter(band, size, **kwargs) for band in bands]
+    with ThreadPoolExecutor(max_workers=min(n_workers, len(bands))) as pool:
+        return list(pool.map(lambda band: median_filter(band, size, **kwargs),
+                             bands))
+
+
+@profiled('median_filter_at')
+def median_filter_at(values: np.ndarray, size: tuple, index,
+                     engine: str = 'scipy', n_levels: int = 1024,
+                     min_valid: int = 1,
+                     tile_size: tuple = (256, 256)) -> np.ndarray:
+    """
+    Compute the windowed median of the input array at the selected pixels
+    only - same values as median_filter(values, ...)[index].
+    With the scipy engine, the windows centered on the selected pixels are
+    gathered in batches and their median computed directly. The other
+    engines filter the bounding boxes of the selected pixels falling in
+    each tile of tile_size, extended by the kernel half-size - tiles
+    without selected pixels are skipped. The histogram engine quantizes
+    values box by box, so its results can differ slightly from the
+    whole-array ones.
+    :param values: input array - np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :param index: selected pixels - np.where tuple or boolean mask
+    :param engine: median filter engine - see MEDIAN_ENGINES
+    :param n_levels: number of quantization levels - histogram engine only
+    :param min_valid: minimum number of valid samples per window
+    :param tile_size: tile size (azimuth, range) - scipy engine excluded
+    :return: median values at the selected pixels - 1D np.ndarray
+    """
+    if engine not in MEDIAN_ENGINES:
+        raise ValueError(f'{engine} invalid median filter engine')
+    rows, cols = np.nonzero(index) if isinstance(index, np.ndarray) \
+        else (np.asarray(index[0]), np.asarray(index[1]))
+    if engine == 'scipy':
+        return _window_median(values, size, rows, cols,
+                              min_valid=min_valid)
+
+    median = np.empty(rows.size,
+                      dtype=np.result_type(values.dtype, np.float32))
+    halo = (size[0] // 2, size[1] // 2)
+    # - group the selected pixels by tile
+    n_t_cols = -(-values.shape[1] // tile_size[1])
+    t_id = (rows // tile_size[0]) * n_t_cols + cols // tile_size[1]
+    order = np.argsort(t_id, kind='stable')
+    t_bounds = np.flatnonzero(np.diff(t_id[order])) + 1
+    for t_px in np.split(order, t_bounds):
+        if t_px.size == 0:
+            continue
+        t_rows, t_cols = rows[t_px], cols[t_px]
+        r_0 = max(t_rows.min() - halo[0], 0)
+        r_1 = min(t_rows.max() + halo[0] + 1, values.shape[0])
+        c_0 = max(t_cols.min() - halo[1], 0)
+        c_1 = min(t_cols.max() + halo[1] + 1, values.shape[1])
+        t_median = median_filter(np.asarray(values[r_0:r_1, c_0:c_1]),
+                                 size, engine=engine, n_levels=n_levels,
+                                 min_valid=min_valid)
+        median[t_px] = t_median[t_rows - r_0, t_cols - c_0]
+    return median
+
+
+def median_filter_bands_at(bands: list, size: tuple, index,
+                           n_workers: int = 1, **kwargs) -> list:
+    """
+    Compute the windowed median of several bands at the selected pixels
+    only - see median_filter_at. With n_workers > 1 the bands are
+    processed concurrently on a thread pool.
+    :param bands: input arrays - list of np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :param index: selected pixels - np.where tuple or boolean mask
+    :param n_workers: number of worker threads
+    :param kwargs: median_filter_at keywords
+    :return: median values at the selected pixels - list of 1D np.ndarray
+    """
+    if isinstance(index, np.ndarray):
+        index = np.nonzero(index)
+
+    def f_band(band):
+        return median_filter_at(band, size, index, **kwargs)
+    if n_workers <= 1 or len(bands) == 1:
+        return [f_band(band) for band in bands]
+    with ThreadPoolExecutor(max_workers=min(n_workers, len(bands))) as pool:
+        return list(pool.map(f_band, bands))
+
+
+def mad_filter(values: np.ndarray, size: tuple,
+               median: np.ndarray = None, **kwargs) -> np.ndarray:
+    """
+    Compute the windowed median absolute deviation of the input array:
+    the windowed median of |values - median|, where median is the
+    windowed median of the input array.
+    :param values: input array - np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :param median: pre-computed windowed median of values - np.ndarray
+    :param kwargs: median_filter keywords (engine, n_levels, min_valid)
+    :return: median absolute deviation array - np.ndarray
+    """
+    if median is None:
+        median = median_filter(values, size, **kwargs)
+    return median_filter(np.abs(values - median), size, **kwargs)
+
+
+def mean_std_filter(values: np.ndarray, size: tuple,
+                    min_valid: int = 1) -> tuple:
+    """
+    Compute the windowed mean and standard deviation of the input array.
+    NaN samples are ignored, windows with fewer than min_valid valid
+    samples are set to NaN.
+    :param values: input array - np.ndarray
+    :param size: window size (azimuth, range) - tuple
+    :param min_valid: minimum number of valid samples per window
+    :return: windowed mean, windowed standard deviation - np.ndarray -
+        input data type, at least float32
+    """
+    valid = np.isfinite(values)
+    v_zero = np.where(valid, values, 0.).astype(np.float64)
+    n_valid = valid_count(valid, size)
+    w_size = size[0] * size[1]
+    # - uniform_filter returns the window mean
+    v_sum = ndimage.uniform_filter(v_zero, size, mode='reflect') * w_size
+    v_sum2 = ndimage.uniform_filter(v_zero * v_zero, size,
+                                    mode='reflect') * w_size
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(v_sum, n_valid, out=v_sum)
+        np.divide(v_sum2, n_valid, out=v_sum2)
+        # - variance: E[x^2] - E[x]^2 - accumulated in float64
+        np.subtract(v_sum2, np.square(v_sum), out=v_sum2)
+        np.sqrt(np.maximum(v_sum2, 0., out=v_sum2), out=v_sum2)
+    # - results in the input data type (at least float32)
+    o_dtype = np.result_type(values.dtype, np.float32)
+    mean = v_sum.astype(o_dtype, copy=False)
+    std = v_sum2.astype(o_dtype, copy=False)
+    mean[n_valid < max(min_valid, 1)] = np.nan
+    std[n_valid < max(min_valid, 1)] = np.nan
+    return mean, std
+
+
+def valid_count(valid: np.ndarray, size: tuple) -> np.ndarray:
+    """
+    Count the valid samples in each window.
+    :param valid: valid samples mask - np.ndarray
+    :param size: window size (azimuth, range) - tuple
+    :return: number of valid samples per window - np.ndarray
+    """
+    # - uniform_filter returns the window mean - counts are exact in
+    # - float32 for windows up to 2^24 samples
+    count = ndimage.uniform_filter(valid.astype(np.float32), size,
+                                   mode='reflect')
+    np.multiply(count, size[0] * size[1], out=count)
+    return np.rint(count, out=count)
+
+
+def _separable_median(values: np.ndarray, size: tuple) -> np.ndarray:
+    """
+    Approximate the 2D windowed median with two 1D median filters.
+    :param values: input array - np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :return: median filtered array - np.ndarray
+    """
+    median_rg = ndimage.median_filter(values, (1, size[1]))
+    return ndimage.median_filter(median_rg, (size[0], 1))
+
+
+def _reflect_index(index: np.ndarray, n_samples: int) -> np.ndarray:
+    """Map out of range indexes as scipy.ndimage 'reflect' mode"""
+    index = np.abs(index + 0.5) - 0.5
+    index = np.mod(index, 2 * n_samples)
+    return np.where(index >= n_samples, 2 * n_samples - index - 1,
+                    index).astype(np.intp)
+
+
+def _nan_rank_median(values: np.ndarray, size: tuple,
+                     eval_px: np.ndarray,
+                     batch_size: int = 2 ** 22) -> np.ndarray:
+    """
+    Windowed median ignoring NaN values, evaluated only at the selected
+    pixels - see _window_median.
+    :param values: input array - np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :param eval_px: pixels where the median is evaluated - np.ndarray
+    :param batch_size: maximum number of samples gathered at once
+    :return: median filtered array - NaN outside eval_px - np.ndarray
+    """
+    median = np.full(values.shape, np.nan,
+                     dtype=np.result_type(values.dtype, np.float32))
+    rows, cols = np.nonzero(eval_px)
+    median[rows, cols] = _window_median(values, size, rows, cols,
+                                        batch_size=batch_size)
+    return median
+
+
+def _window_median(values: np.ndarray, size: tuple, rows: np.ndarray,
+                   cols: np.ndarray, min_valid: int = 1,
+                   batch_size: int = 2 ** 22) -> np.ndarray:
+    """
+    Median of the windows centered on the selected pixels, ignoring NaN
+    values. Windows are gathered in batches of at most batch_size samples
+    directly from the input array, which is never copied nor padded.
+    As in scipy.ndimage.median_filter, the value of rank n_valid // 2 is
+    returned - NaN if the window has fewer than min_valid valid samples.
+    :param values: input array - np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :param rows: selected pixels rows - np.ndarray
+    :param cols: selected pixels columns - np.ndarray
+    :param min_valid: minimum number of valid samples per window
+    :param batch_size: maximum number of samples gathered at once
+    :return: median of each window - 1D np.ndarray
+    """
+    median = np.empty(rows.size,
+                      dtype=np.result_type(values.dtype, np.float32))
+    off_az = np.arange(size[0]) - size[0] // 2
+    off_rg = np.arange(size[1]) - size[1] // 2
+    k_area = size[0] * size[1]
+    n_batch = max(batch_size // k_area, 1)
+    for b_start in range(0, rows.size, n_batch):
+        b_rows = rows[b_start:b_start + n_batch]
+        b_cols = cols[b_start:b_start + n_batch]
+        w_rows = _reflect_index(b_rows[:, None] + off_az, values.shape[0])
+        w_cols = _reflect_index(b_cols[:, None] + off_rg, values.shape[1])
+        windows = values[w_rows[:, :, None], w_cols[:, None, :]]\
+            .reshape(b_rows.size, -1)
+        n_valid = np.isfinite(windows).sum(axis=1)
+        b_median = median[b_start:b_start + n_batch]
+        # - complete windows - partial sort around the median rank
+        full = n_valid == k_area
+        b_median[full] = np.partition(windows[full], k_area // 2,
+                                      axis=1)[:, k_area // 2]
+        if not full.all():
+            # - NaN values are sorted at the end of each window
+            s_windows = np.sort(windows[~full], axis=1)
+            b_median[~full] \
+                = np.take_along_axis(s_windows,
+                                     (n_valid[~full] // 2)[:, None],
+                                     axis=1)[:, 0]
+        b_median[n_valid < max(min_valid, 1)] = np.nan
+    return median
+
+
+def _histogram_median(values: np.ndarray, size: tuple,
+                      n_levels: int = 1024, min_valid: int = 1
+                      ) -> np.ndarray:
+    """
+    Sliding-histogram windowed median.
+    Values are quantized to n_levels levels spanning their 0.1-99.9
+    percentile range (values outside the range are clipped). For each
+    level, the number of window samples falling in it is computed with a
+    running box sum; a pixel is assigned the first level at which the
+    cumulative count reaches the median rank. Empty levels are skipped
+    and the search stops as soon as every pixel has been assigned - the
+    cost grows with the number of levels scanned.
+    NaN values are not counted; the median rank of each window is computed
+    on its valid samples.
+    :param values: input array - np.ndarray
+    :param size: median filter kernel size (azimuth, range) - tuple
+    :param n_levels: number of quantization levels
+    :param min_valid: minimum number of valid samples per window
+    :return: median filtered array - np.ndarray
+    """
+    valid = np.isfinite(values)
+    median = np.full(values.shape, np.nan,
+                     dtype=np.result_type(values.dtype, np.float32))
+    if not valid.any():
+        return median
+    v_min, v_max = np.percentile(values[valid], [0.1, 99.9])
+    step = (v_max - v_min) / (n_levels - 1) if v_max > v_min else 1.
+    # - quantized values - NaN mapped to an extra level
+    q_values = np.full(values.shape, n_levels, dtype=np.int32)
+    q_values[valid] = np.clip(np.rint((values[valid] - v_min) / step),
+                              0, n_levels - 1)
+    occupied = np.bincount(q_values.ravel(), minlength=n_levels + 1)
+
+    # - scipy.ndimage median rank (0-based): n_valid // 2
+    k_area = size[0] * size[1]
+    if valid.all():
+        n_valid = k_area
+        unassigned = np.full(values.shape, k_area >= min_valid)
+    else:
+        n_valid = valid_count(valid, size)
+        unassigned = n_valid >= min_valid
+    rank = n_valid // 2 + 1
+    count = np.zeros(values.shape)
+    for level in np.flatnonzero(occupied[:n_levels]):
+        # - box sum of the level indicator (uniform_filter returns the mean)
+        count += ndimage.uniform_filter((q_values == level)
+                                        .astype(np.float64), size,
+                                        mode='reflect')
+        new_px = unassigned & (count * k_area > rank - 0.5)
+        median[new_px] = v_min + level * step
+        unassigned[new_px] = False
+        if not unassigned.any():
+            break
+
+    return median
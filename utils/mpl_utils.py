@@ -2,20 +2,21 @@
 Enrico Ciraci 03/2022
 Set of utility functions that can be used to generate figures with matplotlib.
 """
-import matplotlib.pyplot as plt
+from matplotlib.axes import Axes
+from matplotlib.colorbar import Colorbar
+from matplotlib.cm import ScalarMappable
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 
-def add_colorbar(ax: plt.Axes, im: plt.pcolormesh) -> plt.colorbar:
+def add_colorbar(ax: Axes, im: ScalarMappable) -> Colorbar:
     """
     Add colorbar to the selected plt.Axes.
     :param ax: plt.Axes object
-    :param im: plt.pcolormesh object
+    :param im: plt.pcolormesh or plt.imshow object
     :return: plt.colorbar
     """
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.05)
 
-    cb = plt.colorbar(im, cax=cax)
+    cb = ax.figure.colorbar(im, cax=cax)
     return cb
-
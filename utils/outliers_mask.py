@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+u"""
+Compact outliers mask - boolean or bit-packed storage.
+"""
+# - python dependencies
+import numpy as np
+
+
+class OutliersMask(np.lib.mixins.NDArrayOperatorsMixin):
+    """Outliers mask stored as a boolean array (1 byte per pixel) or as a
+    bit-packed array (1 bit per pixel).
+    ...
+
+    Parameters
+    ----------
+    :param mask - np.ndarray - outliers boolean mask (True -> outlier).
+    :param packed - bool - store the mask bit-packed.
+
+    Attributes
+    ----------
+    shape       # - Mask shape
+    T           # - Transposed 0/1 mask
+    count       # - Number of outliers
+    packed      # - Mask stored bit-packed
+    nbytes      # - Memory used by the mask storage
+
+    Methods
+    -------
+    from_index - Create a mask from a np.where index tuple.
+    to_bool - Return the mask as a boolean array.
+    to_float - Return the mask as a 0/1 array.
+    sum - Sum of the 0/1 mask - see np.ndarray.sum.
+    indices - Return the outliers indices (np.where tuple).
+    index - Return the cheapest representation to index layer arrays.
+    pack / unpack - Return a bit-packed / boolean copy of the mask.
+
+    An OutliersMask can be used directly to index numpy arrays. Numpy
+    operations and comparisons (e.g. mask == 1) see the mask as a 0/1
+    array - the legacy binary mask.
+    """
+    def __init__(self, mask: np.ndarray, packed: bool = False) -> None:
+        mask = np.asarray(mask, dtype=bool)
+        self._shape = mask.shape
+        self._packed = packed
+        self._data = np.packbits(mask, axis=None) if packed else mask
+
+    @classmethod
+    def from_index(cls, index: tuple, shape: tuple,
+                   packed: bool = False) -> 'OutliersMask':
+        """
+        Create a mask from an index tuple (e.g. returned by np.where).
+        :param index: outliers indices - tuple
+        :param shape: mask shape - tuple
+        :param packed: store the mask bit-packed
+        :return: OutliersMask
+        """
+        mask = np.zeros(shape, dtype=bool)
+        mask[index] = True
+        return cls(mask, packed=packed)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        if dtype is None:
+            return self.to_bool()
+        return self.to_bool().astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # - numpy operations and operators (NDArrayOperatorsMixin) see
+        # - the legacy 0/1 mask
+        inputs = [i.to_float() if isinstance(i, OutliersMask) else i
+                  for i in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getitem__(self, key) -> np.ndarray:
+        return self.to_bool()[key]
+
+    @property
+    def shape(self) -> tuple:
+        """Mask shape"""
+        return self._shape
+
+    @property
+    def T(self) -> np.ndarray:
+        """Transposed 0/1 mask"""
+        return self.to_float().T
+
+    @property
+    def packed(self) -> bool:
+        """Mask stored bit-packed"""
+        return self._packed
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the mask storage"""
+        return self._data.nbytes
+
+    @property
+    def count(self) -> int:
+        """Number of outliers"""
+        if self._packed:
+            return int(np.unpackbits(self._data).sum())
+        return int(np.count_nonzero(self._data))
+
+    def to_bool(self) -> np.ndarray:
+        """Return the mask as a boolean array - read-only if not packed"""
+        if self._packed:
+            return np.unpackbits(self._data, count=int(np.prod(self._shape)))\
+                .reshape(self._shape).view(bool)
+        # - read-only view - the mask storage is not modified
+        b_mask = self._data.view()
+        b_mask.flags.writeable = False
+        return b_mask
+
+    def to_float(self, dtype=np.float32) -> np.ndarray:
+        """Return the mask as a 0/1 array: 1 -> outlier, 0 -> valid"""
+        return self.to_bool().astype(dtype)
+
+    def sum(self, *args, **kwargs):
+        """Sum of the 0/1 mask - see np.ndarray.sum"""
+        return self.to_float().sum(*args, **kwargs)
+
+    def indices(self) -> tuple:
+        """Return the outliers indices - np.where tuple"""
+        return np.nonzero(self.to_bool())
+
+    def index(self, max_density: float = 1. / 16.):
+        """
+        Return the cheapest representation to index layer arrays: indices
+        if the outliers density is lower than max_density (fewer bytes than
+        a boolean mask), the boolean mask otherwise.
+        :param max_density: maximum outliers density to return indices
+        :return: np.where tuple or boolean mask
+        """
+        mask = self.to_bool()
+        if np.count_nonzero(mask) < max_density * mask.size:
+            return np.nonzero(mask)
+        return mask
+
+    def pack(self) -> 'OutliersMask':
+        """Return a bit-packed copy of the mask"""
+        return OutliersMask(self.to_bool(), packed=True)
+
+    def unpack(self) -> 'OutliersMask':
+        """Return a boolean copy of the mask"""
+        return OutliersMask(self.to_bool(), packed=False)
+
+
+def as_index(mask):
+    """
+    Convert an outliers mask to a value usable to index numpy arrays.
+    :param mask: OutliersMask, boolean mask or np.where tuple
+    :return: np.where tuple or boolean mask
+    """
+    if isinstance(mask, OutliersMask):
+        return mask.index()
+    return mask
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+u"""
+Display-resolution previews of large rasters.
+
+Rasters are decimated with a NaN-aware block mean and histograms are
+accumulated block by block, so that figures can be generated at any
+raster size with bounded memory.
+"""
+# - python dependencies
+import numpy as np
+
+
+def preview_factor(shape: tuple, max_size: int = 1024) -> int:
+    """
+    Decimation factor needed to fit a raster in max_size pixels per side.
+    :param shape: raster shape (rows, columns)
+    :param max_size: maximum preview size [pixels]
+    :return: decimation factor - int
+    """
+    return max(int(np.ceil(max(shape) / max_size)), 1)
+
+
+def block_mean(values: np.ndarray, factor: int,
+               block_rows: int = 256) -> np.ndarray:
+    """
+    Decimate a 2D array by averaging factor x factor blocks - NaN values
+    are ignored, all-NaN blocks are set to NaN. The input is processed in
+    strips of block_rows output rows.
+    :param values: input array - np.ndarray
+    :param factor: decimation factor
+    :param block_rows: number of output rows computed at once
+    :return: decimated array - np.ndarray
+    """
+    if factor <= 1:
+        return np.asarray(values)
+    n_rows, n_cols = values.shape
+    o_rows, o_cols = -(-n_rows // factor), -(-n_cols // factor)
+    preview = np.empty((o_rows, o_cols), dtype=np.float32)
+    for o_row in range(0, o_rows, block_rows):
+        rows = slice(o_row * factor, min((o_row + block_rows) * factor,
+                                         n_rows))
+        strip = np.asarray(values[rows], dtype=np.float32)
+        s_rows = -(-strip.shape[0] // factor)
+        # - pad the strip to a multiple of the decimation factor
+        padded = np.full((s_rows * factor, o_cols * factor), np.nan,
+                         dtype=np.float32)
+        padded[:strip.shape[0], :n_cols] = strip
+        blocks = padded.reshape(s_rows, factor, o_cols, factor)
+        valid = np.isfinite(blocks)
+        b_sum = np.where(valid, blocks, 0.).sum(axis=(1, 3))
+        b_count = valid.sum(axis=(1, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            preview[o_row:o_row + s_rows] = b_sum / b_count
+    return preview
+
+
+def blocked_histogram(values: np.ndarray, bins: int, value_range: tuple,
+                      density: bool = False,
+                      block_rows: int = 1024) -> tuple:
+    """
+    Compute the histogram of a large array block by block - NaN values
+    are ignored.
+    :param values: input array - np.ndarray
+    :param bins: number of bins
+    :param value_range: histogram (min, max) values
+    :param density: normalize the histogram to a probability density
+        over value_range
+    :param block_rows: number of rows processed at once
+    :return: counts, bin edges - np.ndarray
+    """
+    values = values.reshape(values.shape[0], -1) if values.ndim > 1 \
+        else values.reshape(1, -1)
+    counts = np.zeros(bins, dtype=np.float64)
+    edges = np.linspace(value_range[0], value_range[1], bins + 1)
+    for row in range(0, values.shape[0], block_rows):
+        block = np.asarray(values[row:row + block_rows])
+        counts += np.histogram(block[np.isfinite(block)], bins=edges)[0]
+    if density and counts.sum() > 0:
+        counts /= counts.sum() * np.diff(edges)
+    return counts, edges
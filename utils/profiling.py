@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+u"""
+Per-stage timing and memory instrumentation.
+
+Processing stages are wrapped with the stage() context manager or the
+profiled() decorator. When a StageProfiler is enabled, each stage records
+wall time, CPU time, peak resident memory and bytes read. Without an
+enabled profiler stages cost a single global lookup.
+
+On Linux the peak resident memory is reset at the start of each stage
+(/proc/self/clear_refs), so each stage reports the peak reached while it
+was running. Memory is a process-wide counter: the peak includes the
+memory of stages running concurrently. Elsewhere the process high-water
+mark is reported.
+
+CPU time and bytes read are counted for the thread running the stage,
+so concurrent stages (thread pools) are not charged for each other's
+work. The work a stage delegates to worker threads is not included -
+it is recorded by the stages of the workers. Nested stages share the
+counters of their thread.
+"""
+# - python dependencies
+import os
+import csv
+import json
+import time
+import pathlib
+import threading
+import functools
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:             # - not available on Windows
+    resource = None
+
+# - Active profiler - None: instrumentation disabled
+_PROFILER = None
+
+
+def _peak_rss() -> int:
+    """
+    Peak resident set size of the process [bytes] since the last reset
+    (Linux) or since the process started - None if unknown
+    """
+    try:
+        with open('/proc/self/status', 'r', encoding='utf8') as s_fid:
+            for ln in s_fid:
+                if ln.startswith('VmHWM:'):
+                    return int(ln.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # - ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the peak resident set size of the process (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='utf8') as c_fid:
+            c_fid.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _bytes_read(scope: str = 'thread-self') -> int:
+    """Bytes read by the calling thread (or by the process: scope='self')
+    so far - None if unknown (Linux only)"""
+    try:
+        with open(f'/proc/{scope}/io', 'r', encoding='utf8') as io_fid:
+            for ln in io_fid:
+                if ln.startswith('rchar:'):
+                    return int(ln.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def process_counters() -> dict:
+    """
+    Process-wide counters - all the threads of the process.
+    :return: cpu_time [s], bytes_read - dict
+    """
+    return {'cpu_time': time.process_time(), 'bytes_read': _bytes_read('self')}
+
+
+class StageProfiler:
+    """Record per-stage processing statistics.
+    ...
+
+    Parameters
+    ----------
+    :param log - bool - print a log line at the end of each stage.
+
+    Attributes
+    ----------
+    records         # - Stage records - list of dict
+
+    Methods
+    -------
+    enable / disable - Start / stop recording the instrumented stages.
+    summary - Aggregate the records by stage name.
+    to_json - Save records and summary to a JSON file.
+    to_csv - Save records to a CSV file.
+
+    Each record contains: stage, wall_time [s], cpu_time [s], peak_rss
+    [bytes], bytes_read, thread and the stage keywords (info). peak_rss is
+    the peak reached during the stage if the peak can be reset (Linux),
+    the process high-water mark otherwise.
+    """
+    FIELDS = ['stage', 'wall_time', 'cpu_time', 'peak_rss', 'bytes_read',
+              'thread', 'info']
+
+    def __init__(self, log: bool = False) -> None:
+        self._log = log
+        self._records = []
+        self._peaks = {}             # - Peak memory of the running stages
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *args) -> None:
+        self.disable()
+
+    @property
+    def records(self) -> list:
+        """Stage records"""
+        return list(self._records)
+
+    def enable(self) -> 'StageProfiler':
+        """Start recording the instrumented stages"""
+        global _PROFILER
+        _PROFILER = self
+        return self
+
+    def disable(self) -> None:
+        """Stop recording the instrumented stages"""
+        global _PROFILER
+        if _PROFILER is self:
+            _PROFILER = None
+
+    @contextmanager
+    def stage(self, name: str, **info):
+        """
+        Record the statistics of the enclosed stage.
+        :param name: stage name
+        :param info: stage keywords added to the record
+        """
+        s_id = object()
+        with self._lock:
+            # - the peaks of the running stages are kept before the reset
+            peak = _peak_rss()
+            for r_id in self._peaks:
+                self._peaks[r_id] = max(self._peaks[r_id], peak or 0)
+            self._peaks[s_id] = 0 if _reset_peak_rss() else peak or 0
+        wall_0, cpu_0, read_0 = time.perf_counter(), time.thread_time(), \
+            _bytes_read()
+        try:
+            yield
+        finally:
+            read_1 = _bytes_read()
+            with self._lock:
+                s_peak, peak = self._peaks.pop(s_id), _peak_rss()
+                peak = None if peak is None else max(s_peak, peak)
+            record = {'stage': name,
+                      'wall_time': time.perf_counter() - wall_0,
+                      'cpu_time': time.thread_time() - cpu_0,
+                      'peak_rss': peak,
+                      'bytes_read': None if read_0 is None
+                      else read_1 - read_0,
+                      'thread': threading.current_thread().name,
+                      'info': {k: str(v) for k, v in info.items()}}
+            with self._lock:
+                self._records.append(record)
+            if self._log:
+                print(f"# - [{name}] wall: {record['wall_time']:.3f} s - "
+                      f"cpu: {record['cpu_time']:.3f} s - peak rss: "
+                      f"{(record['peak_rss'] or 0) / 1024 ** 2:.1f} MB "
+                      f"{' '.join(f'{k}={v}' for k, v in info.items())}")
+
+    def summary(self) -> dict:
+        """
+        Aggregate the records by stage name.
+        :return: stage name -> count, total wall/cpu time, max peak rss,
+            total bytes read - dict
+        """
+        summary = {}
+        for rec in self.records:
+            s_rec = summary.setdefault(rec['stage'],
+                                       {'count': 0, 'wall_time': 0.,
+                                        'cpu_time': 0., 'peak_rss': 0,
+                                        'bytes_read': 0})
+            s_rec['count'] += 1
+            s_rec['wall_time'] += rec['wall_time']
+            s_rec['cpu_time'] += rec['cpu_time']
+            s_rec['peak_rss'] = max(s_rec['peak_rss'], rec['peak_rss'] or 0)
+            s_rec['bytes_read'] += rec['bytes_read'] or 0
+        return summary
+
+    def to_json(self, f_path: pathlib.Path) -> None:
+        """
+        Save records and summary to a JSON file.
+        :param f_path: output file path
+        :return: None
+        """
+        with open(f_path, 'w', encoding='utf8') as j_fid:
+            json.dump({'pid': os.getpid(), 'summary': self.summary(),
+                       'records': self.records}, j_fid, indent=2)
+
+    def to_csv(self, f_path: pathlib.Path) -> None:
+        """
+        Save records to a CSV file.
+        :param f_path: output file path
+        :return: None
+        """
+        with open(f_path, 'w', encoding='utf8', newline='') as c_fid:
+            writer = csv.DictWriter(c_fid, fieldnames=self.FIELDS)
+            writer.writeheader()
+            for rec in self.records:
+                writer.writerow({**rec, 'info': json.dumps(rec['info'])})
+
+
+@contextmanager
+def stage(name: str, **info):
+    """
+    Instrument the enclosed stage - no-op if no profiler is enabled.
+    :param name: stage name
+    :param info: stage keywords added to the record
+    """
+    profiler = _PROFILER
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name, **info):
+            yield
+
+
+def profiled(name: str):
+    """
+    Decorator - instrument each call of the decorated function.
+    :param name: stage name
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _PROFILER is None:
+                return func(*args, **kwargs)
+            with _PROFILER.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+u"""
+Quality assessment (QA) figures of offsets layers.
+
+Figures are rendered with the Agg canvas - no pyplot state and no GUI
+backend are involved - and saved to file, so they can be generated on
+headless nodes and from background threads or processes. Plot functions
+take display-resolution previews (see utils.preview), not full
+resolution bands.
+"""
+# - python dependencies
+import pathlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from utils.mpl_utils import add_colorbar
+
+# - QA figures default settings
+QA_RC = {'font.family': 'monospace', 'font.weight': 'bold'}
+
+
+def _new_figure(fig_size: tuple) -> Figure:
+    """Create a figure attached to an Agg canvas"""
+    fig = Figure(figsize=fig_size)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _save_figure(fig: Figure, out_path: pathlib.Path) -> Figure:
+    """Save the figure if an output path is given"""
+    if out_path is not None:
+        fig.savefig(out_path, dpi=150)
+    return fig
+
+
+def plot_offsets(previews: dict, shape: tuple, out_path: pathlib.Path = None,
+                 fig_size: tuple = (10, 6),
+                 offsets_range: tuple = (-20, 20),
+                 cov_range: tuple = (0, 50), title: str = '',
+                 off_cmap: str = 'RdBu', cov_cmap: str = 'Reds') -> Figure:
+    """
+    Plot dense offsets and their covariance.
+    :param previews: band previews - dict - offsets_az, offsets_rg, cov_az,
+        cov_rg
+    :param shape: full resolution layer shape (rows, columns)
+    :param out_path: output figure path - None: the figure is not saved
+    :param fig_size: figure size - tuple
+    :param offsets_range: offsets (min, max) values - tuple
+    :param cov_range: covariance (min, max) values - tuple
+    :param title: figure sup-title
+    :param off_cmap: offsets colormap
+    :param cov_cmap: covariance colormap
+    :return: Figure
+    """
+    # - Azimuth along x, Range along y - full resolution pixel units
+    im_kwd = {'origin': 'lower', 'aspect': 'auto',
+              'interpolation': 'nearest',
+              'extent': (0, shape[0], 0, shape[1])}
+    panels = [('offsets_az', 'Offsets Azimuth', off_cmap, offsets_range),
+              ('offsets_rg', 'Offsets Range', off_cmap, offsets_range),
+              ('cov_az', 'Covariance Offsets Azimuth', cov_cmap, cov_range),
+              ('cov_rg', 'Covariance Offsets Range', cov_cmap, cov_range)]
+    with matplotlib.rc_context(QA_RC):
+        fig = _new_figure(fig_size)
+        fig.suptitle(title, weight='bold', size=16)
+        for p_num, panel in enumerate(panels, start=1):
+            b_name, b_title, cmap, v_range = panel
+            ax = fig.add_subplot(2, 2, p_num)
+            ax.set_title(b_title, loc='left', weight='bold')
+            im = ax.imshow(np.asarray(previews[b_name]).T, cmap=cmap,
+                           vmin=v_range[0], vmax=v_range[1], **im_kwd)
+            add_colorbar(ax, im)
+        fig.tight_layout()
+        return _save_figure(fig, out_path)
+
+
+def plot_offsets_distribution(histograms: dict,
+                              out_path: pathlib.Path = None,
+                              fig_size: tuple = (10, 4),
+                              offsets_range: tuple = (-20, 20)) -> Figure:
+    """
+    Plot histograms showing the offsets value distribution.
+    :param histograms: (counts, bin edges) - dict - offsets_az, offsets_rg
+    :param out_path: output figure path - None: the figure is not saved
+    :param fig_size: figure size
+    :param offsets_range: histogram x-axis limits
+    :return: Figure
+    """
+    panels = [('offsets_az', 'Offsets Azimuth', 'g'),
+              ('offsets_rg', 'Offsets Range', 'b')]
+    with matplotlib.rc_context(QA_RC):
+        fig = _new_figure(fig_size)
+        for p_num, (b_name, b_title, color) in enumerate(panels, start=1):
+            counts, edges = histograms[b_name]
+            ax = fig.add_subplot(1, 2, p_num)
+            ax.set_title(b_title, loc='left', weight='bold')
+            ax.hist(edges[:-1], edges, weights=counts,
+                    facecolor=color, edgecolor='k', alpha=0.75)
+            ax.grid(color='k', linestyle='dotted', alpha=0.3)
+            ax.set_xlim(offsets_range[0], offsets_range[1])
+        fig.tight_layout()
+        return _save_figure(fig, out_path)
+
+
+def plot_outliers_mask(preview: np.ndarray, shape: tuple,
+                       out_path: pathlib.Path = None,
+                       fig_size: tuple = (7, 5),
+                       title: str = 'Outliers Mask') -> Figure:
+    """
+    Plot the outliers mask - fraction of outliers per display pixel.
+    :param preview: outliers mask preview - np.ndarray
+    :param shape: full resolution mask shape (rows, columns)
+    :param out_path: output figure path - None: the figure is not saved
+    :param fig_size: figure size
+    :param title: figure title
+    :return: Figure
+    """
+    with matplotlib.rc_context(QA_RC):
+        fig = _new_figure(fig_size)
+        ax_b = fig.add_subplot(111)
+        ax_b.set_title(title, weight='bold', loc='left', size=20)
+        im_b = ax_b.imshow(np.asarray(preview).T, cmap='Greys', vmin=0,
+                           vmax=1, origin='lower', aspect='auto',
+                           interpolation='nearest',
+                           extent=(0, shape[0], 0, shape[1]))
+        add_colorbar(ax_b, im_b)
+        return _save_figure(fig, out_path)
+
+
+class FigureExporter:
+    """Render and save QA figures in the background.
+    ...
+
+    Parameters
+    ----------
+    :param executor - str - 'thread' or 'process'.
+    :param max_workers - int - number of figures rendered concurrently.
+
+    Methods
+    -------
+    submit - Render a figure in the background - returns a Future.
+    close - Wait for all the figures to be saved.
+
+    Plot functions return the Figure object, which is not sent back from
+    worker processes: with the 'process' executor the futures results
+    are None.
+    """
+    def __init__(self, executor: str = 'thread', max_workers: int = 1) -> None:
+        if executor not in ['thread', 'process']:
+            raise ValueError(f'{executor} invalid figure exporter executor')
+        self._process = executor == 'process'
+        self._pool = ProcessPoolExecutor(max_workers=max_workers) \
+            if self._process else ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def submit(self, plot_func, *args, **kwargs):
+        """
+        Render a figure in the background.
+        :param plot_func: plot function - e.g. plot_offsets
+        :param args: plot function arguments
+        :param kwargs: plot function keywords
+        :return: concurrent.futures.Future
+        """
+        if self._process:
+            future = self._pool.submit(_render, plot_func, *args, **kwargs)
+        else:
+            future = self._pool.submit(plot_func, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def close(self) -> None:
+        """Wait for all the figures to be saved - errors are raised"""
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._pool.shutdown()
+            self._futures = []
+
+
+def _render(plot_func, *args, **kwargs) -> None:
+    """Render a figure in a worker process - the figure is not returned"""
+    plot_func(*args, **kwargs)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+u"""
+Raster input/output utilities based on GDAL.
+"""
+# - python dependencies
+import os
+import pathlib
+import numpy as np
+from osgeo import gdal
+from utils.envi_header import read_envi_header
+from utils.profiling import stage
+
+# - Output raster formats: GDAL driver and file extension
+RASTER_FORMATS = {'ENVI': ('ENVI', ''), 'GTiff': ('GTiff', '.tif'),
+                  'COG': ('GTiff', '.tif')}
+# - Floating point GDAL data types
+FLOAT_TYPES = (gdal.GDT_Float32, gdal.GDT_Float64)
+
+
+def _envi_layout(f_path: pathlib.Path) -> tuple:
+    """
+    Layout of a flat binary ENVI raster.
+    :param f_path: raster path - the header is read from f_path.hdr
+    :return: data type, interleave, header offset [bytes], file array
+        shape - tuple, or None if the raster is not a flat binary ENVI
+        raster
+    """
+    hdr_path = f'{f_path}.hdr'
+    if not (os.path.isfile(f_path) and os.path.isfile(hdr_path)):
+        return None
+    try:
+        header = read_envi_header(hdr_path)
+        dtype = header.dtype
+    except (ValueError, KeyError):
+        return None
+    n_rows, n_cols, n_bands = header.lines, header.samples, header.bands
+    interleave = header.interleave
+    offset = header.header_offset
+    if interleave not in ('bip', 'bil', 'bsq') \
+            or not header.file_type.upper().startswith('ENVI') \
+            or header.fields.get('file compression', '0') != '0':
+        return None
+    if os.path.getsize(f_path) < offset + header.nbytes:
+        return None
+
+    shape = {'bip': (n_rows, n_cols, n_bands),
+             'bil': (n_rows, n_bands, n_cols),
+             'bsq': (n_bands, n_rows, n_cols)}[interleave]
+    return dtype, interleave, offset, shape
+
+
+def _band_view(r_map: np.ndarray, interleave: str, b_num: int,
+               rows: slice, cols: slice) -> np.ndarray:
+    """Window of the selected band of a raster with the given layout"""
+    if interleave == 'bip':
+        return r_map[rows, cols, b_num - 1]
+    if interleave == 'bil':
+        return r_map[rows, b_num - 1, cols]
+    return r_map[b_num - 1, rows, cols]
+
+
+def _window_slices(shape: tuple, interleave: str, window: tuple) -> tuple:
+    """Rows and columns slices of a raster window"""
+    n_rows = shape[1 if interleave == 'bsq' else 0]
+    n_cols = shape[-1 if interleave != 'bip' else 1]
+    if window is None:
+        window = (0, 0, n_cols, n_rows)
+    return slice(window[1], window[1] + window[3]), \
+        slice(window[0], window[0] + window[2])
+
+
+def _read_block(r_fid, block: np.ndarray) -> None:
+    """Fill a contiguous block with the next bytes of the file"""
+    n_bytes = r_fid.readinto(memoryview(block).cast('B'))
+    if n_bytes != block.nbytes:
+        raise ValueError(f'# - Truncated raster: {r_fid.name}')
+
+
+def envi_memmap(f_path: pathlib.Path, bands: list,
+                window: tuple = None) -> list:
+    """
+    Map the selected bands of a flat binary ENVI raster in memory.
+    Bands are returned as read-only np.memmap views - no data is read
+    until the values are used.
+    :param f_path: raster path - the header is read from f_path.hdr
+    :param bands: band numbers (1-based) - list
+    :param window: (xoff, yoff, xsize, ysize) raster window - tuple
+    :return: band views - list of np.memmap, or None if the raster is not
+        a flat binary ENVI raster that can be mapped
+    """
+    layout = _envi_layout(f_path)
+    if layout is None:
+        return None
+    dtype, interleave, offset, shape = layout
+    r_map = np.memmap(f_path, dtype=dtype, mode='r', offset=offset,
+                      shape=shape)
+    rows, cols = _window_slices(shape, interleave, window)
+    return [_band_view(r_map, interleave, b_num, rows, cols)
+            for b_num in bands]
+
+
+def read_raster_bands(f_path: pathlib.Path, bands: list,
+                      window: tuple = None, dtypes: list = None,
+                      block_rows: int = 256) -> list:
+    """
+    Read the selected bands of a raster in a single pass over the file.
+    Flat binary ENVI rasters are read block of rows by block of rows,
+    sequentially, into a reused buffer and each block is de-interleaved
+    into preallocated band buffers. Other rasters are read with a single
+    multi-band GDAL request.
+    :param f_path: raster path
+    :param bands: band numbers (1-based) - list
+    :param window: (xoff, yoff, xsize, ysize) raster window - tuple
+    :param dtypes: output data type of each band - list - None: raster
+        data type
+    :param block_rows: number of rows read at once (ENVI rasters)
+    :return: band values - list of np.ndarray
+    """
+    layout = _envi_layout(f_path)
+    if layout is not None:
+        dtype, interleave, offset, shape = layout
+        rows, cols = _window_slices(shape, interleave, window)
+        if dtypes is None:
+            dtypes = [dtype.newbyteorder('=')] * len(bands)
+        b_shape = (rows.stop - rows.start, cols.stop - cols.start)
+        b_arrays = [np.empty(b_shape, dtype=dt) for dt in dtypes]
+        # - full rows are read - file row shape: (samples, bands),
+        # - (bands, samples) or (samples,) for each band plane
+        row_shape = shape[-1:] if interleave == 'bsq' else shape[1:]
+        row_bytes = int(np.prod(row_shape)) * dtype.itemsize
+        buffer = np.empty((min(block_rows, max(b_shape[0], 1)),)
+                          + row_shape, dtype=dtype)
+        with open(f_path, 'rb') as r_fid:
+            if interleave == 'bsq':
+                # - bands are stored sequentially
+                b_planes = [(b_array, offset + (b_num - 1) * shape[1]
+                             * row_bytes) for b_num, b_array
+                            in zip(bands, b_arrays)]
+            else:
+                b_planes = [(None, offset)]
+            for b_array, p_offset in b_planes:
+                r_fid.seek(p_offset + rows.start * row_bytes)
+                for row in range(0, b_shape[0], block_rows):
+                    block = buffer[:min(block_rows, b_shape[0] - row)]
+                    _read_block(r_fid, block)
+                    o_rows = slice(row, row + block.shape[0])
+                    if b_array is not None:
+                        b_array[o_rows] = block[:, cols]
+                        continue
+                    for b_num, o_array in zip(bands, b_arrays):
+                        o_array[o_rows] = _band_view(block, interleave,
+                                                     b_num, slice(None),
+                                                     cols)
+        return b_arrays
+
+    ds = gdal.Open(str(f_path), gdal.GA_ReadOnly)
+    if ds is None:
+        raise ValueError(f'# - Unable to open raster: {f_path}')
+    w_args = () if window is None else tuple(window)
+    b_stack = ds.ReadAsArray(*w_args, band_list=list(bands))
+    ds = None
+    if b_stack.ndim == 2:
+        b_stack = b_stack[np.newaxis]
+    if dtypes is None:
+        return list(b_stack)
+    return [b_array.astype(dt, copy=False)
+            for b_array, dt in zip(b_stack, dtypes)]
+
+
+def writer_options(out_format: str = 'ENVI',
+                   data_type: int = gdal.GDT_Float32,
+                   compress: str = 'DEFLATE', block_size: int = 512,
+                   overviews='auto') -> dict:
+    """
+    RasterWriter keywords for the selected output format.
+    GTiff and COG outputs are tiled and compressed - with horizontal
+    differencing (integer) or floating point predictor - and carry
+    internal overviews. COG outputs have the cloud-optimized layout.
+    :param out_format: output format [ENVI, GTiff, COG]
+    :param data_type: GDAL data type
+    :param compress: compression algorithm [DEFLATE, ZSTD, LZW, NONE]
+    :param block_size: tile size [pixels]
+    :param overviews: overview levels - list, 'auto' or None
+    :return: RasterWriter keywords - dict
+    """
+    if out_format not in RASTER_FORMATS:
+        raise ValueError(f'# - Unsupported output format: {out_format}')
+    if out_format == 'ENVI':
+        return {'driver': 'ENVI', 'options': []}
+    options = ['TILED=YES', f'BLOCKXSIZE={block_size}',
+               f'BLOCKYSIZE={block_size}', 'BIGTIFF=IF_SAFER']
+    if compress.upper() != 'NONE':
+        options += [f'COMPRESS={compress.upper()}',
+                    f'PREDICTOR={3 if data_type in FLOAT_TYPES else 2}']
+    return {'driver': 'GTiff', 'options': options, 'overviews': overviews,
+            'cog': out_format == 'COG'}
+
+
+def overview_levels(shape: tuple, block_size: int = 512) -> list:
+    """
+    Overview decimation factors - powers of two until the coarsest
+    overview fits in a single block.
+    :param shape: raster shape (rows, columns)
+    :param block_size: tile size [pixels]
+    :return: overview levels - list
+    """
+    levels = []
+    level = 1
+    while -(-max(shape) // level) > block_size:
+        level *= 2
+        levels.append(level)
+    return levels
+
+
+class RasterWriter:
+    """Write a multi-band raster in blocks.
+    ...
+
+    Parameters
+    ----------
+    :param f_path - pathlib.Path - output raster path.
+    :param shape - tuple - raster shape (rows, columns).
+    :param n_bands - int - number of raster bands.
+    :param data_type - int - GDAL data type.
+    :param driver - str - GDAL driver name.
+    :param options - list - GDAL creation options.
+    :param ref_path - pathlib.Path - raster from which to copy the
+        georeferencing information, metadata and band descriptions.
+    :param overviews - list or 'auto' - overview levels built on close.
+    :param cog - bool - convert the raster to a Cloud-Optimized GeoTIFF on
+        close - the data are written to a temporary GeoTIFF first.
+    :param nodata - float - band no-data value.
+
+    Methods
+    -------
+    write - Write a block of band values.
+    close - Flush data to disk and close the raster.
+    """
+    def __init__(self, f_path: pathlib.Path, shape: tuple, n_bands: int,
+                 data_type: int = gdal.GDT_Float32, driver: str = 'ENVI',
+                 options: list = None, ref_path: pathlib.Path = None,
+                 overviews=None, cog: bool = False,
+                 nodata: float = None) -> None:
+        self._path = f_path
+        self._driver = driver
+        self._options = options or []
+        self._overviews = overview_levels(shape, _block_size(self._options))\
+            if overviews == 'auto' else overviews
+        self._resampling = 'AVERAGE' if data_type in FLOAT_TYPES \
+            else 'NEAREST'
+        self._cog = cog
+        # - COG layout is created on close from a temporary GeoTIFF
+        w_path = f'{f_path}.tmp.tif' if cog else str(f_path)
+        self._ds = gdal.GetDriverByName(driver)\
+            .Create(w_path, shape[1], shape[0], n_bands, data_type,
+                    options=self._options)
+        if self._ds is None:
+            raise OSError(f': Unable to create {f_path}')
+        if nodata is not None:
+            for b_num in range(1, n_bands + 1):
+                self._ds.GetRasterBand(b_num).SetNoDataValue(nodata)
+        if ref_path is not None and os.path.isfile(ref_path):
+            ref_ds = gdal.Open(str(ref_path), gdal.GA_ReadOnly)
+            self._ds.SetGeoTransform(ref_ds.GetGeoTransform())
+            self._ds.SetProjection(ref_ds.GetProjection())
+            self._ds.SetMetadata(ref_ds.GetMetadata() or {})
+            for b_num in range(1, min(n_bands, ref_ds.RasterCount) + 1):
+                self._ds.GetRasterBand(b_num).SetDescription(
+                    ref_ds.GetRasterBand(b_num).GetDescription())
+            ref_ds = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, bands: list, xoff: int = 0, yoff: int = 0) -> None:
+        """
+        Write a block of values for each of the raster bands.
+        :param bands: band values - list of np.ndarray
+        :param xoff: block column offset
+        :param yoff: block row offset
+        :return: None
+        """
+        with stage('write_block', raster=self._path):
+            for b_num, b_array in enumerate(bands, start=1):
+                b_array = np.asarray(b_array)
+                if b_array.dtype == np.float16:
+                    # - half precision arrays are not supported by GDAL
+                    b_array = b_array.astype(np.float32)
+                self._ds.GetRasterBand(b_num)\
+                    .WriteArray(b_array, xoff, yoff)
+
+    def close(self) -> None:
+        """Build the overviews, flush data to disk and close the raster"""
+        if self._ds is None:
+            return
+        with stage('close_raster', raster=self._path):
+            if self._overviews:
+                self._ds.BuildOverviews(self._resampling,
+                                        list(self._overviews))
+            self._ds.FlushCache()
+            if self._cog:
+                gdal.GetDriverByName(self._driver)\
+                    .CreateCopy(str(self._path), self._ds,
+                                options=self._options
+                                + ['COPY_SRC_OVERVIEWS=YES'])
+                self._ds = None
+                gdal.GetDriverByName(self._driver)\
+                    .Delete(f'{self._path}.tmp.tif')
+            self._ds = None
+
+
+def _block_size(options: list) -> int:
+    """Tile size set in the GDAL creation options - 512 by default"""
+    for opt in options:
+        if opt.upper().startswith('BLOCKYSIZE='):
+            return int(opt.split('=', 1)[1])
+    return 512
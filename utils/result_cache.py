@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+u"""
+On-disk cache of intermediate results (median images, outlier masks,
+filled bands).
+
+Entries are stored as .npy files and returned memory-mapped. Keys combine
+the fingerprint of the input files with the operator parameters; the
+inputs of each entry are recorded in a JSON file next to it, so that the
+dependencies of every stage output can be inspected. The least recently
+used entries are evicted when the cache exceeds its disk budget.
+"""
+# - python dependencies
+import os
+import json
+import hashlib
+import pathlib
+import datetime
+import threading
+import numpy as np
+
+
+def file_fingerprint(f_path: pathlib.Path, content_hash: bool = False,
+                     chunk_size: int = 2 ** 24) -> str:
+    """
+    Fingerprint of a file: size and modification time, or content hash.
+    :param f_path: file path
+    :param content_hash: hash the file content instead of using its size
+        and modification time
+    :param chunk_size: read size used to hash the file content [bytes]
+    :return: fingerprint - str
+    """
+    if content_hash:
+        f_hash = hashlib.sha1()
+        with open(f_path, 'rb') as f_fid:
+            for chunk in iter(lambda: f_fid.read(chunk_size), b''):
+                f_hash.update(chunk)
+        return f_hash.hexdigest()
+    f_stat = os.stat(f_path)
+    return f'{os.path.abspath(f_path)}:{f_stat.st_size}:{f_stat.st_mtime_ns}'
+
+
+class ResultCache:
+    """Persistent cache of numpy arrays with LRU eviction.
+    ...
+
+    Parameters
+    ----------
+    :param cache_dir - pathlib.Path - cache directory.
+    :param max_size - float - disk budget [GB].
+    :param content_hash - bool - fingerprint the inputs by their content
+        instead of the files size and modification time: outputs are
+        reused as long as the input values do not change (e.g. tiles of a
+        partially re-processed layer).
+
+    Attributes
+    ----------
+    cache_dir       # - Cache directory
+    max_bytes       # - Disk budget [bytes]
+    content_hash    # - Fingerprint the inputs by their content
+    nbytes          # - Disk space used by the cache entries [bytes]
+    stats           # - Cache hits and misses per operator
+
+    Methods
+    -------
+    key - Cache key from operator name, input fingerprints and parameters.
+    get - Return a cached array (memory-mapped) or None.
+    put - Store an array - evict least recently used entries if needed.
+    inputs - Return the inputs recorded for a cache entry.
+    evict - Evict least recently used entries to fit the disk budget.
+    clear - Remove all cache entries.
+
+    Entries access time is tracked through the file modification time, so
+    the cache can be shared by several processes.
+    """
+    def __init__(self, cache_dir: pathlib.Path, max_size: float = 2.,
+                 content_hash: bool = False) -> None:
+        self._cache_dir = pathlib.Path(cache_dir)
+        self._max_bytes = int(max_size * 1024 ** 3)
+        self._content_hash = content_hash
+        self._inputs = {}            # - Inputs of the keys built so far
+        self._stats = {}             # - Hits and misses per operator
+        self._lock = threading.Lock()
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+    @property
+    def cache_dir(self) -> pathlib.Path:
+        """Cache directory"""
+        return self._cache_dir
+
+    @property
+    def max_bytes(self) -> int:
+        """Disk budget [bytes]"""
+        return self._max_bytes
+
+    @property
+    def content_hash(self) -> bool:
+        """Fingerprint the inputs by their content"""
+        return self._content_hash
+
+    @property
+    def stats(self) -> dict:
+        """Cache hits and misses per operator - dict"""
+        with self._lock:
+            return {k: dict(v) for k, v in self._stats.items()}
+
+    @property
+    def nbytes(self) -> int:
+        """Disk space used by the cache entries [bytes]"""
+        return sum(f.stat().st_size for f in self._entries())
+
+    def _entries(self) -> list:
+        return list(self._cache_dir.glob('*.npy'))
+
+    def _entry_path(self, key: str) -> pathlib.Path:
+        return self._cache_dir.joinpath(f'{key}.npy')
+
+    def _inputs_path(self, key: str) -> pathlib.Path:
+        return self._cache_dir.joinpath(f'{key}.json')
+
+    def key(self, operator: str, fingerprints, **params) -> str:
+        """
+        Cache key from operator name, input fingerprints and parameters.
+        The inputs are recorded with the entry when it is stored.
+        :param operator: operator name - str
+        :param fingerprints: fingerprints of the operator inputs
+        :param params: operator parameters - JSON serializable
+        :return: key - str
+        """
+        k_str = json.dumps([operator, fingerprints, params], sort_keys=True,
+                           default=str)
+        key = f'{operator}_{hashlib.sha1(k_str.encode()).hexdigest()}'
+        with self._lock:
+            self._inputs[key] = json.loads(k_str)
+        return key
+
+    def _count(self, key: str, hit: bool) -> None:
+        operator = key.rsplit('_', 1)[0]
+        with self._lock:
+            o_stats = self._stats.setdefault(operator,
+                                             {'hits': 0, 'misses': 0})
+            o_stats['hits' if hit else 'misses'] += 1
+
+    def get(self, key: str) -> np.ndarray:
+        """
+        Return a cached array - memory-mapped, read-only.
+        :param key: cache key
+        :return: np.memmap or None if the key is not cached
+        """
+        e_path = self._entry_path(key)
+        try:
+            array = np.load(e_path, mmap_mode='r')
+            # - mark the entry as recently used
+            os.utime(e_path)
+        except (FileNotFoundError, ValueError):
+            self._count(key, hit=False)
+            return None
+        self._count(key, hit=True)
+        with self._lock:
+            self._inputs.pop(key, None)
+        return array
+
+    def put(self, key: str, array: np.ndarray) -> np.ndarray:
+        """
+        Store an array - evict least recently used entries if needed.
+        :param key: cache key
+        :param array: array to store
+        :return: stored array - memory-mapped, read-only
+        """
+        e_path = self._entry_path(key)
+        t_path = self._cache_dir.joinpath(f'{key}.{os.getpid()}.tmp')
+        with open(t_path, 'wb') as t_fid:
+            np.save(t_fid, np.asarray(array))
+        # - atomic - concurrent writers of the same key are safe
+        os.replace(t_path, e_path)
+        with self._lock:
+            k_inputs = self._inputs.pop(key, None)
+        if k_inputs is not None:
+            operator, fingerprints, params = k_inputs
+            i_path = self._cache_dir.joinpath(f'{key}.{os.getpid()}.jtmp')
+            with open(i_path, 'w', encoding='utf8') as i_fid:
+                json.dump({'operator': operator,
+                           'fingerprints': fingerprints, 'params': params,
+                           'created': datetime.datetime.now().isoformat()},
+                          i_fid, indent=2)
+            os.replace(i_path, self._inputs_path(key))
+        self.evict(keep=e_path)
+        return np.load(e_path, mmap_mode='r') if e_path.exists() else array
+
+    def inputs(self, key: str) -> dict:
+        """
+        Return the inputs recorded for a cache entry.
+        :param key: cache key
+        :return: dict - operator, fingerprints, params, created - or None if
+            no inputs are recorded
+        """
+        try:
+            with open(self._inputs_path(key), 'r', encoding='utf8') as i_fid:
+                return json.load(i_fid)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _remove(self, e_path: pathlib.Path) -> None:
+        """Remove an entry and its inputs record"""
+        for f_path in (e_path, e_path.with_suffix('.json')):
+            try:
+                os.remove(f_path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep: pathlib.Path = None) -> None:
+        """
+        Evict least recently used entries to fit the disk budget.
+        :param keep: entry not to evict - the most recent one
+        :return: None
+        """
+        entries = sorted(((f.stat().st_mtime_ns, f.stat().st_size, f)
+                          for f in self._entries()), key=lambda e: e[0])
+        c_size = sum(e[1] for e in entries)
+        for _, e_size, e_path in entries:
+            if c_size <= self._max_bytes:
+                break
+            if e_path == keep:
+                continue
+            self._remove(e_path)
+            c_size -= e_size
+
+    def clear(self) -> None:
+        """Remove all cache entries"""
+        for e_path in self._entries():
+            self._remove(e_path)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+u"""
+Synthetic AMPCOR offsets layers for testing and benchmarking.
+
+Layers are made of a smooth displacement field plus noise, with clusters
+of gross outliers (low SNR, large covariance) and no-data regions (NaN in
+all the bands). They are written to disk row strip by row strip, so that
+production-size layers (e.g. 20000 x 20000 pixels) can be generated with
+bounded memory. The output is fully determined by the random seed.
+"""
+# - python dependencies
+import os
+import json
+import pathlib
+import numpy as np
+from osgeo import gdal
+from utils.raster_io import RasterWriter, writer_options
+
+# - Offsets layer files: raster file name -> number of bands
+SYNTHETIC_FILES = {'dense_offsets': 2, 'gross_offsets': 2, 'snr': 1,
+                   'covariance': 2}
+# - Layer parameters from high to low resolution:
+# - offsets noise [pixels], outliers fraction
+SYNTHETIC_LEVELS = {'layer1': (0.5, 0.03), 'layer2': (0.3, 0.015),
+                    'layer3': (0.15, 0.005)}
+
+
+def write_envi_header(f_path: pathlib.Path, shape: tuple, n_bands: int,
+                      interleave: str = 'bip', byte_order: int = 0,
+                      file_type: str = 'ENVI Standard') -> None:
+    """
+    Write the ENVI header (f_path.hdr) of a float32 raster.
+    :param f_path: raster path
+    :param shape: raster shape (rows, columns)
+    :param n_bands: number of bands
+    :param interleave: bands interleave [bip, bil, bsq]
+    :param byte_order: 0: little endian, 1: big endian
+    :param file_type: ENVI file type - e.g. 'TIFF' for GTiff rasters
+    :return: None
+    """
+    with open(f'{f_path}.hdr', 'w', encoding='utf8') as h_fid:
+        h_fid.write(f'ENVI\nsamples = {shape[1]}\nlines = {shape[0]}\n'
+                    f'bands = {n_bands}\nheader offset = 0\n'
+                    f'file type = {file_type}\ndata type = 4\n'
+                    f'interleave = {interleave}\n'
+                    f'byte order = {byte_order}\n')
+
+
+def write_envi_raster(f_path: pathlib.Path, bands: np.ndarray,
+                      interleave: str = 'bip',
+                      byte_order: int = 0) -> pathlib.Path:
+    """
+    Write a flat binary float32 ENVI raster and its header.
+    :param f_path: raster path
+    :param bands: band values - np.ndarray (bands, rows, columns)
+    :param interleave: bands interleave [bip, bil, bsq]
+    :param byte_order: 0: little endian, 1: big endian
+    :return: raster path - pathlib.Path
+    """
+    order = {'bsq': (0, 1, 2), 'bil': (1, 0, 2), 'bip': (1, 2, 0)}
+    dtype = np.dtype('>f4' if byte_order else '<f4')
+    np.ascontiguousarray(np.transpose(bands, order[interleave]),
+                         dtype=dtype).tofile(f_path)
+    write_envi_header(f_path, bands.shape[1:], bands.shape[0],
+                      interleave=interleave, byte_order=byte_order)
+    return pathlib.Path(f_path)
+
+
+def write_random_layer(d_path: pathlib.Path, shape: tuple,
+                       rng: np.random.Generator) -> pathlib.Path:
+    """
+    Write an offsets layer of random values (normal, standard deviation 5 -
+    absolute values for SNR and covariance) - small test layers.
+    :param d_path: output layer directory
+    :param shape: layer shape (rows, columns)
+    :param rng: random number generator
+    :return: layer directory - pathlib.Path
+    """
+    d_path = pathlib.Path(d_path)
+    d_path.mkdir(parents=True, exist_ok=True)
+    for f_name, n_b in SYNTHETIC_FILES.items():
+        values = rng.normal(0., 5., (shape[0], shape[1], n_b))
+        if f_name in ['snr', 'covariance']:
+            values = np.abs(values)
+        write_envi_raster(d_path.joinpath(f_name), values.transpose(2, 0, 1))
+    return d_path
+
+
+def smooth_field(rows: np.ndarray, cols: np.ndarray, shape: tuple,
+                 seed: int = 0, amplitude: float = 10.,
+                 n_waves: int = 4) -> tuple:
+    """
+    Smooth displacement field - sum of plane waves with wavelengths
+    between 1/4 and 1 times the layer size.
+    :param rows: row coordinates - np.ndarray
+    :param cols: column coordinates - np.ndarray
+    :param shape: layer shape (rows, columns)
+    :param seed: random seed - the same field is returned for all layers
+        generated with the same seed
+    :param amplitude: field amplitude [pixels]
+    :param n_waves: number of plane waves
+    :return: azimuth field, range field - np.ndarray
+    """
+    rng = np.random.default_rng([seed, 0])
+    fields = []
+    for _ in range(2):
+        field = np.zeros(np.broadcast(rows, cols).shape, dtype=np.float32)
+        for _ in range(n_waves):
+            k_row, k_col = rng.uniform(1., 4., 2) / np.asarray(shape)
+            phase = rng.uniform(0., 2. * np.pi)
+            field += np.sin(2. * np.pi * (k_row * rows + k_col * cols)
+                            + phase).astype(np.float32)
+        fields.append(field * (amplitude / n_waves))
+    return tuple(fields)
+
+
+def random_disks(shape: tuple, fraction: float, radius: tuple,
+                 rng: np.random.Generator) -> np.ndarray:
+    """
+    Random disks covering approximately a fraction of the layer.
+    :param shape: layer shape (rows, columns)
+    :param fraction: covered fraction of the layer
+    :param radius: (min, max) disks radius [pixels]
+    :param rng: random number generator
+    :return: disks (row, column, radius) sorted by row - np.ndarray
+    """
+    m_area = np.pi * np.mean(np.square(radius))
+    n_disks = int(round(fraction * shape[0] * shape[1] / m_area))
+    disks = np.column_stack([rng.uniform(0, shape[0], n_disks),
+                             rng.uniform(0, shape[1], n_disks),
+                             rng.uniform(radius[0], radius[1], n_disks)])
+    return disks[np.argsort(disks[:, 0])]
+
+
+def disks_mask(disks: np.ndarray, rows: slice, n_cols: int) -> np.ndarray:
+    """
+    Rasterize the disks intersecting a strip of rows.
+    :param disks: disks (row, column, radius) sorted by row - np.ndarray
+    :param rows: strip rows - slice
+    :param n_cols: number of columns
+    :return: strip binary mask - np.ndarray
+    """
+    mask = np.zeros((rows.stop - rows.start, n_cols), dtype=bool)
+    if disks.size == 0:
+        return mask
+    r_max = disks[:, 2].max()
+    first, last = np.searchsorted(disks[:, 0], [rows.start - r_max,
+                                                rows.stop + r_max])
+    for d_row, d_col, d_rad in disks[first:last]:
+        r_0 = max(int(np.floor(d_row - d_rad)), rows.start)
+        r_1 = min(int(np.ceil(d_row + d_rad)) + 1, rows.stop)
+        c_0 = max(int(np.floor(d_col - d_rad)), 0)
+        c_1 = min(int(np.ceil(d_col + d_rad)) + 1, n_cols)
+        if r_0 >= r_1 or c_0 >= c_1:
+            continue
+        d_r = np.arange(r_0, r_1)[:, None] + 0.5 - d_row
+        d_c = np.arange(c_0, c_1)[None, :] + 0.5 - d_col
+        mask[r_0 - rows.start:r_1 - rows.start, c_0:c_1] \
+            |= d_r ** 2 + d_c ** 2 <= d_rad ** 2
+    return mask
+
+
+def synthetic_strip(rows: slice, shape: tuple, seed: int, level: int,
+                    noise: float, outliers: np.ndarray,
+                    nodata: np.ndarray) -> dict:
+    """
+    Compute the bands of a strip of rows of a synthetic layer.
+    :param rows: strip rows - slice
+    :param shape: layer shape (rows, columns)
+    :param seed: random seed
+    :param level: layer level - 0: high resolution
+    :param noise: offsets noise [pixels]
+    :param outliers: outlier clusters (row, column, radius) - np.ndarray
+    :param nodata: no-data regions (row, column, radius) - np.ndarray
+    :return: raster file name -> list of band values - dict
+    """
+    n_rows = rows.stop - rows.start
+    rng = np.random.default_rng([seed, level + 1, rows.start])
+    r_crd = np.arange(rows.start, rows.stop, dtype=np.float32)[:, None]
+    c_crd = np.arange(shape[1], dtype=np.float32)[None, :]
+    f_az, f_rg = smooth_field(r_crd, c_crd, shape, seed=seed)
+    s_shape = (n_rows, shape[1])
+    off_az = f_az + rng.normal(0., noise, s_shape).astype(np.float32)
+    off_rg = f_rg + rng.normal(0., noise, s_shape).astype(np.float32)
+    snr = rng.gamma(4., 3., s_shape).astype(np.float32)
+    cov_az = (noise ** 2 * rng.exponential(1., s_shape)).astype(np.float32)
+    cov_rg = (noise ** 2 * rng.exponential(1., s_shape)).astype(np.float32)
+    # - gross outliers - random offsets, low SNR, large covariance
+    o_mask = disks_mask(outliers, rows, shape[1])
+    n_out = int(o_mask.sum())
+    off_az[o_mask] = rng.uniform(-50., 50., n_out)
+    off_rg[o_mask] = rng.uniform(-50., 50., n_out)
+    snr[o_mask] = rng.uniform(0., 3., n_out)
+    cov_az[o_mask] = rng.uniform(1., 10., n_out)
+    cov_rg[o_mask] = rng.uniform(1., 10., n_out)
+    bands = {'dense_offsets': [off_az, off_rg],
+             'gross_offsets': [np.round(f_az), np.round(f_rg)],
+             'snr': [snr], 'covariance': [cov_az, cov_rg]}
+    # - no-data regions - NaN in all the bands
+    n_mask = disks_mask(nodata, rows, shape[1])
+    for b_list in bands.values():
+        for b_values in b_list:
+            b_values[n_mask] = np.nan
+    return bands
+
+
+def write_synthetic_layer(d_path: pathlib.Path, shape: tuple, seed: int = 0,
+                          level: int = 0, noise: float = 0.5,
+                          outlier_fraction: float = 0.03,
+                          nodata_fraction: float = 0.02,
+                          out_format: str = 'ENVI',
+                          compress: str = 'DEFLATE',
+                          block_rows: int = 512) -> pathlib.Path:
+    """
+    Write a synthetic offsets layer.
+    ENVI rasters are flat binary, band interleaved by pixel. GTiff rasters
+    are tiled and compressed - an ENVI header is written next to each
+    raster so that the layer can be read by OffsetsLayer.
+    :param d_path: output layer directory
+    :param shape: layer shape (rows, columns)
+    :param seed: random seed
+    :param level: layer level - 0: high resolution
+    :param noise: offsets noise [pixels]
+    :param outlier_fraction: fraction of the layer covered by outliers
+    :param nodata_fraction: fraction of the layer covered by no-data
+    :param out_format: raster format [ENVI, GTiff]
+    :param compress: GTiff compression algorithm
+    :param block_rows: number of rows generated at once
+    :return: layer directory - pathlib.Path
+    """
+    if out_format not in ['ENVI', 'GTiff']:
+        raise ValueError(f'# - Unsupported synthetic layer format: '
+                         f'{out_format}')
+    d_path = pathlib.Path(d_path)
+    os.makedirs(d_path, exist_ok=True)
+    rng = np.random.default_rng([seed, level + 1])
+    outliers = random_disks(shape, outlier_fraction, (2., 12.), rng)
+    # - no-data regions are shared by all the layers of a pair
+    nodata = random_disks(shape, nodata_fraction, (20., 60.),
+                          np.random.default_rng([seed, 0]))
+    if out_format == 'ENVI':
+        writers = {f: open(d_path.joinpath(f), 'wb')
+                   for f in SYNTHETIC_FILES}
+    else:
+        w_kwd = writer_options('GTiff', gdal.GDT_Float32, compress=compress,
+                               overviews=None)
+        writers = {f: RasterWriter(d_path.joinpath(f), shape, n_b,
+                                   nodata=np.nan, **w_kwd)
+                   for f, n_b in SYNTHETIC_FILES.items()}
+    try:
+        for row in range(0, shape[0], block_rows):
+            rows = slice(row, min(row + block_rows, shape[0]))
+            bands = synthetic_strip(rows, shape, seed, level, noise,
+                                    outliers, nodata)
+            for f_name, b_list in bands.items():
+                if out_format == 'ENVI':
+                    np.stack(b_list, axis=-1).astype('<f4')\
+                        .tofile(writers[f_name])
+                else:
+                    writers[f_name].write(b_list, yoff=row)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    f_type = 'ENVI Standard' if out_format == 'ENVI' else 'TIFF'
+    for f_name, n_b in SYNTHETIC_FILES.items():
+        write_envi_header(d_path.joinpath(f_name), shape, n_b,
+                          file_type=f_type)
+    return d_path
+
+
+def write_synthetic_pair(d_path: pathlib.Path, shape: tuple, seed: int = 0,
+                         **kwargs) -> list:
+    """
+    Write the three offsets layers of a synthetic image pair (layer1,
+    layer2, layer3 - from high to low resolution). The layers share the
+    displacement field and the no-data regions. Existing layers generated
+    with the same parameters are not written again.
+    :param d_path: output pair directory
+    :param shape: layers shape (rows, columns)
+    :param seed: random seed
+    :param kwargs: write_synthetic_layer keywords
+    :return: layers directories - list of pathlib.Path
+    """
+    d_path = pathlib.Path(d_path)
+    s_param = {'shape': list(shape), 'seed': seed, **kwargs}
+    p_path = d_path.joinpath('synthetic.json')
+    l_paths = [d_path.joinpath(l_name) for l_name in SYNTHETIC_LEVELS]
+    if p_path.is_file():
+        with open(p_path, 'r', encoding='utf8') as p_fid:
+            if json.load(p_fid) == s_param:
+                return l_paths
+    for level, (l_path, (noise, o_frac)) \
+            in enumerate(zip(l_paths, SYNTHETIC_LEVELS.values())):
+        write_synthetic_layer(l_path, shape, seed=seed, level=level,
+                              **{'noise': noise, 'outlier_fraction': o_frac,
+                                 **kwargs})
+    with open(p_path, 'w', encoding='utf8') as p_fid:
+        json.dump(s_param, p_fid)
+    return l_paths
@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import pytest
+from utils.envi_header import parse_envi_header, read_envi_header
+
+
+def test_parse_envi_header(tmp_path):
+    hdr_path = tmp_path.joinpath('dense_offsets.hdr')
+    hdr_path.write_text('ENVI\n'
+                        'description = {\n'
+                        '  AMPCOR dense offsets}\n'
+                        'samples = 40\n'
+                        'Lines   = 30\n'
+                        'band names = { Band 1,\n Band 2 }\n'
+                        'data type = 4\n')
+    header = parse_envi_header(hdr_path)
+    assert header['description'] == 'AMPCOR dense offsets'
+    assert header['samples'] == '40'
+    assert header['lines'] == '30'
+    assert header['band names'] == 'Band 1, Band 2'
+    assert header['data type'] == '4'
+
+
+def test_parse_invalid_header(tmp_path):
+    hdr_path = tmp_path.joinpath('snr.hdr')
+    hdr_path.write_text('samples = 40\n')
+    with pytest.raises(ValueError):
+        parse_envi_header(hdr_path)
+
+
+def test_read_envi_header(tmp_path):
+    hdr_path = tmp_path.joinpath('covariance.hdr')
+    hdr_path.write_text('ENVI\n'
+                        'samples = 40\n'
+                        'lines = 30\n'
+                        'bands = 2\n'
+                        'header offset = 0\n'
+                        'data type = 4\n'
+                        'interleave = BIP\n'
+                        'byte order = 1\n'
+                        'band names = {\n cov_az,\n cov_rg}\n'
+                        'map info = {UTM, 1.0, 1.0, 500000.0, 7000000.0,\n'
+                        ' 240.0, 120.0, 22, North, WGS-84, units=Meters}\n')
+    header = read_envi_header(hdr_path)
+    assert header.shape == (30, 40)
+    assert header.bands == 2 and header.interleave == 'bip'
+    assert header.dtype == np.dtype('>f4')
+    assert header.nbytes == 30 * 40 * 2 * 4
+    assert header.band_names == ('cov_az', 'cov_rg')
+    assert header.map_info.zone == 22 and header.map_info.datum == 'WGS-84'
+    assert header.map_info.units == 'Meters'
+    assert header.geotransform == (500000.0, 240.0, 0.0,
+                                   7000000.0, 0.0, -120.0)
+    # - cached
+    assert read_envi_header(hdr_path) is header
+    # - refreshed if the file changes
+    hdr_path.write_text(hdr_path.read_text().replace('lines = 30',
+                                                     'lines = 300'))
+    os.utime(hdr_path, ns=(0, os.stat(hdr_path).st_mtime_ns + 10 ** 9))
+    assert read_envi_header(hdr_path).shape == (300, 40)
@@ -0,0 +1,95 @@
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pytest
+from utils.layer_store import LayerStore
+
+
+def load_bands(f_path: pathlib.Path, count_path: pathlib.Path):
+    """Band loader - each call is recorded in count_path"""
+    def loader(bands: list, dtypes: list) -> list:
+        with open(count_path, 'a', encoding='utf8') as c_fid:
+            c_fid.write(f'{os.getpid()}\n')
+        values = np.load(f_path)
+        return [values[b_num - 1].astype(dt)
+                for b_num, dt in zip(bands, dtypes)]
+    return loader
+
+
+# - worker process store - kept open until the process exits
+_STORES = {}
+
+
+def attach_worker(store_dir: pathlib.Path, f_path: pathlib.Path,
+                  count_path: pathlib.Path) -> float:
+    """Attach the raster bands from a worker process - not closed"""
+    if store_dir not in _STORES:
+        _STORES[store_dir] = LayerStore(store_dir)
+    store = _STORES[store_dir]
+    b_maps = store.attach(f_path, [1, 2], [np.float32] * 2,
+                          load_bands(f_path, count_path))
+    return float(sum(np.nansum(b) for b in b_maps))
+
+
+def test_layer_store(tmp_path: pathlib.Path):
+    values = np.random.default_rng(0).normal(size=(2, 30, 40))
+    f_path = tmp_path.joinpath('raster.npy')
+    np.save(f_path, values)
+    count_path = tmp_path.joinpath('loads.txt')
+    loader = load_bands(f_path, count_path)
+    store_dir = tmp_path.joinpath('store')
+
+    with LayerStore(store_dir) as store_1:
+        b_maps = store_1.attach(f_path, [1, 2], [np.float32, np.float16],
+                                loader)
+        assert [b.dtype for b in b_maps] == [np.float32, np.float16]
+        assert isinstance(b_maps[0], np.memmap)
+        assert not b_maps[0].flags.writeable
+        np.testing.assert_array_equal(b_maps[0],
+                                      values[0].astype(np.float32))
+        store_2 = LayerStore(store_dir)
+        # - stored bands are attached - not loaded again
+        s_maps = store_2.attach(f_path, [2], [np.float16], loader)
+        np.testing.assert_array_equal(s_maps[0], b_maps[1])
+        assert len(count_path.read_text().split()) == 1
+        assert store_1.stats == {'loaded': 2, 'attached': 0}
+        assert store_2.stats == {'loaded': 0, 'attached': 1}
+        key = LayerStore.key(f_path, 2, np.float16)
+        assert store_1.refs(key) == 2
+        assert store_1.nbytes > 0
+    # - bands are removed with their last reference
+    assert store_2.refs(key) == 1
+    assert store_2.nbytes > 0
+    assert store_2.refs(LayerStore.key(f_path, 1, np.float32)) == 0
+    store_2.close()
+    assert store_2.nbytes == 0
+    # - mapped bands stay valid
+    np.testing.assert_array_equal(s_maps[0], values[1].astype(np.float16))
+
+    # - a different data type is a different band
+    assert LayerStore.key(f_path, 1, np.float16) \
+        != LayerStore.key(f_path, 1, np.float32)
+
+
+@pytest.mark.parametrize('n_procs', [3])
+def test_layer_store_processes(tmp_path: pathlib.Path, n_procs: int):
+    """Verify that bands are loaded once by concurrent processes"""
+    values = np.random.default_rng(0).normal(size=(2, 300, 400))
+    f_path = tmp_path.joinpath('raster.npy')
+    np.save(f_path, values)
+    count_path = tmp_path.joinpath('loads.txt')
+    store_dir = tmp_path.joinpath('store')
+    with ProcessPoolExecutor(max_workers=n_procs) as pool:
+        sums = list(pool.map(attach_worker, *zip(*[(store_dir, f_path,
+                                                   count_path)] * 6)))
+    np.testing.assert_allclose(sums, values.astype(np.float32).sum(),
+                               rtol=1e-5)
+    assert len(count_path.read_text().split()) == 1
+    # - workers exited without closing their stores
+    store = LayerStore(store_dir)
+    assert store.nbytes > 0
+    assert store.refs(LayerStore.key(f_path, 1, np.float32)) == 0
+    store.cleanup()
+    assert store.nbytes == 0
+    assert not list(store_dir.glob('*.ref'))
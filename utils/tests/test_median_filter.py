@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from utils.median_filter import median_filter, mad_filter, \
+    median_filter_bands, mean_std_filter, median_filter_at, \
+    median_filter_bands_at
+
+
+def offsets_field(shape: tuple = (120, 90)) -> np.ndarray:
+    """Smooth offsets field + noise + sparse outliers"""
+    rng = np.random.default_rng(0)
+    az, rg = np.meshgrid(np.linspace(-3, 3, shape[0]),
+                         np.linspace(-2, 2, shape[1]), indexing='ij')
+    values = 2. * az + rg + rng.normal(0., 0.3, shape)
+    values[rng.random(shape) < 0.03] += 40.
+    return values.astype(np.float32)
+
+
+@pytest.mark.parametrize('size', [(9, 9), (21, 15), (50, 50)])
+def test_histogram_median_parity(size):
+    values = offsets_field()
+    reference = ndimage.median_filter(values, size)
+    median = median_filter(values, size, engine='histogram', n_levels=1024)
+    v_min, v_max = np.percentile(values, [0.1, 99.9])
+    # - exact up to half a quantization step
+    assert np.abs(median - reference).max() <= (v_max - v_min) / 1023 / 2 \
+        + 1e-5
+
+
+@pytest.mark.parametrize('size', [(9, 9), (21, 15), (51, 51)])
+def test_separable_median_parity(size):
+    values = offsets_field()
+    reference = ndimage.median_filter(values, size)
+    median = median_filter(values, size, engine='separable')
+    # - approximate - error well below the noise level
+    assert np.percentile(np.abs(median - reference), 99) < 0.3
+
+
+def test_invalid_engine():
+    with pytest.raises(ValueError):
+        median_filter(offsets_field(), (5, 5), engine='sort')
+
+
+def nan_median_brute(values: np.ndarray, size: tuple) -> np.ndarray:
+    """Reference NaN-aware median - rank n_valid // 2 as scipy"""
+    pad = [(s // 2, s - 1 - s // 2) for s in size]
+    padded = np.pad(values, pad, mode='symmetric')
+    median = np.full(values.shape, np.nan)
+    for row in range(values.shape[0]):
+        for col in range(values.shape[1]):
+            window = padded[row:row + size[0], col:col + size[1]].ravel()
+            window = np.sort(window[np.isfinite(window)])
+            if window.size:
+                median[row, col] = window[window.size // 2]
+    return median
+
+
+@pytest.mark.parametrize('size', [(5, 5), (6, 3)])
+def test_nan_median(size):
+    values = offsets_field((30, 25))
+    rng = np.random.default_rng(1)
+    values[rng.random(values.shape) < 0.4] = np.nan
+    values[:8, :8] = np.nan
+    reference = nan_median_brute(values, size)
+    median = median_filter(values, size)
+    np.testing.assert_array_equal(median, reference.astype(np.float32))
+    median = median_filter(values, size, engine='histogram', n_levels=4096)
+    np.testing.assert_array_equal(np.isnan(median), np.isnan(reference))
+    assert np.nanmax(np.abs(median - reference)) < 0.05
+
+
+def test_nan_median_min_valid():
+    values = offsets_field((30, 25))
+    values[:, :12] = np.nan
+    median = median_filter(values, (5, 5), min_valid=15)
+    # - windows centered on column 12 hold 3 x 5 valid samples
+    assert np.isnan(median[:, :12]).all()
+    assert np.isfinite(median[:, 12:]).all()
+    median = median_filter(values, (5, 5), min_valid=16)
+    assert np.isnan(median[:, :13]).all()
+
+
+@pytest.mark.parametrize('engine', ['scipy', 'separable', 'histogram'])
+def test_min_valid_window_area(engine):
+    """Verify that min_valid applies with and without NaN samples"""
+    values = offsets_field((30, 25))
+    n_values = values.copy()
+    n_values[0, 0] = np.nan
+    for v in [values, n_values]:
+        assert np.isnan(median_filter(v, (5, 5), engine=engine,
+                                      min_valid=26)).all()
+        assert np.isfinite(median_filter(v, (5, 5), engine=engine,
+                                         min_valid=25)[5:, 5:]).all()
+
+
+def test_mad_filter():
+    values = offsets_field()
+    size = (9, 9)
+    median = median_filter(values, size)
+    np.testing.assert_array_equal(mad_filter(values, size),
+                                  ndimage.median_filter(
+                                      np.abs(values - median), size))
+
+
+def test_median_filter_bands():
+    bands = [offsets_field(), -offsets_field(), 2. * offsets_field()]
+    medians = median_filter_bands(bands, (7, 7), n_workers=3)
+    for band, median in zip(bands, medians):
+        np.testing.assert_array_equal(median, median_filter(band, (7, 7)))
+
+
+@pytest.mark.parametrize('engine', ['scipy', 'separable', 'histogram'])
+def test_median_filter_at(engine):
+    values = offsets_field()
+    rng = np.random.default_rng(2)
+    values[rng.random(values.shape) < 0.1] = np.nan
+    values[:10, :6] = np.nan
+    mask = rng.random(values.shape) < 0.05
+    mask[:3, :3] = True
+    size = (9, 7)
+    reference = median_filter(values, size, engine=engine, min_valid=10)
+    median = median_filter_at(values, size, mask, engine=engine,
+                              min_valid=10, tile_size=(32, 40))
+    np.testing.assert_array_equal(np.isnan(median), np.isnan(reference[mask]))
+    if engine == 'histogram':
+        # - values quantized tile by tile
+        assert np.nanmax(np.abs(median - reference[mask])) < 0.1
+    else:
+        np.testing.assert_array_equal(median, reference[mask])
+    # - np.where index - same order as the index
+    index = np.nonzero(mask)
+    index = (index[0][::-1], index[1][::-1])
+    np.testing.assert_array_equal(
+        median_filter_bands_at([values], size, index, engine=engine,
+                               min_valid=10, tile_size=(32, 40))[0],
+        median[::-1])
+
+
+def test_mean_std_filter():
+    values = offsets_field((40, 30)).astype(np.float64)
+    values[5:9, 7] = np.nan
+    size = (5, 7)
+    mean, std = mean_std_filter(values, size, min_valid=20)
+    # - brute force reference - reflect border handling
+    padded = np.pad(values, ((2, 2), (3, 3)), mode='symmetric')
+    for row, col in [(0, 0), (6, 7), (20, 15), (39, 29)]:
+        window = padded[row:row + size[0], col:col + size[1]]
+        np.testing.assert_allclose(mean[row, col], np.nanmean(window))
+        np.testing.assert_allclose(std[row, col], np.nanstd(window),
+                                   rtol=1e-6)
+    mean, std = mean_std_filter(values, size, min_valid=33)
+    assert np.isnan(mean[6, 7]) and np.isnan(std[6, 7])
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from utils.outliers_mask import OutliersMask, as_index
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_outliers_mask(packed):
+    rng = np.random.default_rng(0)
+    mask = rng.random((37, 53)) < 0.1
+    o_mask = OutliersMask(mask, packed=packed)
+    assert o_mask.shape == mask.shape
+    assert o_mask.count == mask.sum()
+    np.testing.assert_array_equal(o_mask.to_bool(), mask)
+    np.testing.assert_array_equal(o_mask.to_float(), mask.astype(float))
+    for ind_a, ind_b in zip(o_mask.indices(), np.where(mask)):
+        np.testing.assert_array_equal(ind_a, ind_b)
+    # - direct indexing
+    values = rng.normal(size=mask.shape)
+    np.testing.assert_array_equal(values[o_mask], values[mask])
+    np.testing.assert_array_equal(values[as_index(o_mask)], values[mask])
+    np.testing.assert_array_equal(o_mask[2:5, 3:9], mask[2:5, 3:9])
+
+
+def test_outliers_mask_storage():
+    mask = np.zeros((400, 400), dtype=bool)
+    mask[::7, ::3] = True
+    assert OutliersMask(mask).nbytes == mask.size
+    p_mask = OutliersMask(mask).pack()
+    assert p_mask.packed and p_mask.nbytes == mask.size // 8
+    np.testing.assert_array_equal(p_mask.unpack().to_bool(), mask)
+    i_mask = OutliersMask.from_index(np.where(mask), mask.shape)
+    np.testing.assert_array_equal(i_mask.to_bool(), mask)
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_outliers_mask_compatibility(packed):
+    """Verify that the mask behaves as the legacy 0/1 binary mask"""
+    mask = np.random.default_rng(0).random((37, 53)) < 0.1
+    o_mask = OutliersMask(mask, packed=packed)
+    b_mask = mask.astype(float)
+    np.testing.assert_array_equal(o_mask == 1, b_mask == 1)
+    np.testing.assert_array_equal(o_mask != 0, mask)
+    np.testing.assert_array_equal(1 - o_mask, 1 - b_mask)
+    np.testing.assert_array_equal(o_mask.T, b_mask.T)
+    assert o_mask.sum() == mask.sum() == o_mask.count
+    np.testing.assert_array_equal(o_mask.sum(axis=0), b_mask.sum(axis=0))
+    # - the mask storage cannot be modified
+    b_view = o_mask.to_bool()
+    if packed:
+        b_view[0, 0] = not mask[0, 0]
+    else:
+        with pytest.raises(ValueError):
+            b_view[0, 0] = not mask[0, 0]
+    assert o_mask.count == mask.sum()
+    np.testing.assert_array_equal(o_mask.to_bool(), mask)
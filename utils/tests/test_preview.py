@@ -0,0 +1,32 @@
+import numpy as np
+from utils.preview import preview_factor, block_mean, blocked_histogram
+
+
+def test_block_mean():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(103, 77))
+    values[:4, :4] = np.nan
+    values[10, 10] = np.nan
+    assert preview_factor(values.shape, max_size=50) == 3
+    assert preview_factor(values.shape, max_size=200) == 1
+    preview = block_mean(values, 4, block_rows=5)
+    assert preview.shape == (26, 20)
+    assert np.isnan(preview[0, 0])
+    np.testing.assert_allclose(preview[2, 2], np.nanmean(values[8:12, 8:12]),
+                               rtol=1e-5)
+    # - partial blocks along the borders
+    np.testing.assert_allclose(preview[-1, -1], values[100:, 76:].mean(),
+                               rtol=1e-5)
+    np.testing.assert_array_equal(block_mean(values, 1), values)
+
+
+def test_blocked_histogram():
+    rng = np.random.default_rng(0)
+    values = rng.normal(0., 5., size=(300, 200))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    counts, edges = blocked_histogram(values, 41, (-20, 20), block_rows=7)
+    reference = np.histogram(values[np.isfinite(values)], 41, (-20, 20))
+    np.testing.assert_array_equal(counts, reference[0])
+    np.testing.assert_allclose(edges, reference[1])
+    counts, edges = blocked_histogram(values, 41, (-20, 20), density=True)
+    np.testing.assert_allclose((counts * np.diff(edges)).sum(), 1.)
@@ -0,0 +1,88 @@
+import csv
+import json
+import time
+import threading
+import numpy as np
+import pytest
+from utils.profiling import StageProfiler, stage, profiled, _reset_peak_rss
+
+
+@profiled('sleep')
+def _sleep(seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+def test_stage_profiler(tmp_path):
+    # - no profiler enabled - stages are not recorded
+    with stage('idle'):
+        pass
+    assert _sleep(0.) == 0.
+    with StageProfiler() as profiler:
+        with stage('outer', band='offsets_az'):
+            assert _sleep(0.02) == 0.02
+        _sleep(0.)
+    with stage('after'):
+        pass
+    records = profiler.records
+    assert [r['stage'] for r in records] == ['sleep', 'outer', 'sleep']
+    assert records[1]['info'] == {'band': 'offsets_az'}
+    assert records[1]['wall_time'] >= records[0]['wall_time'] >= 0.02
+    assert records[0]['cpu_time'] < 0.02
+    summary = profiler.summary()
+    assert summary['sleep']['count'] == 2 and summary['outer']['count'] == 1
+
+    profiler.to_json(tmp_path.joinpath('report.json'))
+    profiler.to_csv(tmp_path.joinpath('report.csv'))
+    with open(tmp_path.joinpath('report.json'), 'r', encoding='utf8') as fid:
+        assert json.load(fid)['summary'] == json.loads(json.dumps(summary))
+    with open(tmp_path.joinpath('report.csv'), 'r', encoding='utf8') as fid:
+        rows = list(csv.DictReader(fid))
+    assert [r['stage'] for r in rows] == ['sleep', 'outer', 'sleep']
+
+
+def test_stage_peak_rss():
+    """Verify that each stage reports its own memory peak"""
+    if not _reset_peak_rss():
+        pytest.skip('peak memory cannot be reset on this platform')
+    n_bytes = 200 * 1024 ** 2
+    with StageProfiler() as profiler:
+        with stage('outer'):
+            with stage('large'):
+                values = np.ones(n_bytes // 8)
+                del values
+            with stage('small'):
+                np.ones(10)
+    peaks = {r['stage']: r['peak_rss'] for r in profiler.records}
+    assert peaks['large'] - peaks['small'] > n_bytes // 2
+    # - the peaks of nested stages are not lost by the reset
+    assert peaks['outer'] >= peaks['large']
+
+
+def test_stage_thread_counters(tmp_path):
+    """Verify that stages are not charged for the work of other threads"""
+    f_path = tmp_path.joinpath('data.bin')
+    f_path.write_bytes(b'0' * 2 ** 24)
+    started = threading.Event()
+
+    def busy() -> None:
+        started.wait()
+        t_end = time.perf_counter() + 0.2
+        while time.perf_counter() < t_end:
+            pass
+        f_path.read_bytes()
+
+    worker = threading.Thread(target=busy)
+    worker.start()
+    with StageProfiler() as profiler:
+        with stage('idle'):
+            started.set()
+            worker.join()
+        with stage('read'):
+            f_path.read_bytes()
+    records = {r['stage']: r for r in profiler.records}
+    assert records['idle']['wall_time'] >= 0.2
+    assert records['idle']['cpu_time'] < 0.1
+    if records['read']['bytes_read'] is not None:
+        assert records['idle']['bytes_read'] < 2 ** 20
+        assert records['read']['bytes_read'] >= 2 ** 24
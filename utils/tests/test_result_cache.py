@@ -0,0 +1,43 @@
+import os
+import numpy as np
+from utils.result_cache import ResultCache, file_fingerprint
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(tmp_path.joinpath('cache'), max_size=2.5e-6)
+    values = np.arange(100, dtype=np.float64).reshape(10, 10)
+    key = cache.key('median_images', ['fp'], size=(3, 3), engine='scipy')
+    assert key == cache.key('median_images', ['fp'], engine='scipy',
+                            size=(3, 3))
+    assert key != cache.key('median_images', ['fp'], size=(5, 5),
+                            engine='scipy')
+    assert cache.get(key) is None
+    stored = cache.put(key, values)
+    assert isinstance(stored, np.memmap) and not stored.flags.writeable
+    np.testing.assert_array_equal(cache.get(key), values)
+    assert cache.inputs(key)['params'] == {'size': [3, 3], 'engine': 'scipy'}
+    assert cache.inputs(key)['fingerprints'] == ['fp']
+    assert cache.stats == {'median_images': {'hits': 1, 'misses': 1}}
+
+    # - least recently used entries are evicted first - budget ~2 entries
+    keys = [key] + [cache.key('test', [i]) for i in range(2)]
+    cache.put(keys[1], values)
+    os.utime(cache.cache_dir.joinpath(f'{keys[1]}.npy'), ns=(0, 0))
+    assert cache.get(key) is not None
+    cache.put(keys[2], values)
+    assert cache.get(keys[1]) is None
+    assert cache.get(key) is not None and cache.get(keys[2]) is not None
+    assert cache.nbytes <= cache.max_bytes
+    cache.clear()
+    assert cache.nbytes == 0
+    assert not list(cache.cache_dir.iterdir())
+
+
+def test_file_fingerprint(tmp_path):
+    f_path = tmp_path.joinpath('raster')
+    f_path.write_bytes(b'0123')
+    fp_stat = file_fingerprint(f_path)
+    fp_hash = file_fingerprint(f_path, content_hash=True)
+    f_path.write_bytes(b'01234')
+    assert file_fingerprint(f_path) != fp_stat
+    assert file_fingerprint(f_path, content_hash=True) != fp_hash
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from offsets_layer import OffsetsLayer
+from utils.synthetic_layers import write_synthetic_pair, disks_mask
+
+
+def test_disks_mask():
+    disks = np.array([[5., 5., 2.], [20., 3., 1.5]])
+    full = disks_mask(disks, slice(0, 30), 10)
+    assert full[5, 5] and full[20, 3] and not full[12, 5]
+    # - strips are consistent with the full mask
+    strips = np.vstack([disks_mask(disks, slice(r, r + 7), 10)
+                        for r in range(0, 28, 7)]
+                       + [disks_mask(disks, slice(28, 30), 10)])
+    np.testing.assert_array_equal(strips, full)
+
+
+@pytest.mark.parametrize('out_format', ['ENVI', 'GTiff'])
+def test_write_synthetic_pair(tmp_path, out_format):
+    shape = (300, 250)
+    l_paths = write_synthetic_pair(tmp_path.joinpath('pair'), shape, seed=3,
+                                   nodata_fraction=0.1,
+                                   out_format=out_format, block_rows=64)
+    assert [p.name for p in l_paths] == ['layer1', 'layer2', 'layer3']
+    layer_1 = OffsetsLayer(l_paths[0])
+    layer_3 = OffsetsLayer(l_paths[2], reader='memmap')
+    assert layer_1.size == layer_3.size == shape
+    # - no-data regions are shared by all the layers
+    no_data = np.isnan(layer_1.offsets_az)
+    assert no_data.any()
+    np.testing.assert_array_equal(np.isnan(layer_3.snr), no_data)
+    # - outlier clusters: low SNR
+    assert (layer_1.snr < 3.).sum() > (layer_3.snr < 3.).sum() > 0
+    # - layers are not written again if the parameters are unchanged
+    mtime = l_paths[0].joinpath('snr').stat().st_mtime_ns
+    write_synthetic_pair(tmp_path.joinpath('pair'), shape, seed=3,
+                         nodata_fraction=0.1, out_format=out_format,
+                         block_rows=64)
+    assert l_paths[0].joinpath('snr').stat().st_mtime_ns == mtime
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+u"""
+Split a raster into overlapping tiles for block-wise processing.
+"""
+# - python dependencies
+from typing import Iterator, NamedTuple
+
+
+class Tile(NamedTuple):
+    """Raster tile - windows are expressed as (xoff, yoff, xsize, ysize)"""
+    read_window: tuple      # - tile + halo window to read
+    write_window: tuple     # - tile window to write
+    inner: tuple            # - tile slices inside the read window
+
+
+def tile_windows(shape: tuple, tile_size: tuple,
+                 halo: tuple = (0, 0)) -> Iterator[Tile]:
+    """
+    Iterate over the tiles covering a raster of the selected shape.
+    Each tile is extended by a halo on every side (clipped at the raster
+    edges) so that windowed operators computed on the read window are
+    exact on the tile.
+    :param shape: raster shape (rows - azimuth, columns - range) - tuple
+    :param tile_size: tile size (rows, columns) - tuple
+    :param halo: halo size (rows, columns) - tuple
+    :return: iterator of Tile
+    """
+    n_rows, n_cols = shape
+    for row in range(0, n_rows, tile_size[0]):
+        row_end = min(row + tile_size[0], n_rows)
+        r_row = max(row - halo[0], 0)
+        r_row_end = min(row_end + halo[0], n_rows)
+        for col in range(0, n_cols, tile_size[1]):
+            col_end = min(col + tile_size[1], n_cols)
+            r_col = max(col - halo[1], 0)
+            r_col_end = min(col_end + halo[1], n_cols)
+            yield Tile(
+                read_window=(r_col, r_row, r_col_end - r_col,
+                             r_row_end - r_row),
+                write_window=(col, row, col_end - col, row_end - row),
+                inner=(slice(row - r_row, row_end - r_row),
+                       slice(col - r_col, col_end - r_col)),
+            )